@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import heapq
+import json
+from itertools import islice
+
+from django.contrib.gis.db.models.functions import Transform
+from django.http import HttpResponseBadRequest, StreamingHttpResponse
+
+from treemap.models import Plot
+from treemap.search import Filter, ParseException
+
+# Page through the map features matching a search, in id order.
+#
+# Each page ends with a cursor of the form <universal_rev>.<last id>, and
+# the next page starts after that id, so no page needs an OFFSET scan.
+# Ids don't change, so cursors stay valid when the universal rev does,
+# which on a busy instance is after nearly every edit. Each page includes
+# the current universal rev, so clients that need a consistent snapshot
+# can notice that the data changed and start again.
+
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+# Rows fetched per query while streaming a page
+_BATCH_SIZE = 500
+
+
+def search_features(request, instance):
+    """ API Request
+
+    Get the map features matching a search, a page at a time
+
+    Verb: GET
+    Params:
+      q, string, opt -> search filter, as for the web map
+      show, string, opt -> display filter, as for the web map
+      cursor, string, opt -> the "next" value from the previous page
+      size, integer, default = 1000 -> Maximum 10000, number of results
+
+    Output:
+      {
+        universalRev, integer -> the instance's universal rev
+        features, [[id, feature type, lng, lat]] -> in id order
+        next, string -> cursor for the next page, null on the last page
+      }
+    """
+    try:
+        size = int(request.GET.get('size', DEFAULT_PAGE_SIZE))
+        if size not in xrange(1, MAX_PAGE_SIZE + 1):
+            raise ValueError()
+    except ValueError:
+        return HttpResponseBadRequest(
+            'The size parameter must be a number between 1 and %d'
+            % MAX_PAGE_SIZE)
+
+    cursor = request.GET.get('cursor')
+    if cursor:
+        try:
+            __, last_id = (int(part) for part in cursor.split('.'))
+        except ValueError:
+            return HttpResponseBadRequest('Invalid cursor')
+    else:
+        last_id = 0
+
+    filter = Filter(request.GET.get('q', ''), request.GET.get('show', ''),
+                    instance)
+    Models = [Plot] + sorted(instance.resource_classes,
+                             key=lambda Model: Model.__name__)
+    try:
+        querysets = [filter.get_objects(Model)
+                     .annotate(latlon=Transform('geom', 4326))
+                     .order_by('pk')
+                     .values_list('pk', 'feature_type', 'latlon')
+                     for Model in Models]
+    except ParseException as e:
+        return HttpResponseBadRequest(e.message)
+
+    content = _stream_page(instance.universal_rev, querysets, last_id, size)
+    return StreamingHttpResponse(content, content_type='application/json')
+
+
+def _stream_page(universal_rev, querysets, last_id, size):
+    yield '{"universalRev": %d, "features": [' % universal_rev
+
+    n_features = 0
+    for pk, feature_type, latlon in _features_after(querysets, last_id,
+                                                    size):
+        feature = [pk, feature_type, round(latlon.x, 7), round(latlon.y, 7)]
+        yield (',' if n_features else '') + json.dumps(feature)
+        n_features += 1
+        last_id = pk
+
+    if n_features < size:
+        next_cursor = None
+    else:
+        next_cursor = '%d.%d' % (universal_rev, last_id)
+
+    yield '], "next": %s}' % json.dumps(next_cursor)
+
+
+def _features_after(querysets, last_id, size):
+    """
+    Yields up to `size` rows with ids greater than `last_id`, merged in id
+    order from the given querysets, which must each be ordered by id
+    """
+    remaining = size
+    while remaining > 0:
+        n = min(remaining, _BATCH_SIZE)
+        batches = [list(qs.filter(pk__gt=last_id)[:n]) for qs in querysets]
+        rows = list(islice(heapq.merge(*batches), n))
+
+        for row in rows:
+            yield row
+
+        if len(rows) < n:
+            return
+        last_id = rows[-1][0]
+        remaining -= n
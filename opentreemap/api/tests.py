@@ -348,6 +348,51 @@ class PlotListing(OTMTestCase):
         self.assertEqual(rids, set([p1.pk, p2.pk, p3.pk]))
 
 
+class SearchFeatures(OTMTestCase):
+    def setUp(self):
+        self.instance = setupTreemapEnv()
+        self.user = User.objects.get(username="commander")
+        self.plots = [mkPlot(self.instance, self.user) for __ in range(3)]
+        self.url = "%s/instance/%s/search/features" % (
+            API_PFX, self.instance.url_name)
+
+    def _get_page(self, **params):
+        response = get_signed(self.client, self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return loads(b''.join(response.streaming_content))
+
+    def test_pages_follow_cursor(self):
+        page = self._get_page(size=2)
+        self.assertEqual([p.pk for p in self.plots[:2]],
+                         [f[0] for f in page['features']])
+        self.assertEqual('Plot', page['features'][0][1])
+        self.assertIsNotNone(page['next'])
+
+        page = self._get_page(size=2, cursor=page['next'])
+        self.assertEqual([self.plots[2].pk],
+                         [f[0] for f in page['features']])
+        self.assertIsNone(page['next'])
+
+    def test_applies_filter(self):
+        page = self._get_page(q=dumps({'plot.id': {'IS': self.plots[1].pk}}))
+        self.assertEqual([self.plots[1].pk],
+                         [f[0] for f in page['features']])
+
+    def test_cursor_is_accepted_after_rev_change(self):
+        page = self._get_page(size=1)
+        self.instance.update_universal_rev()
+
+        page = self._get_page(size=2, cursor=page['next'])
+        self.assertEqual([p.pk for p in self.plots[1:]],
+                         [f[0] for f in page['features']])
+        self.instance.refresh_from_db()
+        self.assertEqual(self.instance.universal_rev, page['universalRev'])
+
+    def test_malformed_cursor(self):
+        response = get_signed(self.client, self.url, {'cursor': 'nope'})
+        self.assertEqual(response.status_code, 400)
+
+
 class Locations(OTMTestCase):
     def setUp(self):
         self.instance = setupTreemapEnv()
@@ -16,7 +16,8 @@ from api.views import (status_view, version_view, public_instances_endpoint,
                        instance_info_endpoint, add_photo_endpoint,
                        export_users_csv_endpoint, export_users_json_endpoint,
                        update_profile_photo_endpoint,
-                       instances_closest_to_point_endpoint)
+                       instances_closest_to_point_endpoint,
+                       search_features_endpoint)
 
 from treemap.instance import URL_NAME_PATTERN
 
@@ -65,6 +66,7 @@ urlpatterns = [
         plot_endpoint),
     url(instance_pattern + r'/locations/' + lat_lon_pattern + '/plots',
         plots_closest_to_point_endpoint),
+    url(instance_pattern + r'/search/features$', search_features_endpoint),
     url(instance_pattern + r'/users.csv',
         export_users_csv_endpoint, name='user_csv'),
     url(instance_pattern + r'/users.json',
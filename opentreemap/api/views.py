@@ -42,6 +42,7 @@ from api.instance import (instance_info, instances_closest_to_point,
                           public_instances, transform_instance_info_response)
 from api.plots import (plots_closest_to_point, get_plot, update_or_create_plot,
                        transform_plot_update_dict)
+from api.search import search_features
 from api.user import (user_info, create_user, update_user,
                       update_profile_photo, transform_user_request,
                       transform_user_response)
@@ -189,8 +190,12 @@ def get_plot_list(request, instance):
     plots = Plot.objects.filter(instance=instance)\
                         .order_by('id')[start:end]
 
+    plots = list(plots)
+    eco_benefits = Plot.benefits.benefits_for_objects(instance, plots)
+
     def ctxt_for_plot(plot):
-        return context_dict_for_plot(request, plot)
+        return context_dict_for_plot(request, plot,
+                                     eco_benefits=eco_benefits[plot.pk])
 
     return [ctxt_for_plot(plot) for plot in plots]
 
@@ -325,6 +330,14 @@ plot_endpoint = instance_api_do(
 species_list_endpoint = instance_api_do(
     route(GET=species_list))
 
+# Streams its response, so it can't use json_api_call
+search_features_endpoint = do(
+    csrf_exempt,
+    check_signature,
+    set_api_version,
+    instance_request,
+    route(GET=search_features))
+
 user_endpoint = api_do(
     route(
         GET=do(login_required, transform_user_response, user_info),
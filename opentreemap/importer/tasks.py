@@ -11,6 +11,8 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
 from django.db import transaction
 
+from treemap.lib.hide_at_zoom import batch_new_plots
+
 from importer.models.base import GenericImportEvent, GenericImportRow
 from importer.models.species import SpeciesImportEvent, SpeciesImportRow
 from importer.models.trees import TreeImportEvent, TreeImportRow
@@ -182,8 +184,9 @@ def commit_import_event(import_type, import_event_id):
 def _commit_rows(import_type, import_event_id, i):
     ie = _get_import_event(import_type, import_event_id)
 
-    for row in ie.rows()[i:(i + settings.IMPORT_BATCH_SIZE)]:
-        row.commit_row()
+    with batch_new_plots():
+        for row in ie.rows()[i:(i + settings.IMPORT_BATCH_SIZE)]:
+            row.commit_row()
     ie.update_progress_timestamp_and_save()
 
 
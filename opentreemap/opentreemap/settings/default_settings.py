@@ -27,6 +27,26 @@ SYSTEM_USER_ID = -1
 #
 ECO_SERVICE_URL = 'http://localhost:13000'
 
+# Requests to the eco benefit service share a pool of keep-alive
+# connections. ECO_SERVICE_TIMEOUT is a (connect, read) tuple in seconds
+# for GETs. ECO_SERVICE_POST_TIMEOUT is used for the POSTed summaries and
+# scenarios, which can take minutes for large instances, so by default
+# they have no read timeout. Failed connections are retried, as are
+# 502/503/504 responses to GETs, with an exponential backoff of
+# ECO_SERVICE_RETRY_BACKOFF * (2 ** (retry - 1))
+ECO_SERVICE_POOL_SIZE = 10
+ECO_SERVICE_TIMEOUT = (3.05, 30)
+ECO_SERVICE_POST_TIMEOUT = (3.05, None)
+ECO_SERVICE_MAX_RETRIES = 2
+ECO_SERVICE_RETRY_BACKOFF = 0.1
+
+# Set ECO_BACKEND to 'local' to compute eco benefits in-process instead of
+# calling the ecoservice. The local engine reads i-Tree lookup tables
+# from ITREE_DATA_DIR, which can be the ecoservice's data directory (see
+# treemap/ecoengine.py for the file formats).
+ECO_BACKEND = 'service'
+ITREE_DATA_DIR = None
+
 # This should be the google analytics id without
 # the 'GTM-' prefix
 GOOGLE_ANALYTICS_ID = None
@@ -103,6 +123,14 @@ OMGEO_SETTINGS = [[
 #
 TILE_HOST = None
 
+# How many instances `recompute_hide_at_zoom --celery` recomputes at once
+HIDE_AT_ZOOM_RECOMPUTE_CONCURRENCY = 4
+
+# How long to cache vector tiles served by the app (see
+# treemap/lib/vector_tiles.py), in seconds. Keys include the instance's
+# revs, so this only bounds the space used by outdated tiles.
+VECTOR_TILE_CACHE_TIMEOUT = 60 * 60 * 24
+
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
 # although not all choices may be available on all operating systems.
@@ -260,6 +288,14 @@ CELERY_TASK_DEFAULT_ROUTING_KEY = "task.%s" % STACK_COLOR
 CELERY_TASK_SERIALIZER = 'pickle'
 CELERY_ACCEPT_CONTENT = ['pickle', 'application/json']
 
+# Periodic tasks, which are run when `celery beat` is running
+CELERY_BEAT_SCHEDULE = {
+    'prune-search-result-sets': {
+        'task': 'treemap.tasks.prune_search_result_sets',
+        'schedule': 60 * 15,
+    },
+}
+
 ROOT_URLCONF = 'opentreemap.urls'
 
 # Python dotted path to the WSGI application used by Django's runserver.
@@ -392,6 +428,58 @@ IE_VERSION_UNSUPPORTED_REDIRECT_PATH = '/unsupported'
 
 USE_OBJECT_CACHES = True
 USE_ECO_CACHE = True
+# How long a request waits for another process computing the same eco
+# summary or plot count before computing it itself, in seconds
+ECO_CACHE_LOCK_WAIT = 30
+# Return the previous value of an eco summary or plot count after a rev
+# change while a Celery task computes the new one
+ECO_CACHE_SERVE_STALE = False
+# Seconds after an instance's revs change to precompute its unfiltered
+# and per-boundary eco summaries. None disables cache warming.
+ECO_CACHE_WARMING_DELAY = 60
+# Estimate tree eco summaries from a stratified random sample of about
+# ECO_SAMPLE_SIZE trees when more than this many trees match a filter,
+# computing the exact summary in the background. None disables sampling.
+ECO_SAMPLING_THRESHOLD = None
+ECO_SAMPLE_SIZE = 5000
+# Number of threads each process uses to compute the eco summaries of
+# different map feature classes at the same time. 1 disables threading.
+ECO_BENEFIT_THREADS = 4
+# Seconds each process trusts its copy of the i-Tree code override
+# cache buster before reading it from Redis again. 0 always reads it.
+ECO_OVERRIDE_REV_TTL = 5
+# Seconds before the stored catalog of i-Tree codes is refreshed from
+# the ecoservice in the background
+ITREE_CODE_CATALOG_MAX_AGE = 60 * 60 * 24
+# Maximum number of single tree benefit results each process keeps in
+# memory, in addition to the shared cache
+ECO_TREE_CACHE_SIZE = 10000
+# Keep a per-tree table of benefits so filtered summaries are a single
+# SUM query (see treemap/lib/tree_benefits.py)
+USE_TREE_BENEFITS_TABLE = True
+
+# Number of compiled search filters each process keeps (see
+# treemap/search.py). 0 disables the cache.
+FILTER_CACHE_SIZE = 500
+
+# Store the ids matching each search filter so that later queries for
+# the same search read them instead of reevaluating the filter (see
+# treemap/lib/search_result_sets.py). Sets are only stored for filters
+# which are searched for more than once.
+USE_SEARCH_RESULT_SETS = True
+# Seconds to keep a stored search result set after its instance's rev
+# changes, for querysets built on it that haven't been evaluated yet
+SEARCH_RESULT_SET_GRACE_PERIOD = 60 * 60
+
+# Maintain expression indexes for searchable user defined fields (see
+# treemap/lib/udf_indexes.py)
+USE_UDF_INDEXES = True
+
+# Record the audits for direct edits in an outbox table, and have a
+# Celery task move them into the audit table in batches of this many
+# (see treemap/lib/audit_outbox.py)
+USE_AUDIT_OUTBOX = False
+AUDIT_OUTBOX_BATCH_SIZE = 5000
 
 BING_API_KEY = None
 GOOGLE_MAPS_API_KEY = os.environ.get('GOOGLE_MAPS_KEY', None)
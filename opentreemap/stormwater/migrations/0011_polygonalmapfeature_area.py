@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stormwater', '0010_stormwater_blank_true'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='polygonalmapfeature',
+            name='area',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunSQL(
+            'UPDATE stormwater_polygonalmapfeature '
+            'SET area = ST_Area(ST_Transform(polygon, 4326)::geography)',
+            migrations.RunSQL.noop),
+    ]
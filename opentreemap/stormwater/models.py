@@ -18,6 +18,9 @@ class PolygonalMapFeature(MapFeature):
     enable_detail_next = True
 
     polygon = models.MultiPolygonField(srid=3857)
+    # The area of `polygon` in square meters, kept up to date on save so
+    # that benefit summaries can sum it rather than recomputing it
+    area = models.FloatField(null=True, blank=True, editable=False)
 
     objects = models.GeoManager()
 
@@ -31,7 +34,12 @@ class PolygonalMapFeature(MapFeature):
 
     @classproperty
     def do_not_track(cls):
-        return MapFeature.do_not_track | {'polygonalmapfeature_ptr'}
+        return MapFeature.do_not_track | {'polygonalmapfeature_ptr', 'area'}
+
+    def save_with_user(self, user, *args, **kwargs):
+        if self.area is None or 'polygon' in self._updated_fields():
+            self.area = self.calculate_area()
+        super(PolygonalMapFeature, self).save_with_user(user, *args, **kwargs)
 
     @property
     def is_editable(self):
@@ -53,19 +61,6 @@ class PolygonalMapFeature(MapFeature):
                            [polygon.ewkb])
             return cursor.fetchone()[0]
 
-    @classmethod
-    def feature_qs_areas(cls, polygonal_map_feature_qs):
-        """
-        Make a PostGIS query that accurately calculates the area of
-        the polygon(s) by first casting to a Geography.
-        """
-        area_sql = 'ST_Area(ST_Transform(polygon, 4326)::geography)'
-        area_col_name = 'area'
-        feature_areas = polygonal_map_feature_qs \
-            .extra(select={area_col_name: area_sql}) \
-            .values_list(area_col_name, flat=True)
-        return feature_areas
-
     @classmethod
     def field_display_name(cls, field_name):
         if field_name == 'polygon':
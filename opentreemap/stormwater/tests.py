@@ -224,6 +224,17 @@ class PolygonalMapFeatureTest(OTMTestCase):
         self.assertAlmostEqual(bioswale.calculate_area(),
                                self.polygon_area_sq_meters, places=0)
 
+    def test_area_is_stored_on_save(self):
+        bioswale = self._make_map_feature(Bioswale)
+        self.assertAlmostEqual(bioswale.area,
+                               self.polygon_area_sq_meters, places=0)
+
+        # The same square of degrees covers less area further north
+        bioswale.polygon = self._make_square_polygon(-76, 39.5)
+        bioswale.save_with_user(self.user)
+        self.assertAlmostEqual(bioswale.area, bioswale.calculate_area())
+        self.assertLess(bioswale.area, self.polygon_area_sq_meters)
+
     def assert_basis(self, basis, n_used, n_discarded):
         self.assertEqual(basis['resource']['n_objects_used'], n_used)
         self.assertEqual(basis['resource']['n_objects_discarded'], n_discarded)
@@ -16,4 +16,13 @@ admin.site.register(models.Tree)
 admin.site.register(models.User)
 admin.site.register(models.StaticPage)
 
+
+class EcoCacheWarmingAdmin(admin.ModelAdmin):
+    list_display = ('instance', 'started_at', 'finished_at', 'n_filters',
+                    'n_errors', 'geo_rev', 'eco_rev', 'universal_rev')
+    ordering = ('-started_at',)
+
+
+admin.site.register(models.EcoCacheWarming, EcoCacheWarmingAdmin)
+
 admin.site.register(udf.UserDefinedFieldDefinition)
@@ -4,6 +4,7 @@ from __future__ import division
 
 import json
 import hashlib
+from collections import defaultdict
 from functools import partial
 from datetime import datetime
 
@@ -17,7 +18,9 @@ from django.utils.dateformat import format as dformat
 from django.dispatch import receiver
 from django.db import models as django_models
 from django.db.models.signals import post_save, post_delete
+from django.db.models import F
 from django.db.models.fields import FieldDoesNotExist
+from django.db.models.functions import Greatest
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.db import IntegrityError, connection, transaction
 from django.conf import settings
@@ -34,7 +37,8 @@ from treemap.util import (all_models_of_class, leaf_models_of_class,
 from treemap.decorators import classproperty
 
 from treemap.lib.object_caches import (field_permissions,
-                                       invalidate_adjuncts, udf_defs)
+                                       invalidate_adjuncts,
+                                       reputation_metrics, udf_defs)
 from treemap.lib.dates import datesafe_eq
 
 
@@ -329,10 +333,17 @@ def approve_or_reject_existing_edit(audit, user, approved):
                                                   field=audit.field)\
                                           .order_by('-created')
 
+                # Direct edits may still be waiting in the audit outbox
+                newer_outbox_audits = AuditOutbox.objects.filter(
+                    model=audit.model, model_id=audit.model_id,
+                    field=audit.field, created__gt=audit.created)
+
                 is_most_recent_audit = False
                 try:
                     most_recent_audit_pk = most_recent_audits[0].pk
-                    is_most_recent_audit = most_recent_audit_pk == audit.pk
+                    is_most_recent_audit = (
+                        most_recent_audit_pk == audit.pk and
+                        not newer_outbox_audits.exists())
 
                     if is_most_recent_audit:
                         obj.apply_change(audit.field,
@@ -501,6 +512,8 @@ def _get_model_and_field(audit):
 
 @transaction.atomic
 def bulk_create_with_user(auditables, user):
+    from treemap.lib.audit_outbox import write_audits
+
     if not auditables or len({a._model_name for a in auditables}) != 1:
         raise Exception('Auditables must be a nonempty list of the same model')
 
@@ -516,7 +529,7 @@ def bulk_create_with_user(auditables, user):
         audits.extend(model._make_audits(user, Audit.Type.Insert, updates))
 
     ModelClass.objects.bulk_create(auditables)
-    Audit.objects.bulk_create(audits)
+    write_audits(audits)
 
 
 class UserTrackingException(Exception):
@@ -1090,6 +1103,8 @@ class Auditable(UserTrackable):
                                          (self, field.name))
 
     def save_with_user(self, user, updates=None, *args, **kwargs):
+        from treemap.lib.audit_outbox import write_audits
+
         action = Audit.Type.Insert if self.pk is None else Audit.Type.Update
 
         # We need to stash the updated fields, because `save` will change them
@@ -1102,7 +1117,7 @@ class Auditable(UserTrackable):
         super(Auditable, self).save_with_user(user, *args, **kwargs)
         audits = list(self._make_audits(user, action, updates))
 
-        Audit.objects.bulk_create(audits)
+        write_audits(audits)
         ReputationMetric.apply_adjustment(*audits)
 
     def _make_audits(self, user, audit_type, updates):
@@ -1154,6 +1169,15 @@ class Auditable(UserTrackable):
         except IndexError:
             audit_string = 'none'
 
+        # Direct edits may still be waiting in the audit outbox
+        if settings.USE_AUDIT_OUTBOX:
+            outbox_audits = AuditOutbox.objects\
+                                       .filter(model=self._model_name)\
+                                       .filter(model_id=self.pk)\
+                                       .order_by('-pk')
+            if outbox_audits.exists():
+                audit_string += ':outbox%s' % outbox_audits[0].pk
+
         string_to_hash = '%s:%s:%s' % (self._model_name, self.pk, audit_string)
 
         return hashlib.md5(string_to_hash).hexdigest()
@@ -1586,6 +1610,32 @@ class Audit(models.Model):
         return self.requires_auth and not self.ref
 
 
+class AuditOutbox(models.Model):
+    """
+    An Audit which has been recorded but not yet moved into the audit
+    table (see treemap/lib/audit_outbox.py). Only direct edits of
+    existing objects are stored here, so there are no requires_auth or ref
+    fields, and there are no indexes beyond the primary key.
+    """
+    model = models.CharField(max_length=255)
+    model_id = models.IntegerField()
+    instance = models.ForeignKey('Instance', null=True, db_index=False)
+    field = models.CharField(max_length=255, null=True)
+    previous_value = models.TextField(null=True)
+    current_value = models.TextField(null=True)
+    user = models.ForeignKey('treemap.User', db_index=False)
+    action = models.IntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def from_audit(cls, audit):
+        return cls(model=audit.model, model_id=audit.model_id,
+                   instance_id=audit.instance_id, field=audit.field,
+                   previous_value=audit.previous_value,
+                   current_value=audit.current_value,
+                   user_id=audit.user_id, action=audit.action)
+
+
 class ReputationMetric(models.Model):
     """
     Assign integer scores for each model that determine
@@ -1604,32 +1654,40 @@ class ReputationMetric(models.Model):
 
     @staticmethod
     def apply_adjustment(*audits):
-        iusers = {}
+        """
+        Adjust the reputation of each audit's user by the score of the
+        matching metric (if any). Adjustments are summed per user and
+        applied with a single UPDATE per user, using the instance's cached
+        metrics, so a batch of audits costs at most one query per user.
+        """
+        from treemap.models import InstanceUser
+
+        deltas = defaultdict(int)
+        # Users with a denied audit can't be reduced below zero
+        floored = set()
+        metrics_by_instance = {}
+
         for audit in audits:
-            try:
-                rm = ReputationMetric.objects.get(instance=audit.instance,
-                                                  model_name=audit.model,
-                                                  action=audit.action)
-            except ObjectDoesNotExist:
-                return
-
-            key = (audit.user.pk, audit.instance.pk)
-            if key in iusers:
-                iuser = iusers[key]
-            else:
-                iuser = audit.user.get_instance_user(audit.instance)
-                iusers[key] = iuser
+            if audit.instance_id is None or audit.user_id is None:
+                continue
+
+            if audit.instance_id not in metrics_by_instance:
+                metrics_by_instance[audit.instance_id] = \
+                    reputation_metrics(audit.instance)
+            rm = metrics_by_instance[audit.instance_id].get(
+                (audit.model, audit.action))
+            if rm is None:
+                continue
+
+            key = (audit.user_id, audit.instance_id)
 
-            if audit.requires_auth and audit.ref:
+            if audit.requires_auth and audit.ref_id:
                 review_audit = audit.ref
                 if review_audit.action == Audit.Type.PendingApprove:
-                    iuser.reputation += rm.approval_score
+                    deltas[key] += rm.approval_score or 0
                 elif review_audit.action == Audit.Type.PendingReject:
-                    new_score = iuser.reputation - rm.denial_score
-                    if new_score >= 0:
-                        iuser.reputation = new_score
-                    else:
-                        iuser.reputation = 0
+                    deltas[key] -= rm.denial_score or 0
+                    floored.add(key)
                 else:
                     error_message = ("Referenced Audits must carry approval "
                                      "actions. They must have an action of "
@@ -1638,10 +1696,21 @@ class ReputationMetric(models.Model):
                                      "database configuration.")
                     raise IntegrityError(error_message)
             elif not audit.requires_auth:
-                iuser.reputation += rm.direct_write_score
+                deltas[key] += rm.direct_write_score or 0
+
+        for (user_id, instance_id), delta in deltas.iteritems():
+            if delta == 0:
+                continue
+            reputation = F('reputation') + delta
+            if (user_id, instance_id) in floored:
+                reputation = Greatest(reputation, 0)
+            InstanceUser.objects \
+                .filter(user_id=user_id, instance_id=instance_id) \
+                .update(reputation=reputation)
+
 
-        for iuser in iusers.itervalues():
-            iuser.save_base()
+post_save.connect(invalidate_adjuncts, sender=ReputationMetric)
+post_delete.connect(invalidate_adjuncts, sender=ReputationMetric)
 
 
 @receiver(post_save, sender=Audit)
@@ -3,11 +3,18 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 
-import urllib2
-import urllib
 import json
+import os
 import re
 import sys
+import threading
+import time
+
+from collections import defaultdict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from django.conf import settings
 from django.contrib.gis.db.backends.postgis.adapter import PostGISAdapter
@@ -46,6 +53,13 @@ add_rollbar_handler(logger, level=logging.INFO)
 # replace these patterns with simple destructuring.
 #
 
+# The benefit factors returned by the ecoservice for each tree
+BENEFIT_FACTORS = ('aq_nox_avoided', 'aq_nox_dep', 'aq_ozone_dep',
+                   'aq_pm10_avoided', 'aq_pm10_dep', 'aq_sox_avoided',
+                   'aq_sox_dep', 'aq_voc_avoided', 'bvoc', 'co2_avoided',
+                   'co2_sequestered', 'co2_storage', 'electricity',
+                   'hydro_interception', 'natural_gas')
+
 INVALID_ECO_PAIR = 'invalid_eco_pair'
 INCOMPLETE_ECO_DATA = 'incomplete_eco_data'
 UNKNOWN_ECO_FAILURE = 'unknown_eco_failure'
@@ -70,12 +84,97 @@ LOG_FUNCTION_FOR_FAILURE_CODE = {
 }
 
 
-def json_benefits_call(endpoint, params, post=False, convert_params=True):
+# All ecobackend callers share a single pooled, keep-alive HTTP session
+# per process. The session is rebuilt if we find ourselves in a forked
+# child (e.g. a Celery worker) so that sockets are never shared between
+# processes.
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def _get_session():
+    global _session, _session_pid
+
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            retry = Retry(total=settings.ECO_SERVICE_MAX_RETRIES,
+                          backoff_factor=settings.ECO_SERVICE_RETRY_BACKOFF,
+                          status_forcelist=(502, 503, 504),
+                          # Only GETs are retried after a read timeout or
+                          # error status. POSTs (eco_summary and
+                          # eco_scenario) can take minutes, so they are
+                          # only retried if they failed to connect.
+                          method_whitelist=frozenset(['GET']),
+                          raise_on_status=False)
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=settings.ECO_SERVICE_POOL_SIZE,
+                max_retries=retry)
+
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+            _session = session
+            _session_pid = os.getpid()
+
+        return _session
+
+
+# Per-process counters of ecoservice calls, keyed by endpoint
+_stats = defaultdict(lambda: {'calls': 0, 'errors': 0, 'seconds': 0.0})
+_stats_lock = threading.Lock()
+
+
+def _record_call(endpoint, seconds, failed):
+    with _stats_lock:
+        stats = _stats[endpoint]
+        stats['calls'] += 1
+        stats['seconds'] += seconds
+        if failed:
+            stats['errors'] += 1
+
+
+def ecoservice_stats():
+    """
+    Returns a dictionary, keyed by endpoint, of the number of ecoservice
+    calls made by this process, how many of them failed, the total time
+    spent waiting on them and the derived mean latency and error rate
+    """
+    with _stats_lock:
+        snapshot = {endpoint: dict(stats)
+                    for endpoint, stats in _stats.iteritems()}
+
+    for stats in snapshot.values():
+        calls = stats['calls']
+        stats['mean_seconds'] = stats['seconds'] / calls if calls else 0.0
+        stats['error_rate'] = stats['errors'] / calls if calls else 0.0
+
+    return snapshot
+
+
+def reset_ecoservice_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def json_benefits_call(endpoint, params, post=False, convert_params=True,
+                       timeout=None):
     url = "%s/%s" % (settings.ECO_SERVICE_URL, endpoint)
 
     if endpoint not in ['invalidate_cache', 'itree_codes.json']:
         invalidate_ecoservice_cache_if_stale()
 
+    if settings.ECO_BACKEND == 'local':
+        from treemap import ecoengine
+        return ecoengine.json_benefits_call(endpoint, params, post,
+                                            convert_params)
+
+    if timeout is None:
+        timeout = (settings.ECO_SERVICE_POST_TIMEOUT if post
+                   else settings.ECO_SERVICE_TIMEOUT)
+
     if post:
         if convert_params:
             paramdata = {}
@@ -106,16 +205,13 @@ def json_benefits_call(endpoint, params, post=False, convert_params=True):
             data = json.dumps(paramdata)
         else:
             data = json.dumps(params)
-        req = urllib2.Request(url,
-                              data,
-                              {'Content-Type': 'application/json'})
+        method = 'POST'
+        request_kwargs = {'data': data,
+                          'headers': {'Content-Type': 'application/json'}}
     else:
-        paramString = "&".join(["%s=%s" % (urllib.quote_plus(str(name)),
-                                           urllib.quote_plus(str(val)))
-                                for (name, val) in params])
-
-        # A get request is assumed by urllib2
-        req = url + '?' + paramString
+        method = 'GET'
+        request_kwargs = {'params': [(str(name), str(val))
+                                     for (name, val) in params]}
 
     # the caller decides if it wants to raise the error
     # as an exception, or return it as a status code on
@@ -123,45 +219,53 @@ def json_benefits_call(endpoint, params, post=False, convert_params=True):
     # return this string, and never raise.
     general_unhandled_struct = (None, UNKNOWN_ECO_FAILURE)
 
+    start = time.time()
     try:
-        result = urllib2.urlopen(req).read()
+        response = _get_session().request(method, url, timeout=timeout,
+                                          **request_kwargs)
+    except requests.RequestException:
+        _record_call(endpoint, time.time() - start, failed=True)
+        logger.error("Error connecting to ecoservice", exc_info=sys.exc_info())
+        return general_unhandled_struct
+
+    failed = not response.ok
+    _record_call(endpoint, time.time() - start, failed=failed)
+
+    if not failed:
+        result = response.content
         if result:
             result = json.loads(result)
         return result, None
-    except urllib2.HTTPError as e:
-        error_body = e.fp.read()
-        for code, patterns in ECOBENEFIT_FAILURE_CODES_AND_PATTERNS.items():
-            for pattern in patterns:
-                match = re.match(pattern, error_body)
-                if match:
-                    # When you pass a dictionary to a Python logger's
-                    # `extra` kwarg, each key in the dictionary is
-                    # added as an attribute on the log message object
-                    # itself. Rollbar specifically looks for an
-                    # attribute named `extra_data` on the log message.
-                    # https://github.com/rollbar/pyrollbar/blob/cbfc2529a2d8847e18f7134aa874eb7c68426e2f/rollbar/logger.py#L97 # NOQA
-                    extra = {
-                        'extra_data': {
-                            'ecobenefit_message': error_body,
-                            'ecobenefit_matched_message_pattern': pattern,
-                            'ecobenefit_failure_code': code
-                        }
+
+    error_body = response.content
+    for code, patterns in ECOBENEFIT_FAILURE_CODES_AND_PATTERNS.items():
+        for pattern in patterns:
+            match = re.match(pattern, error_body)
+            if match:
+                # When you pass a dictionary to a Python logger's
+                # `extra` kwarg, each key in the dictionary is
+                # added as an attribute on the log message object
+                # itself. Rollbar specifically looks for an
+                # attribute named `extra_data` on the log message.
+                # https://github.com/rollbar/pyrollbar/blob/cbfc2529a2d8847e18f7134aa874eb7c68426e2f/rollbar/logger.py#L97 # NOQA
+                extra = {
+                    'extra_data': {
+                        'ecobenefit_message': error_body,
+                        'ecobenefit_matched_message_pattern': pattern,
+                        'ecobenefit_failure_code': code
                     }
-                    # We set the text of the log message to the code
-                    # and pattern that were matched rather than the
-                    # fully detailed message so that Rollbar can group
-                    # and count similar failures.
-                    LOG_FUNCTION_FOR_FAILURE_CODE[code](
-                        "ECOBENEFIT FAILURE: %s %s " % (code, pattern),
-                        extra=extra)
-                    return (None, code)
-        else:
-            # If we did not break out of the loop by returning early
-            # that means we received an unknown response from the
-            # ecoservice.
-            LOG_FUNCTION_FOR_FAILURE_CODE[UNKNOWN_ECO_FAILURE](
-                "ECOBENEFIT FAILURE: " + error_body)
-            return general_unhandled_struct
-    except urllib2.URLError:
-        logger.error("Error connecting to ecoservice", exc_info=sys.exc_info())
-        return general_unhandled_struct
+                }
+                # We set the text of the log message to the code
+                # and pattern that were matched rather than the
+                # fully detailed message so that Rollbar can group
+                # and count similar failures.
+                LOG_FUNCTION_FOR_FAILURE_CODE[code](
+                    "ECOBENEFIT FAILURE: %s %s " % (code, pattern),
+                    extra=extra)
+                return (None, code)
+
+    # If we did not return early that means we received an
+    # unknown response from the ecoservice.
+    LOG_FUNCTION_FOR_FAILURE_CODE[UNKNOWN_ECO_FAILURE](
+        "ECOBENEFIT FAILURE: " + error_body)
+    return general_unhandled_struct
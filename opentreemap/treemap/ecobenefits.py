@@ -3,15 +3,27 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.gis.geos.point import Point
-from django.db import connection
+from django.db import close_old_connections, connection
 
 from django_tinsel.decorators import json_api_call
+from multiprocessing.pool import ThreadPool
+import copy
+import hashlib
 import itertools
+import json
+import math
+import os
+import threading
+import time
 
 from treemap import ecobackend
-from treemap.ecocache import get_cached_benefits
+from treemap.ecocache import get_cached_benefits, get_cached_tree_benefits
 
 WATTS_PER_BTU = 0.29307107
 GAL_PER_CUBIC_M = 264.172052
@@ -20,6 +32,32 @@ FEET_SQ_PER_METER_SQ = 10.7639
 FEET_PER_INCH = 1/12.0
 GALLONS_PER_CUBIC_FT = 7.48
 
+# Sampled eco summaries stratify trees by region, species and diameter
+# class, and report the half-width of a 95% confidence interval
+_SAMPLE_DIAMETER_CLASS_INCHES = 6
+_SAMPLE_Z_SCORE = 1.96
+
+# Draws a random sample of the trees returned by `query` (diameter,
+# species id, otm code and, for multiple regions, x and y), taking the
+# same fraction of each stratum but at least one tree, along with the
+# number of trees in each stratum
+_SAMPLE_SQL = """
+    SELECT diameter, species_id, otm_code, region_code, n_stratum
+    FROM (
+        SELECT t.diameter, t.species_id, t.otm_code,
+               {region_code} AS region_code,
+               row_number() OVER (PARTITION BY {stratum}
+                                  ORDER BY random()) AS n_row,
+               count(*) OVER (PARTITION BY {stratum}) AS n_stratum
+        FROM ({query}) AS t (diameter, species_id, otm_code{xy})
+        {join}
+    ) AS s
+    WHERE n_row <= GREATEST(1, CEIL(n_stratum * {fraction}))
+"""
+
+_EXACT_SCHEDULED_KEY = 'eco_exact_scheduled/%s'
+_EXACT_SCHEDULED_TIMEOUT = 60 * 30
+
 
 class BenefitCategory(object):
     ENERGY = 'energy'
@@ -82,6 +120,9 @@ class BenefitCalculator(object):
 
     benefits_for_object returns a tuple of:
     (dict from above, basis dict, error [or None])
+
+    benefits_for_objects returns a dictionary mapping each object's
+    id to the tuple benefits_for_object would return for it
     """
 
     def benefits_for_filter(self, instance, item_filter):
@@ -90,6 +131,10 @@ class BenefitCalculator(object):
     def benefits_for_object(self, instance, obj):
         return {}
 
+    def benefits_for_objects(self, instance, objs):
+        return {obj.pk: self.benefits_for_object(instance, obj)
+                for obj in objs}
+
 
 class CountOnlyBenefitCalculator(BenefitCalculator):
     def __init__(self, clz):
@@ -115,8 +160,17 @@ class TreeBenefitsCalculator(BenefitCalculator):
         # UnicodeDecodeError
         return unicode(cursor.mogrify(sql, params), 'utf-8')
 
-    def benefits_for_filter(self, instance, item_filter):
+    def benefits_for_filter(self, instance, item_filter,
+                            allow_sampling=True):
+        """
+        When settings.ECO_SAMPLING_THRESHOLD is set and more trees than
+        that match the filter, the summary is estimated from a stratified
+        random sample of them and, if the eco cache is on, the exact
+        summary is computed by a Celery task and replaces the estimate.
+        Passing allow_sampling=False always computes the exact summary.
+        """
         from treemap.models import Plot, Tree
+        from treemap.lib.tree_benefits import summed_tree_benefits
 
         instance = item_filter.instance
         plots = item_filter.get_objects(Plot)
@@ -137,6 +191,13 @@ class TreeBenefitsCalculator(BenefitCalculator):
                 instance, {})
             return (empty_rslt, basis)
 
+        if settings.USE_TREE_BENEFITS_TABLE:
+            summed = summed_tree_benefits(instance, trees)
+            if summed is not None:
+                benefits, n_computed_trees = summed
+                return self._extrapolated_summary(
+                    instance, benefits, n_computed_trees, n_total_trees)
+
         # When calculating benefits we can skip region information
         # if there is only one intersecting region or if the
         # instance forces a region on us
@@ -182,6 +243,13 @@ class TreeBenefitsCalculator(BenefitCalculator):
 
             query = query.replace(targetGeomField, xyGeomFields, 1)
 
+        threshold = settings.ECO_SAMPLING_THRESHOLD
+        if (allow_sampling and threshold is not None
+                and n_total_trees > threshold):
+            self._schedule_exact_summary(item_filter)
+            return self._sampled_summary(instance, query, region_code,
+                                         n_total_trees)
+
         params = {'query': query,
                   'instance_id': instance.pk,
                   'region': region_code or ""}
@@ -199,6 +267,11 @@ class TreeBenefitsCalculator(BenefitCalculator):
         else:
             n_computed_trees = 1
 
+        return self._extrapolated_summary(
+            instance, benefits, n_computed_trees, n_total_trees)
+
+    def _extrapolated_summary(self, instance, benefits, n_computed_trees,
+                              n_total_trees):
         # Extrapolate an average over the rest of the urban forest
         if n_computed_trees > 0 and n_total_trees > 0:
             percent = float(n_computed_trees) / n_total_trees
@@ -213,49 +286,243 @@ class TreeBenefitsCalculator(BenefitCalculator):
 
         return (rslt, basis)
 
+    def _sampled_summary(self, instance, query, region_code,
+                         n_total_trees):
+        fraction = min(1.0, settings.ECO_SAMPLE_SIZE / n_total_trees)
+        stratum = 't.species_id, FLOOR(t.diameter / %d)' % \
+            _SAMPLE_DIAMETER_CLASS_INCHES
+
+        if region_code:
+            sql = _SAMPLE_SQL.format(
+                query=query, stratum=stratum, fraction=repr(fraction),
+                region_code="'%s'" % region_code, xy='', join='')
+        else:
+            sql = _SAMPLE_SQL.format(
+                query=query, stratum='r.code, ' + stratum,
+                fraction=repr(fraction), region_code='r.code', xy=', x, y',
+                join='JOIN treemap_itreeregion r ON ST_Contains('
+                     'r.geometry, ST_SetSRID(ST_MakePoint(t.x, t.y), 3857))')
+
+        strata = {}
+        with connection.cursor() as cursor:
+            # The query already has its parameters interpolated
+            cursor.execute(sql)
+            for diameter, species_id, otm_code, row_region_code, n_stratum \
+                    in cursor.fetchall():
+                stratum_key = (row_region_code, species_id,
+                               diameter // _SAMPLE_DIAMETER_CLASS_INCHES)
+                n_stratum, sample = strata.setdefault(
+                    stratum_key, (n_stratum, []))
+                sample.append((row_region_code, species_id, otm_code,
+                               diameter))
+
+        # Trees with the same region, species and diameter have the same
+        # benefits, so look each combination up once
+        values_by_key = {}
+
+        def values_for(key):
+            if key not in values_by_key:
+                benefits, err = raw_benefits_for_tree(instance, *key)
+                if err:
+                    values_by_key[key] = None
+                else:
+                    groups = compute_currency_and_transform_units(
+                        instance, dict(benefits))['plot']
+                    values_by_key[key] = (benefits, {
+                        group: groups[group]['value']
+                        for group in BenefitCategory.GROUPS})
+            return values_by_key[key]
+
+        # Estimate totals from the mean of each stratum's sample, counting
+        # trees we can't compute benefits for as zero
+        benefits = {}
+        variances = {group: 0.0 for group in BenefitCategory.GROUPS}
+        n_computed = 0.0
+        n_sampled = 0
+        for n_stratum, sample in strata.itervalues():
+            n = len(sample)
+            n_sampled += n
+            weight = n_stratum / n
+            group_values = {group: [] for group in BenefitCategory.GROUPS}
+
+            for key in sample:
+                values = values_for(key)
+                if values is None:
+                    for group in BenefitCategory.GROUPS:
+                        group_values[group].append(0.0)
+                    continue
+
+                raw, groups = values
+                n_computed += weight
+                for factor, value in raw.iteritems():
+                    benefits[factor] = benefits.get(factor, 0.0) + \
+                        value * weight
+                for group in BenefitCategory.GROUPS:
+                    group_values[group].append(groups[group])
+
+            if n > 1:
+                finite_population_correction = 1 - n / n_stratum
+                for group, ys in group_values.iteritems():
+                    mean = sum(ys) / n
+                    s2 = sum((y - mean) ** 2 for y in ys) / (n - 1)
+                    variances[group] += (n_stratum ** 2 * s2 / n *
+                                         finite_population_correction)
+
+        n_computed_trees = int(round(n_computed))
+        rslt, basis = self._extrapolated_summary(
+            instance, benefits, n_computed_trees, n_total_trees)
+
+        if n_computed_trees > 0:
+            scale = n_total_trees / n_computed_trees
+        else:
+            scale = 1.0
+        basis['plot']['n_objects_sampled'] = n_sampled
+        for group, variance in variances.iteritems():
+            basis['plot']['ci95_' + group] = \
+                _SAMPLE_Z_SCORE * math.sqrt(variance) * scale
+
+        return rslt, basis
+
+    def _schedule_exact_summary(self, item_filter):
+        from treemap.tasks import compute_exact_benefits
+
+        if not settings.USE_ECO_CACHE:
+            return
+
+        instance = item_filter.instance
+        filter_key = '%s/%s/%s/%s' % (
+            instance.pk, instance.universal_rev,
+            item_filter.filterstr, item_filter.displaystr)
+        key = _EXACT_SCHEDULED_KEY % hashlib.md5(
+            filter_key.encode('utf-8')).hexdigest()
+
+        if cache.add(key, True, _EXACT_SCHEDULED_TIMEOUT):
+            transaction.on_commit(lambda: compute_exact_benefits.delay(
+                instance.pk, item_filter.filterstr, item_filter.displaystr))
+
     def benefits_for_object(self, instance, plot):
         tree = plot.current_tree()
-        error = None
+        error = self._missing_tree_data_error(tree)
 
-        if tree is None:
+        if error:
             rslt = None
-            error = 'NO_TREE'
+        else:
+            rslt, error = self._benefits_for_tree(
+                instance, plot.itree_region.code, tree.species.pk,
+                tree.species.otm_code, tree.diameter)
+
+        return (rslt, self._object_basis(rslt), error)
+
+    def benefits_for_objects(self, instance, plots):
+        """
+        Trees which share a region, species and diameter have identical
+        benefits, so each distinct combination is only looked up once
+        no matter how many plots share it
+        """
+        from treemap.models import Tree
+
+        plots = list(plots)
+
+        trees_by_plot_id = {}
+        trees = Tree.objects.filter(plot__in=plots).select_related('species')
+        for tree in trees:
+            trees_by_plot_id.setdefault(tree.plot_id, tree)
+
+        region_code_for_plot = region_code_lookup(instance)
+
+        results = {}
+        benefits_by_key = {}
+        for plot in plots:
+            tree = trees_by_plot_id.get(plot.pk)
+            error = self._missing_tree_data_error(tree)
+
+            if error:
+                rslt = None
+            else:
+                key = (region_code_for_plot(plot), tree.species.pk,
+                       tree.species.otm_code, tree.diameter)
+                if key not in benefits_by_key:
+                    benefits_by_key[key] = self._benefits_for_tree(
+                        instance, *key)
+                rslt, error = benefits_by_key[key]
+                # Callers are free to modify the returned benefits
+                rslt = copy.deepcopy(rslt)
+
+            results[plot.pk] = (rslt, self._object_basis(rslt), error)
+
+        return results
+
+    def _missing_tree_data_error(self, tree):
+        if tree is None:
+            return 'NO_TREE'
         elif not tree.diameter:
-            rslt = None
-            error = 'MISSING_DBH'
+            return 'MISSING_DBH'
         elif not tree.species:
-            rslt = None
-            error = 'MISSING_SPECIES'
+            return 'MISSING_SPECIES'
         else:
-            region_code = plot.itree_region.code
+            return None
 
-            if region_code:
-                params = {'otmcode': tree.species.otm_code,
-                          'diameter': tree.diameter,
-                          'region': region_code,
-                          'instanceid': instance.pk,
-                          'speciesid': tree.species.pk}
+    def _benefits_for_tree(self, instance, region_code, species_id,
+                           otm_code, diameter):
+        benefits, err = raw_benefits_for_tree(
+            instance, region_code, species_id, otm_code, diameter)
 
-                rawb, err = ecobackend.json_benefits_call(
-                    'eco.json', params.iteritems())
+        if err == 'MISSING_REGION':
+            return None, err
+        elif err:
+            return {'error': err}, err
+        else:
+            return compute_currency_and_transform_units(
+                instance, benefits), None
 
-                if err:
-                    rslt = {'error': err}
-                    error = err
-                else:
-                    benefits = compute_currency_and_transform_units(
-                        instance, rawb['Benefits'])
+    def _object_basis(self, rslt):
+        return {'plot':
+                {'n_objects_used': 1 if rslt else 0,
+                 'n_objects_discarded': 0 if rslt else 1}}
 
-                    rslt = benefits
-            else:
-                rslt = None
-                error = 'MISSING_REGION'
 
-        basis = {'plot':
-                 {'n_objects_used': 1 if rslt else 0,
-                  'n_objects_discarded': 0 if rslt else 1}}
+def raw_benefits_for_tree(instance, region_code, species_id, otm_code,
+                          diameter):
+    """
+    Returns a tuple of (benefits, error) where benefits are the
+    unconverted values from the ecoservice for a single tree
+    """
+    if not region_code:
+        return None, 'MISSING_REGION'
+
+    params = {'otmcode': otm_code,
+              'diameter': diameter,
+              'region': region_code,
+              'instanceid': instance.pk,
+              'speciesid': species_id}
+
+    def compute_benefits():
+        rawb, err = ecobackend.json_benefits_call(
+            'eco.json', params.iteritems())
+        return (None if err else rawb['Benefits']), err
+
+    return get_cached_tree_benefits(
+        region_code, species_id, otm_code, diameter, compute_benefits)
+
+
+def region_code_lookup(instance):
+    """
+    Returns a function from a plot to the code of the i-Tree region
+    containing it, matching `Plot.itree_region` but fetching the
+    instance's regions only once
+    """
+    if instance.itree_region_default:
+        return lambda plot: instance.itree_region_default
+
+    regions = list(instance.itree_regions())
 
-        return (rslt, basis, error)
+    def region_code_for_plot(plot):
+        for region in regions:
+            if region.geometry.contains(plot.geom):
+                return region.code
+        return None
+
+    return region_code_for_plot
 
 
 def compute_currency_and_transform_units(instance, benefits):
@@ -414,12 +681,53 @@ def _annotate_basis_with_extra_stats(basis):
             abasis['n_pct_calculated'] = pct
 
 
+# The calculators for each map feature class are independent (the tree
+# calculator mostly waits on the ecoservice, the others on PostGIS), so
+# they run on a per-process pool of threads. Django gives each thread its
+# own database connection.
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPool(settings.ECO_BENEFIT_THREADS)
+            _pool_pid = os.getpid()
+
+        return _pool
+
+
+def _benefits_for_class_in_thread(args):
+    cls, filter = args
+    close_old_connections()
+    try:
+        return _benefits_for_class(cls, filter)
+    finally:
+        close_old_connections()
+
+
+def _benefits_for_classes(classes, filter):
+    # Other connections can't see changes made by an uncommitted
+    # transaction, so in that case everything runs on this connection
+    if (len(classes) < 2 or settings.ECO_BENEFIT_THREADS < 2
+            or connection.in_atomic_block):
+        return [_benefits_for_class(C, filter) for C in classes]
+
+    # Results come back in the order of `classes`, so merging them
+    # is deterministic
+    return _get_pool().map(_benefits_for_class_in_thread,
+                           [(C, filter) for C in classes])
+
+
 def get_benefits_for_filter(filter):
     benefits, basis = {}, {}
 
-    for C in filter.instance.map_feature_classes:
-        ft_benefit_groups, ft_basis = _benefits_for_class(C, filter)
-
+    classes = filter.instance.map_feature_classes
+    for ft_benefit_groups, ft_basis in _benefits_for_classes(classes, filter):
         _combine_benefit_basis(basis, ft_basis)
         _combine_grouped_benefits(benefits, ft_benefit_groups)
 
@@ -451,8 +759,21 @@ benefit_labels = {
 }
 
 
+# The i-Tree codes for each region are kept in an ITreeCodeCatalog row, so
+# a new process only needs a database query to load them. Each process
+# checks for a newer catalog every _ITREE_CODES_RECHECK_SECONDS, and when
+# the stored catalog is older than settings.ITREE_CODE_CATALOG_MAX_AGE a
+# Celery task fetches a fresh one from the ecoservice. The ecoservice is
+# only called synchronously when no catalog has been stored yet.
+
+_ITREE_CODES_RECHECK_SECONDS = 60 * 5
+_ITREE_CODES_REFRESH_SCHEDULED_KEY = 'itree_code_catalog_refresh_scheduled'
+
 _itree_codes_by_region = None
 _all_itree_codes = None
+_itree_codes_version = None
+_itree_codes_checked_at = 0
+_itree_codes_lock = threading.Lock()
 
 
 def all_itree_codes():
@@ -462,21 +783,75 @@ def all_itree_codes():
 
 def has_itree_code(region_code, itree_code):
     _ensure_itree_codes_fetched()
-    has = itree_code in _itree_codes_by_region.get(region_code, [])
+    has = itree_code in _itree_codes_by_region.get(region_code, ())
     return has
 
 
 def _ensure_itree_codes_fetched():
-    global _itree_codes_by_region, _all_itree_codes
-    if _itree_codes_by_region is None:
-        result, err = ecobackend.json_benefits_call('itree_codes.json', {})
-        if err:
-            raise Exception('Failed to retrieve i-Tree codes from ecoservice')
+    global _itree_codes_checked_at
+    from treemap.models import ITreeCodeCatalog
+
+    with _itree_codes_lock:
+        now = time.time()
+        if (_itree_codes_by_region is not None and
+                now - _itree_codes_checked_at < _ITREE_CODES_RECHECK_SECONDS):
+            return
+        _itree_codes_checked_at = now
+
+        try:
+            catalog = ITreeCodeCatalog.objects.only('version', 'fetched_at') \
+                                              .latest()
+        except ITreeCodeCatalog.DoesNotExist:
+            catalog = refresh_itree_code_catalog()
+
+        if catalog.version != _itree_codes_version:
+            # Only load the (deferred) codes when they have changed
+            _load_itree_codes(catalog)
+
+        age = timezone.now() - catalog.fetched_at
+        if age.total_seconds() > settings.ITREE_CODE_CATALOG_MAX_AGE:
+            _schedule_itree_code_catalog_refresh()
+
+
+def _load_itree_codes(catalog):
+    global _itree_codes_by_region, _all_itree_codes, _itree_codes_version
+
+    _itree_codes_by_region = {region_code: frozenset(codes)
+                              for region_code, codes
+                              in catalog.codes.iteritems()}
+    _all_itree_codes = set(
+        itertools.chain(*_itree_codes_by_region.values()))
+    _itree_codes_version = catalog.version
+
+
+def _schedule_itree_code_catalog_refresh():
+    from treemap.tasks import refresh_itree_code_catalog as refresh_task
+
+    if cache.add(_ITREE_CODES_REFRESH_SCHEDULED_KEY, True,
+                 _ITREE_CODES_RECHECK_SECONDS):
+        transaction.on_commit(lambda: refresh_task.delay())
+
+
+def refresh_itree_code_catalog():
+    """
+    Fetch the i-Tree codes from the ecoservice and store them, returning
+    the stored ITreeCodeCatalog
+    """
+    from treemap.models import ITreeCodeCatalog
+
+    result, err = ecobackend.json_benefits_call('itree_codes.json', {})
+    if err:
+        raise Exception('Failed to retrieve i-Tree codes from ecoservice')
 
-        _itree_codes_by_region = result['Codes']
+    codes = {region_code: sorted(region_codes)
+             for region_code, region_codes in result['Codes'].iteritems()}
+    version = hashlib.md5(
+        json.dumps(codes, sort_keys=True).encode('utf-8')).hexdigest()
 
-        _all_itree_codes = set(
-            itertools.chain(*_itree_codes_by_region.values()))
+    catalog, __ = ITreeCodeCatalog.objects.update_or_create(
+        version=version,
+        defaults={'codes': codes, 'fetched_at': timezone.now()})
+    return catalog
 
 
 within_itree_regions_view = json_api_call(within_itree_regions)
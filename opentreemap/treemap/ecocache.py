@@ -2,7 +2,12 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
+import copy
 import hashlib
+import threading
+import time
+
+from collections import OrderedDict
 
 from django.conf import settings
 from django.core.cache import cache
@@ -19,10 +24,30 @@ from treemap.models import Plot, ITreeCodeOverride
 #
 # Plot key is count/plots/<url_name>/<universal_rev>/<filter_hash>
 # Eco key is eco/trees/<url_name>/<universal_rev>/<filter_hash>
+#
+# Search facet counts (see treemap/lib/facets.py) are always keyed by
+# universal_rev: facets/<facet>/<url_name>/<universal_rev>/<filter_hash>
+#
+# Only one process computes a given key at a time. Others wait for its
+# result, polling the cache, rather than repeating the computation.
+#
+# With settings.ECO_CACHE_SERVE_STALE, the most recently computed value
+# for each prefix/instance/filter is also kept, regardless of rev, under
+#
+# <prefix>/<url_name>/latest/<filter_hash>
+#
+# and is returned on a miss while a Celery task computes the new value.
 
 # Entries will be neither numerous nor large, so let them live for a month
 _TIMEOUT = 60 * 60 * 24 * 30
 
+# Upper bound on how long a crashed computation can block others
+_LOCK_TIMEOUT = 60 * 5
+_POLL_INTERVAL = 0.1
+
+_stats = {'hits': 0, 'misses': 0, 'waits': 0, 'stale': 0}
+_stats_lock = threading.Lock()
+
 
 def get_cached_benefits(class_name, filter, compute_value):
     prefix = 'eco/%s' % class_name
@@ -36,18 +61,119 @@ def get_cached_plot_count(filter):
     return _get_or_compute(prefix, filter, compute_value)
 
 
-def _get_or_compute(prefix, filter, compute_value):
+def get_cached_facet(name, filter, compute_value):
+    # Facets are cheap enough that it isn't worth serving stale counts
+    prefix = 'facets/%s' % name
+    return _get_or_compute(prefix, filter, compute_value, serve_stale=False)
+
+
+def _get_or_compute(prefix, filter, compute_value, serve_stale=True):
     if not settings.USE_ECO_CACHE:
-        value = compute_value()
-    else:
-        key = _get_key(prefix, filter)
+        return compute_value()
+
+    key = _get_key(prefix, filter)
+    value = cache.get(key)
+    if value is not None:
+        _count('hits')
+        return value
+
+    _count('misses')
+    lock_key = key + '/lock'
+
+    if serve_stale and settings.ECO_CACHE_SERVE_STALE:
+        stale_value = cache.get(_get_latest_key(prefix, filter))
+        if stale_value is not None:
+            if cache.add(lock_key, True, _LOCK_TIMEOUT):
+                from treemap.tasks import refresh_eco_cache
+                refresh_eco_cache.delay(prefix, filter.instance.pk,
+                                        filter.filterstr, filter.displaystr,
+                                        lock_key)
+            _count('stale')
+            return stale_value
+
+    if cache.add(lock_key, True, _LOCK_TIMEOUT):
+        try:
+            return _compute_and_set(prefix, filter, key, compute_value)
+        finally:
+            cache.delete(lock_key)
+
+    # Another process is computing this value
+    _count('waits')
+    deadline = time.time() + settings.ECO_CACHE_LOCK_WAIT
+    while time.time() < deadline:
+        time.sleep(_POLL_INTERVAL)
         value = cache.get(key)
-        if value is None:
-            value = compute_value()
-            cache.set(key, value, _TIMEOUT)
+        if value is not None:
+            return value
+
+    # It is taking too long, or it failed
+    return _compute_and_set(prefix, filter, key, compute_value)
+
+
+def _compute_and_set(prefix, filter, key, compute_value, replace=False):
+    value = compute_value()
+    if replace:
+        cache.set(key, value, _TIMEOUT)
+    elif not cache.add(key, value, _TIMEOUT):
+        # A value was stored while we were computing, e.g. the exact
+        # benefits from the task that computing a sampled estimate
+        # scheduled, and it shouldn't be replaced with ours
+        stored_value = cache.get(key)
+        return stored_value if stored_value is not None else value
+    if settings.ECO_CACHE_SERVE_STALE:
+        cache.set(_get_latest_key(prefix, filter), value, _TIMEOUT)
     return value
 
 
+def refresh_cached_value(prefix, filter, lock_key):
+    """
+    Compute and cache the current value for a prefix and filter on
+    behalf of a request that was served a stale value
+    """
+    def compute_value():
+        if prefix == 'count/Plot':
+            return filter.get_object_count(Plot)
+
+        class_name = prefix.split('/', 1)[1]
+        Clz = next(Clz for Clz in filter.instance.map_feature_classes
+                   if Clz.__name__ == class_name)
+        return Clz.benefits.benefits_for_filter(filter.instance, filter)
+
+    try:
+        key = _get_key(prefix, filter)
+        _compute_and_set(prefix, filter, key, compute_value)
+    finally:
+        cache.delete(lock_key)
+
+
+def set_cached_benefits(class_name, filter, value):
+    """
+    Replace the cached benefits for a class and filter, e.g. with the
+    exact value after an estimate was cached. Values computed on a cache
+    miss never replace one stored this way, whichever is written first.
+    """
+    if not settings.USE_ECO_CACHE:
+        return
+
+    prefix = 'eco/%s' % class_name
+    key = _get_key(prefix, filter)
+    _compute_and_set(prefix, filter, key, lambda: value, replace=True)
+
+
+def _count(stat):
+    with _stats_lock:
+        _stats[stat] += 1
+
+
+def eco_cache_stats():
+    """
+    Returns counts of cache hits, misses, waits on another process's
+    computation and stale values served, for this process
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
 def _get_key(prefix, filter):
     if filter and (filter.filterstr or filter.displaystr):
         # Example of why eco_rev is insufficient when a filter is active:
@@ -67,37 +193,138 @@ def _get_key(prefix, filter):
         # We are computing benefits for features other than trees
         version = filter.instance.universal_rev
 
-    filter_key = '%s/%s' % (filter.filterstr, filter.displaystr)
-    # Explicitly calling `encode()` ensures that the presence of a
-    # unicode symbol in the filter string will not raise a
-    # UnicodeEncodeError exception when calling `md5()`
-    filter_hash = hashlib.md5(filter_key.encode('utf-8')).hexdigest()
     key = "%s/%s/%s/%s" % (prefix,
                            filter.instance.url_name,
                            version,
-                           filter_hash)
+                           _get_filter_hash(filter))
     return key
 
 
+def _get_latest_key(prefix, filter):
+    return "%s/%s/latest/%s" % (prefix,
+                                filter.instance.url_name,
+                                _get_filter_hash(filter))
+
+
+def _get_filter_hash(filter):
+    filter_key = '%s/%s' % (filter.filterstr, filter.displaystr)
+    # Explicitly calling `encode()` ensures that the presence of a
+    # unicode symbol in the filter string will not raise a
+    # UnicodeEncodeError exception when calling `md5()`
+    return hashlib.md5(filter_key.encode('utf-8')).hexdigest()
+
+
+# ----------------------------------------------------------------
+# Cache the raw ecoservice benefits of single trees.
+#
+# A single tree's benefits depend only on its region, its species (the
+# species id is how the ecoservice finds i-Tree code overrides), its
+# i-Tree code and its diameter. Results are kept in a bounded in-process
+# LRU in front of a shared Redis layer.
+#
+# Tree key is eco/tree/<itree_code_override_rev>/<region>/<species_id>/
+#     <otm_code>/<diameter>
+#
+# Including the override rev means adding or removing an override busts
+# every entry. Currency conversion is applied to the values after they
+# come out of the cache, so BenefitCurrencyConversion changes need no
+# invalidation.
+
+_tree_benefits = OrderedDict()
+_tree_benefits_lock = threading.Lock()
+_tree_benefits_stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0}
+
+
+def get_cached_tree_benefits(region_code, species_id, otm_code, diameter,
+                             compute_value):
+    """
+    compute_value must return a (benefits, error) tuple. Errors are not
+    cached. The returned benefits are a copy which the caller may modify.
+    """
+    if not settings.USE_ECO_CACHE:
+        return compute_value()
+
+    key = 'eco/tree/%s/%s/%s/%s/%s' % (_get_override_rev(), region_code,
+                                       species_id, otm_code, diameter)
+
+    with _tree_benefits_lock:
+        value = _tree_benefits.pop(key, None)
+        if value is not None:
+            _tree_benefits[key] = value
+            _tree_benefits_stats['local_hits'] += 1
+            return copy.deepcopy(value), None
+
+    value = cache.get(key)
+    if value is None:
+        value, err = compute_value()
+        if err:
+            return value, err
+        cache.set(key, value, _TIMEOUT)
+        stat = 'misses'
+    else:
+        stat = 'shared_hits'
+
+    with _tree_benefits_lock:
+        _tree_benefits_stats[stat] += 1
+        _tree_benefits[key] = value
+        while len(_tree_benefits) > settings.ECO_TREE_CACHE_SIZE:
+            _tree_benefits.popitem(last=False)
+
+    return copy.deepcopy(value), None
+
+
+def tree_benefits_cache_stats():
+    with _tree_benefits_lock:
+        stats = dict(_tree_benefits_stats)
+        stats['size'] = len(_tree_benefits)
+
+    lookups = stats['local_hits'] + stats['shared_hits'] + stats['misses']
+    hits = stats['local_hits'] + stats['shared_hits']
+    stats['hit_rate'] = hits / lookups if lookups else 0.0
+    return stats
+
+
+def clear_tree_benefits_cache():
+    with _tree_benefits_lock:
+        _tree_benefits.clear()
+        for stat in _tree_benefits_stats:
+            _tree_benefits_stats[stat] = 0
+
+
 # ----------------------------------------------------------------
 # The ecoservice keeps a cache of i-Tree code overrides.
 # Store a cache buster in Redis, and keep a local copy.
 # If the local copy is stale, invalidate the cache of the local ecoservice.
+#
+# Reading the cache buster from Redis before every ecoservice call would
+# add a round trip to each benefit lookup, so each process remembers the
+# value it read for settings.ECO_OVERRIDE_REV_TTL seconds. A process that
+# changes an override sees the new value immediately; other processes see
+# it within the TTL.
 
 _ITREE_CODE_OVERRIDE_REV_KEY = 'itree_code_override_rev'
 my_itree_code_override_rev = None
 
+_override_rev = None
+_override_rev_expires_at = 0
+_override_rev_lock = threading.Lock()
+_override_rev_stats = {'checks': 0, 'shared_reads': 0, 'invalidations': 0}
+
 
 def _increment_itree_code_override_rev(*args, **kwargs):
     _init_if_needed()
-    cache.incr(_ITREE_CODE_OVERRIDE_REV_KEY)
+    rev = cache.incr(_ITREE_CODE_OVERRIDE_REV_KEY)
+    _remember_override_rev(rev)
 
 
 def invalidate_ecoservice_cache_if_stale():
     from treemap import ecobackend
     global my_itree_code_override_rev
 
-    cached_rev = _init_if_needed()
+    cached_rev = _get_override_rev()
+
+    with _override_rev_lock:
+        _override_rev_stats['checks'] += 1
 
     if my_itree_code_override_rev != cached_rev:
         __, err = ecobackend.json_benefits_call('invalidate_cache', {})
@@ -105,6 +332,39 @@ def invalidate_ecoservice_cache_if_stale():
             raise Exception('Failed to invalidate ecoservice cache')
         my_itree_code_override_rev = cached_rev
 
+        with _override_rev_lock:
+            _override_rev_stats['invalidations'] += 1
+
+
+def override_rev_stats():
+    """
+    Returns counts of ecoservice cache staleness checks, how many of them
+    read the cache buster from Redis and how many invalidations were
+    sent to the ecoservice, for this process
+    """
+    with _override_rev_lock:
+        return dict(_override_rev_stats)
+
+
+def _get_override_rev():
+    with _override_rev_lock:
+        if _override_rev is not None and \
+                time.time() < _override_rev_expires_at:
+            return _override_rev
+        _override_rev_stats['shared_reads'] += 1
+
+    rev = _init_if_needed()
+    _remember_override_rev(rev)
+    return rev
+
+
+def _remember_override_rev(rev):
+    global _override_rev, _override_rev_expires_at
+
+    with _override_rev_lock:
+        _override_rev = rev
+        _override_rev_expires_at = time.time() + settings.ECO_OVERRIDE_REV_TTL
+
 
 def _init_if_needed():
     global my_itree_code_override_rev
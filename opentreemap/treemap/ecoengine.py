@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import csv
+import json
+import os
+import re
+import threading
+
+from collections import defaultdict
+
+import numpy as np
+
+from django.conf import settings
+from django.db import connection
+
+from treemap.ecobackend import (BENEFIT_FACTORS as FACTORS,
+                                INVALID_ECO_PAIR, INCOMPLETE_ECO_DATA,
+                                UNKNOWN_ECO_FAILURE)
+from treemap.species.codes import get_itree_code
+
+# An in-process implementation of the ecoservice endpoints, used in place
+# of HTTP calls when settings.ECO_BACKEND is 'local'.
+#
+# The i-Tree lookup tables are read from settings.ITREE_DATA_DIR, which
+# can be the ecoservice's own data directory. The ecoservice keeps one CSV
+# file per region and factor, named output__<region_code>__<factor>.csv
+# (in any subdirectory), with a header row of the dbh breaks in cm and
+# then a row per i-Tree code:
+#
+#   itree_code,3.81,11.43,22.86,...
+#   BDL OTHER,<value at each dbh break>,...
+#
+# Regions can also be given as one JSON file each, named
+# <region_code>.json:
+#
+#   {
+#     "dbh_breaks_cm": [3.81, 11.43, 22.86, ...],
+#     "codes": {
+#       itree_code: {
+#         factor: [value at each dbh break, ...],
+#         ...
+#       }
+#     }
+#   }
+#
+# Benefits for a diameter between two breaks are linearly interpolated,
+# and diameters outside the breaks use the value at the nearest break.
+
+CM_PER_INCH = 2.54
+
+_CSV_NAME_RE = re.compile(r'^output__(.+)__([a-z0-9_]+)\.csv$')
+
+_SUMMARY_SQL = """
+    SELECT t.diameter, t.species_id, t.otm_code, COUNT(*)
+    FROM ({query}) AS t (diameter, species_id, otm_code)
+    GROUP BY t.diameter, t.species_id, t.otm_code
+"""
+
+_MULTI_REGION_SUMMARY_SQL = """
+    SELECT t.diameter, t.species_id, t.otm_code, r.code, COUNT(*)
+    FROM ({query}) AS t (diameter, species_id, otm_code, x, y)
+    JOIN treemap_itreeregion r
+      ON ST_Contains(r.geometry, ST_SetSRID(ST_MakePoint(t.x, t.y), 3857))
+    GROUP BY t.diameter, t.species_id, t.otm_code, r.code
+"""
+
+_lock = threading.Lock()
+_regions = None
+_overrides_by_instance = {}
+
+
+class _RegionData(object):
+    def __init__(self, data):
+        self.dbh_breaks = np.array(data['dbh_breaks_cm'], dtype=float)
+        # One row per factor, one column per dbh break
+        self.values_by_code = {
+            itree_code: np.array([values.get(factor,
+                                             [0.0] * len(self.dbh_breaks))
+                                  for factor in FACTORS], dtype=float)
+            for itree_code, values in data['codes'].iteritems()}
+
+    def values_at(self, itree_code, diameters):
+        """
+        Returns an array with one row per factor and one column per
+        diameter (in inches)
+        """
+        return self.values_at_cm(
+            itree_code, np.asarray(diameters, dtype=float) * CM_PER_INCH)
+
+    def values_at_cm(self, itree_code, diameters_cm):
+        """
+        Like values_at, for diameters in cm, as scenario trees have.
+        Diameters of zero or less (e.g. a tree not yet planted in a
+        scenario) have no benefits.
+        """
+        dbh = np.asarray(diameters_cm, dtype=float)
+        values = np.array([np.interp(dbh, self.dbh_breaks, row)
+                           for row in self.values_by_code[itree_code]])
+        return np.where(dbh > 0, values, 0.0)
+
+    def totals(self, itree_code, diameters, counts):
+        """
+        Returns an array of each factor summed over all diameters, where
+        each diameter is counted the given number of times
+        """
+        return self.values_at(itree_code, diameters).dot(
+            np.asarray(counts, dtype=float))
+
+
+def _load_regions():
+    global _regions
+    with _lock:
+        if _regions is None:
+            data_dir = settings.ITREE_DATA_DIR
+            if not data_dir:
+                raise Exception('ITREE_DATA_DIR must be set to use the '
+                                'local eco benefit engine')
+            regions = {}
+            region_tables = defaultdict(dict)
+            for dirpath, __, filenames in os.walk(data_dir):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    name, ext = os.path.splitext(filename)
+                    csv_match = _CSV_NAME_RE.match(filename)
+                    if csv_match:
+                        region_code, factor = csv_match.groups()
+                        if factor in FACTORS:
+                            region_tables[region_code][factor] = \
+                                _read_csv_table(path)
+                    elif ext == '.json':
+                        with open(path) as f:
+                            regions[name] = _RegionData(json.load(f))
+            for region_code, tables in region_tables.iteritems():
+                regions[region_code] = _RegionData(
+                    _region_data_from_tables(tables))
+            _regions = regions
+    return _regions
+
+
+def _read_csv_table(path):
+    """
+    Returns a (dbh breaks, {itree_code: values}) tuple for one of the
+    ecoservice's CSV files
+    """
+    with open(path, 'rb') as f:
+        rows = [row for row in csv.reader(f) if row]
+    header, rows = rows[0], rows[1:]
+    # The header may or may not have a cell above the i-Tree codes
+    if len(header) == len(rows[0]):
+        header = header[1:]
+    breaks = [float(value) for value in header]
+    return breaks, {row[0].strip(): [float(value) for value in row[1:]]
+                    for row in rows}
+
+
+def _region_data_from_tables(tables):
+    breaks = None
+    codes = defaultdict(dict)
+    for factor, (factor_breaks, values_by_code) in tables.iteritems():
+        if breaks is None:
+            breaks = factor_breaks
+        elif factor_breaks != breaks:
+            raise Exception('i-Tree tables for one region must share '
+                            'their dbh breaks')
+        for itree_code, values in values_by_code.iteritems():
+            codes[itree_code][factor] = values
+    return {'dbh_breaks_cm': breaks, 'codes': codes}
+
+
+def _overrides(instance_id):
+    from treemap.models import ITreeCodeOverride
+    instance_id = int(instance_id)
+    with _lock:
+        if instance_id not in _overrides_by_instance:
+            overrides = ITreeCodeOverride.objects \
+                .filter(instance_species__instance_id=instance_id) \
+                .values_list('instance_species_id', 'region__code',
+                             'itree_code')
+            _overrides_by_instance[instance_id] = {
+                (species_id, region_code): itree_code
+                for species_id, region_code, itree_code in overrides}
+        return _overrides_by_instance[instance_id]
+
+
+def _itree_code(instance_id, region_code, species_id, otm_code):
+    """
+    Returns an (itree_code, error) tuple, preferring an instance's
+    override for the species over the default code for its otm_code
+    """
+    itree_code = _overrides(instance_id).get((int(species_id), region_code))
+    if itree_code is None:
+        itree_code = get_itree_code(region_code, otm_code)
+    if itree_code is None:
+        return None, INVALID_ECO_PAIR
+
+    region = _load_regions().get(region_code)
+    if region is None or itree_code not in region.values_by_code:
+        return None, INCOMPLETE_ECO_DATA
+
+    return itree_code, None
+
+
+def _as_benefits(totals):
+    return dict(zip(FACTORS, (float(total) for total in totals)))
+
+
+def _eco(params):
+    region_code = params['region']
+    itree_code, err = _itree_code(params['instanceid'], region_code,
+                                  params['speciesid'], params['otmcode'])
+    if err:
+        return None, err
+
+    values = _load_regions()[region_code].values_at(
+        itree_code, [float(params['diameter'])])
+    return {'Benefits': _as_benefits(values[:, 0])}, None
+
+
+def _eco_summary(params):
+    instance_id = params['instance_id']
+    region_code = params['region']
+
+    with connection.cursor() as cursor:
+        # The query already has its parameters interpolated
+        if region_code:
+            cursor.execute(_SUMMARY_SQL.format(query=params['query']))
+            rows = [row[:3] + (region_code, row[3])
+                    for row in cursor.fetchall()]
+        else:
+            cursor.execute(
+                _MULTI_REGION_SUMMARY_SQL.format(query=params['query']))
+            rows = cursor.fetchall()
+
+    grouped = defaultdict(lambda: ([], []))
+    for diameter, species_id, otm_code, row_region_code, count in rows:
+        itree_code, err = _itree_code(instance_id, row_region_code,
+                                      species_id, otm_code)
+        if not err:
+            diameters, counts = grouped[(row_region_code, itree_code)]
+            diameters.append(diameter)
+            counts.append(count)
+
+    regions = _load_regions()
+    totals = np.zeros(len(FACTORS))
+    n_trees = 0
+    for (row_region_code, itree_code), (diameters, counts) in \
+            grouped.iteritems():
+        totals += regions[row_region_code].totals(
+            itree_code, diameters, counts)
+        n_trees += sum(counts)
+
+    benefits = _as_benefits(totals)
+    benefits['n_trees'] = n_trees
+    return {'Benefits': benefits}, None
+
+
+def _eco_scenario(params):
+    instance_id = params['instance_id']
+    n_years = int(params['years'])
+    regions = _load_regions()
+
+    yearly_totals = np.zeros((n_years, len(FACTORS)))
+    for tree in params['scenario_trees']:
+        region_code = tree['region']
+        itree_code, err = _itree_code(instance_id, region_code,
+                                      tree['species_id'], tree['otmcode'])
+        if err:
+            return None, err
+
+        # Scenario diameters are already in cm
+        diameters = tree['diameters'][:n_years]
+        if diameters:
+            values = regions[region_code].values_at_cm(itree_code, diameters)
+            yearly_totals[:len(diameters)] += values.T
+
+    return {'Total': _as_benefits(yearly_totals.sum(axis=0)),
+            'Years': [_as_benefits(totals) for totals in yearly_totals]}, None
+
+
+def _itree_codes(params):
+    codes = {region_code: sorted(region.values_by_code.keys())
+             for region_code, region in _load_regions().iteritems()}
+    return {'Codes': codes}, None
+
+
+def _invalidate_cache(params):
+    with _lock:
+        _overrides_by_instance.clear()
+    return None, None
+
+
+_ENDPOINTS = {
+    'eco.json': _eco,
+    'eco_summary.json': _eco_summary,
+    'eco_scenario.json': _eco_scenario,
+    'itree_codes.json': _itree_codes,
+    'invalidate_cache': _invalidate_cache,
+}
+
+
+def json_benefits_call(endpoint, params, post=False, convert_params=True):
+    """
+    Accepts the same arguments as ecobackend.json_benefits_call and
+    returns the same (result, error) tuple the ecoservice would
+    """
+    handler = _ENDPOINTS.get(endpoint)
+    if handler is None:
+        return None, UNKNOWN_ECO_FAILURE
+    return handler(dict(params))
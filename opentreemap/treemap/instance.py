@@ -253,6 +253,10 @@ class Instance(models.Model):
                                         null=True, blank=True)
     eco_rev = models.IntegerField(default=_DEFAULT_REV)
 
+    # The geo_rev as of the last hide_at_zoom recompute, so that unchanged
+    # instances can be skipped (see treemap/lib/hide_at_zoom.py)
+    hide_at_zoom_geo_rev = models.IntegerField(null=True, editable=False)
+
     eco_benefits_conversion = models.ForeignKey(
         'BenefitCurrencyConversion', null=True, blank=True)
 
@@ -619,6 +623,9 @@ class Instance(models.Model):
         for attr in attrs:
             setattr(self, attr, getattr(qs[0], attr))
 
+        from treemap.lib.ecocache_warming import schedule_eco_cache_warming
+        schedule_eco_cache_warming(self)
+
     def itree_regions(self, **extra_query):
         from treemap.models import ITreeRegion, ITreeRegionInMemory
 
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+
+from treemap.audit import Audit, AuditOutbox
+
+# The audit table is large and heavily indexed, so inserting audits
+# during every edit is slow. When settings.USE_AUDIT_OUTBOX is set, the
+# audits for direct writes are instead inserted into an unindexed outbox
+# table in the same transaction as the edit, and a Celery task later
+# moves them into the audit table in large batches.
+#
+# Because the outbox is written in the edit's transaction, no audits are
+# lost if the task is never run; `manage.py flush_audit_outbox` moves any
+# that are left over. Until they are moved, the audits don't appear in
+# edit histories or the recent edits lists.
+#
+# Audits for pending edits (requires_auth=True) are always written
+# directly, since they must be visible to reviewers right away. So are
+# Insert audits, since code that asks who created an object or which
+# trees a plot has had (e.g. Auditable.was_created_by, which lets users
+# delete their own creations) must see them as soon as the object
+# exists. Code that needs the latest audits for an object
+# (Auditable.hash and the check for whether a rejected edit is the most
+# recent one) also looks in the outbox.
+
+# Don't schedule more than one flush at a time
+_SCHEDULED_KEY = 'audit_outbox_flush_scheduled'
+_SCHEDULED_TIMEOUT = 60 * 5
+
+# Move the oldest rows, skipping any that a concurrent flush is moving.
+# The audits keep the time they were recorded rather than the time they
+# were moved.
+_MOVE_SQL = """
+    WITH moved AS (
+        DELETE FROM {outbox}
+        WHERE id IN (SELECT id FROM {outbox}
+                     ORDER BY id
+                     LIMIT %s
+                     FOR UPDATE SKIP LOCKED)
+        RETURNING id, model, model_id, instance_id, field, previous_value,
+                  current_value, user_id, action, created
+    )
+    INSERT INTO {audit} (model, model_id, instance_id, field,
+                         previous_value, current_value, user_id, action,
+                         requires_auth, created, updated)
+    SELECT model, model_id, instance_id, field, previous_value,
+           current_value, user_id, action, FALSE, created, created
+    FROM moved
+    ORDER BY id
+"""
+
+
+def write_audits(audits):
+    """
+    Saves the given unsaved audits, putting those for direct edits of
+    existing objects in the outbox if it is enabled
+    """
+    if not settings.USE_AUDIT_OUTBOX:
+        Audit.objects.bulk_create(audits)
+        return
+
+    def is_deferred(audit):
+        return not audit.requires_auth and audit.action != Audit.Type.Insert
+
+    immediate = [audit for audit in audits if not is_deferred(audit)]
+    direct = [AuditOutbox.from_audit(audit) for audit in audits
+              if is_deferred(audit)]
+
+    if immediate:
+        Audit.objects.bulk_create(immediate)
+    if direct:
+        AuditOutbox.objects.bulk_create(direct)
+        schedule_audit_outbox_flush()
+
+
+def schedule_audit_outbox_flush():
+    from treemap.tasks import flush_audit_outbox
+
+    # Only claim the key once the audits are committed, so that a rolled
+    # back transaction doesn't hold off the next flush
+    def schedule():
+        if cache.add(_SCHEDULED_KEY, True, _SCHEDULED_TIMEOUT):
+            flush_audit_outbox.delay()
+
+    transaction.on_commit(schedule)
+
+
+def flush_audit_outbox(batch_size=None):
+    """
+    Moves audits from the outbox into the audit table until the outbox is
+    empty. Returns the number of audits moved.
+    """
+    batch_size = batch_size or settings.AUDIT_OUTBOX_BATCH_SIZE
+
+    # Audits recorded from now on need another flush
+    cache.delete(_SCHEDULED_KEY)
+
+    sql = _MOVE_SQL.format(outbox=AuditOutbox._meta.db_table,
+                           audit=Audit._meta.db_table)
+    n_moved = 0
+    while True:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(sql, [batch_size])
+            n_batch = cursor.rowcount
+        n_moved += n_batch
+        if n_batch < batch_size:
+            return n_moved
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from django.core.cache import cache
+from django.db import connection, transaction
+
+from treemap.models import Boundary, MapFeatureBoundary
+
+# Keep a MapFeatureBoundary row for each map feature within each
+# boundary of its instance (Instance.boundaries), so IN_BOUNDARY searches
+# can select feature ids by boundary id rather than testing every
+# feature against a large multipolygon.
+#
+# A feature's rows are recomputed whenever it is created or moved. A
+# boundary's rows are recomputed by a Celery task whenever it is saved
+# or linked to or unlinked from an instance, and are only used for
+# searches once `members_indexed_at` has caught up with `updated_at`.
+# Boundaries loaded outside of Django have never been indexed, so the
+# first search on one schedules the task and uses the geometry until it
+# is done. Anonymous boundaries (drawn by users for a single search) are
+# never indexed.
+
+# Don't schedule indexing an unindexed boundary for every search on it
+_SCHEDULED_KEY = 'boundary_members_update_scheduled/%s'
+_SCHEDULED_TIMEOUT = 60 * 30
+
+_INSERT_FEATURE_SQL = """
+    INSERT INTO treemap_mapfeatureboundary (map_feature_id, boundary_id)
+    SELECT f.id, b.id
+    FROM treemap_mapfeature f
+    JOIN treemap_instance_boundaries ib
+      ON ib.instance_id = f.instance_id
+    JOIN treemap_boundary b
+      ON b.id = ib.boundary_id
+     AND ST_Within(f.the_geom_webmercator, b.the_geom_webmercator)
+    WHERE f.id = %s
+      AND NOT (b.name = '' AND b.category = '' AND NOT b.searchable)
+"""
+
+_INSERT_BOUNDARY_SQL = """
+    INSERT INTO treemap_mapfeatureboundary (map_feature_id, boundary_id)
+    SELECT f.id, b.id
+    FROM treemap_boundary b
+    JOIN treemap_instance_boundaries ib
+      ON ib.boundary_id = b.id
+    JOIN treemap_mapfeature f
+      ON f.instance_id = ib.instance_id
+     AND ST_Within(f.the_geom_webmercator, b.the_geom_webmercator)
+    WHERE b.id = %s
+"""
+
+
+def members_are_indexed(boundary):
+    return (boundary.members_indexed_at is not None and
+            boundary.members_indexed_at >= boundary.updated_at)
+
+
+def member_ids(boundary_id):
+    return MapFeatureBoundary.objects \
+        .filter(boundary_id=boundary_id) \
+        .values('map_feature_id')
+
+
+def update_feature_boundaries(map_feature):
+    MapFeatureBoundary.objects.filter(map_feature=map_feature).delete()
+    with connection.cursor() as cursor:
+        cursor.execute(_INSERT_FEATURE_SQL, [map_feature.pk])
+
+
+def schedule_boundary_members_update(boundary, debounce=False):
+    from treemap.tasks import update_boundary_members
+
+    if debounce and not cache.add(_SCHEDULED_KEY % boundary.pk, True,
+                                  _SCHEDULED_TIMEOUT):
+        return
+
+    transaction.on_commit(lambda: update_boundary_members.delay(boundary.pk))
+
+
+def invalidate_boundary_members(boundary_ids):
+    """
+    Stops searches using the members of the given boundaries, e.g. after
+    they were linked to another instance, until they are recomputed
+    """
+    from treemap.tasks import update_boundary_members
+
+    boundary_ids = list(boundary_ids)
+    Boundary.all_objects \
+        .filter(pk__in=boundary_ids) \
+        .update(members_indexed_at=None)
+
+    def schedule(boundary_id):
+        transaction.on_commit(
+            lambda: update_boundary_members.delay(boundary_id))
+
+    for boundary_id in boundary_ids:
+        schedule(boundary_id)
+
+
+@transaction.atomic
+def update_boundary_members(boundary):
+    indexed_as_of = boundary.updated_at
+
+    MapFeatureBoundary.objects.filter(boundary=boundary).delete()
+    with connection.cursor() as cursor:
+        cursor.execute(_INSERT_BOUNDARY_SQL, [boundary.pk])
+
+    # Use update() so that `updated_at` is unchanged
+    Boundary.all_objects \
+        .filter(pk=boundary.pk) \
+        .update(members_indexed_at=indexed_as_of)
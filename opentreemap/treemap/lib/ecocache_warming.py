@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import json
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.timezone import now
+
+from opentreemap.util import add_rollbar_handler
+
+from treemap.ecobenefits import get_benefits_for_filter
+from treemap.ecocache import get_cached_plot_count
+from treemap.models import EcoCacheWarming
+from treemap.search import Filter
+
+logger = logging.getLogger(__name__)
+add_rollbar_handler(logger, level=logging.INFO)
+
+# After an instance's revs change, precompute the eco summaries and plot
+# counts that visitors are most likely to ask for next: the unfiltered
+# map and a search within each of the instance's boundaries.
+#
+# Rev bumps tend to come in bursts (e.g. while an import commits), so a
+# run is scheduled settings.ECO_CACHE_WARMING_DELAY seconds after the
+# first bump, and further bumps before then don't schedule another.
+
+_SCHEDULED_KEY = 'ecocache_warming_scheduled/%s'
+
+
+def schedule_eco_cache_warming(instance):
+    from treemap.tasks import warm_eco_cache as warm_eco_cache_task
+
+    delay = settings.ECO_CACHE_WARMING_DELAY
+    if not settings.USE_ECO_CACHE or delay is None:
+        return
+
+    # Only claim the key once the change is committed, so that a rolled
+    # back transaction doesn't hold off warming for the whole delay
+    def schedule():
+        if cache.add(_SCHEDULED_KEY % instance.pk, True, delay):
+            warm_eco_cache_task.apply_async((instance.pk,), countdown=delay)
+
+    transaction.on_commit(schedule)
+
+
+def filters_to_warm(instance):
+    yield Filter('', '', instance)
+
+    boundaries = instance.boundaries \
+        .filter(searchable=True) \
+        .order_by('sort_order', 'name')
+    for boundary_id in boundaries.values_list('pk', flat=True):
+        # Match the browser's JSON.stringify output. The map page reads
+        # the boundary id from a hidden input, so it is a string.
+        filterstr = json.dumps({'mapFeature.geom': {'IN_BOUNDARY':
+                                                    str(boundary_id)}},
+                               separators=(',', ':'))
+        yield Filter(filterstr, '', instance)
+
+
+def warm_eco_cache(instance):
+    cache.delete(_SCHEDULED_KEY % instance.pk)
+
+    status, __ = EcoCacheWarming.objects.get_or_create(instance=instance)
+    status.started_at = now()
+    status.finished_at = None
+    status.geo_rev = instance.geo_rev
+    status.eco_rev = instance.eco_rev
+    status.universal_rev = instance.universal_rev
+    status.n_filters = 0
+    status.n_errors = 0
+    status.save()
+
+    for filter in filters_to_warm(instance):
+        try:
+            get_cached_plot_count(filter)
+            get_benefits_for_filter(filter)
+        except Exception:
+            logger.exception('Failed to warm eco cache for %s with filter %s'
+                             % (instance.url_name, filter.filterstr))
+            status.n_errors += 1
+        status.n_filters += 1
+
+    status.finished_at = now()
+    status.save()
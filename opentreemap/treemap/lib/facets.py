@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from django.contrib.postgres.fields.hstore import KeyTransform
+from django.db.models import Count, F, Func, IntegerField
+
+from treemap.ecocache import get_cached_facet
+from treemap.lib.object_caches import udf_defs
+from treemap.models import MapFeatureBoundary, Plot
+
+# Counts of the plots and trees matching a search, broken down by species,
+# diameter class, boundary or the value of a choice UDF.
+#
+# Each facet is one GROUP BY over the plots returned by
+# Filter.get_objects, and is cached in the eco cache under the
+# instance's universal rev, like other search results.
+#
+# Boundary counts use the boundary membership index (see
+# treemap/lib/boundary_membership.py), so boundaries which have not been
+# indexed yet are left out. Only the instance's own boundaries are
+# counted.
+
+DIAMETER_CLASS_WIDTH = 6  # inches
+
+STANDARD_FACETS = ('species', 'diameter', 'boundary')
+
+
+class FacetError(Exception):
+    def __init__(self, message):
+        super(FacetError, self).__init__(message)
+        self.message = message
+
+
+def facet_counts(filter, facet_names):
+    """
+    Returns a dict mapping each of the given facet names to a list of
+    dicts with a 'count' and the values that were counted. Facet names are
+    those in STANDARD_FACETS or the identifier of a choice UDF on plots or
+    trees, e.g. 'tree.udf:Condition'.
+
+    Raises FacetError for an unknown facet name.
+    """
+    computers = [(name, _facet_computer(filter.instance, name))
+                 for name in facet_names]
+
+    counts = {}
+    for name, (cache_name, compute) in computers:
+        counts[name] = get_cached_facet(
+            cache_name, filter,
+            lambda: compute(filter.get_objects(Plot)))
+    return counts
+
+
+def _facet_computer(instance, name):
+    """
+    Returns a (cache name, compute function) tuple for a facet, where the
+    compute function takes a plot queryset
+    """
+    if name == 'species':
+        return name, _species_counts
+    elif name == 'diameter':
+        return name, _diameter_counts
+    elif name == 'boundary':
+        return name, lambda plots: _boundary_counts(instance, plots)
+
+    udfd = next((udfd for udfd in udf_defs(instance)
+                 if udfd.full_name == name
+                 and udfd.model_type in ('Plot', 'Tree')
+                 and not udfd.iscollection
+                 and udfd.datatype_dict['type'] == 'choice'), None)
+    if udfd is None:
+        raise FacetError('Unknown facet "%s"' % name)
+
+    field = 'udfs' if udfd.model_type == 'Plot' else 'tree__udfs'
+    return ('udf/%s' % udfd.pk,
+            lambda plots: _udf_counts(plots, udfd.name, field))
+
+
+def _species_counts(plots):
+    rows = plots \
+        .filter(tree__species__isnull=False) \
+        .values('tree__species_id', 'tree__species__common_name') \
+        .annotate(count=Count('tree')) \
+        .order_by('-count', 'tree__species__common_name')
+
+    return [{'id': row['tree__species_id'],
+             'name': row['tree__species__common_name'],
+             'count': row['count']}
+            for row in rows]
+
+
+def _diameter_counts(plots):
+    rows = plots \
+        .filter(tree__diameter__isnull=False) \
+        .annotate(diameter_class=Func(
+            F('tree__diameter') / DIAMETER_CLASS_WIDTH, function='FLOOR',
+            output_field=IntegerField())) \
+        .values('diameter_class') \
+        .annotate(count=Count('tree')) \
+        .order_by('diameter_class')
+
+    return [{'min': int(row['diameter_class']) * DIAMETER_CLASS_WIDTH,
+             'max': (int(row['diameter_class']) + 1) * DIAMETER_CLASS_WIDTH,
+             'count': row['count']}
+            for row in rows]
+
+
+def _boundary_counts(instance, plots):
+    rows = MapFeatureBoundary.objects \
+        .filter(map_feature__in=plots.values('pk'),
+                boundary__in=instance.boundaries.all(),
+                boundary__searchable=True) \
+        .values('boundary_id', 'boundary__name', 'boundary__category') \
+        .annotate(count=Count('map_feature')) \
+        .order_by('boundary__category', 'boundary__name')
+
+    return [{'id': row['boundary_id'],
+             'name': row['boundary__name'],
+             'category': row['boundary__category'],
+             'count': row['count']}
+            for row in rows]
+
+
+def _udf_counts(plots, udf_name, field):
+    rows = plots \
+        .annotate(value=KeyTransform(udf_name, field)) \
+        .filter(value__isnull=False) \
+        .values('value') \
+        .annotate(count=Count('pk')) \
+        .order_by('-count', 'value')
+
+    return [{'value': row['value'], 'count': row['count']} for row in rows]
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from math import floor
+
+from django.contrib.gis.geos import Point, Polygon
+from django.db.models import Count, F, Func, IntegerField, Value
+
+from treemap.lib.hide_at_zoom import GRID_PIXELS, MAX_ZOOM, get_grid_size_wm
+from treemap.models import Plot
+from treemap.search import Filter
+
+# Counts of plots (and optionally trees and species) per cell of a screen
+# grid, so that zoomed-out maps of large instances can draw a few hundred
+# aggregates instead of every plot.
+#
+# Every map feature stores the cell it falls in on the finest hide_at_zoom
+# grid (GRID_PIXELS at MAX_ZOOM) as MapFeature.grid_x and grid_y. Cell
+# sizes double with each zoom level out, so the cell containing a feature
+# on a grid of 2^k times the size is just (grid_x >> k, grid_y >> k), and
+# counting needs no geometry functions.
+
+BASE_GRID_SIZE_WM = get_grid_size_wm(GRID_PIXELS, MAX_ZOOM)
+
+DEFAULT_CELL_PIXELS = 64
+MAX_CELL_PIXELS = 256
+
+
+def grid_cell(point):
+    """
+    Returns the (grid_x, grid_y) of the finest grid cell containing a web
+    mercator point
+    """
+    return (int(floor(point.x / BASE_GRID_SIZE_WM)),
+            int(floor(point.y / BASE_GRID_SIZE_WM)))
+
+
+def is_valid_grid(zoom, cell_pixels):
+    """
+    Grid cells must be a power of two multiple of the finest cells
+    """
+    if not (0 <= zoom <= MAX_ZOOM and
+            GRID_PIXELS <= cell_pixels <= MAX_CELL_PIXELS):
+        return False
+    ratio = cell_pixels // GRID_PIXELS
+    return ratio * GRID_PIXELS == cell_pixels and ratio & (ratio - 1) == 0
+
+
+def grid_counts(instance, filterstr, displaystr, bbox, zoom,
+                cell_pixels=DEFAULT_CELL_PIXELS, include_trees=False):
+    """
+    Returns a list with a dict for each grid cell in the bounding box
+    (xmin, ymin, xmax, ymax in lat/lng) which contains plots matching the
+    search. Each dict has the lng/lat of the cell's center and its number
+    of plots. With include_trees, it also has the number of trees and of
+    distinct species.
+    """
+    shift = (MAX_ZOOM - zoom) + (cell_pixels // GRID_PIXELS).bit_length() - 1
+    cell_size = BASE_GRID_SIZE_WM * 2 ** shift
+
+    area = Polygon.from_bbox(bbox)
+    area.srid = 4326
+    area.transform(3857)
+
+    if filterstr or displaystr:
+        plots = Filter(filterstr, displaystr, instance).get_objects(Plot)
+    else:
+        plots = Plot.objects.filter(instance=instance)
+
+    aggregates = {'n_plots': Count('pk', distinct=True)}
+    if include_trees:
+        aggregates['n_trees'] = Count('tree', distinct=True)
+        aggregates['n_species'] = Count('tree__species', distinct=True)
+
+    rows = plots \
+        .filter(geom__bboverlaps=area, grid_x__isnull=False) \
+        .annotate(cell_x=_shifted(F('grid_x'), shift),
+                  cell_y=_shifted(F('grid_y'), shift)) \
+        .values('cell_x', 'cell_y') \
+        .annotate(**aggregates) \
+        .order_by('cell_x', 'cell_y')
+
+    cells = []
+    for row in rows:
+        center = Point((row.pop('cell_x') + 0.5) * cell_size,
+                       (row.pop('cell_y') + 0.5) * cell_size, srid=3857)
+        center.transform(4326)
+        row['lng'] = center.x
+        row['lat'] = center.y
+        cells.append(row)
+    return cells
+
+
+def _shifted(expression, shift):
+    return Func(expression, Value(shift), arg_joiner=' >> ',
+                template='(%(expressions)s)', output_field=IntegerField())
@@ -3,16 +3,28 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 
+import logging
+import threading
+import time
+from contextlib import contextmanager
 from math import floor
 
+from django.conf import settings
 from django.db import connection
+from django.db.models import Count, Q
 
+from treemap.instance import Instance
 from treemap.models import MapFeature
 
 GRID_PIXELS = 2
 MAX_ZOOM = 14
 MIN_ZOOM = 0
 
+# Instances with fewer features aren't worth recomputing
+MIN_FEATURE_COUNT = 100
+
+logger = logging.getLogger(__name__)
+
 # When viewing a zoomed-out tree map, multiple plots in a local area are
 # rendered on top of one another. We set MapFeature.hide_at_zoom so the tiler
 # can render just one plot in such cases, speeding up tile creation for maps
@@ -20,44 +32,162 @@ MIN_ZOOM = 0
 #
 # At each zoom level Z we find groups of plots located in the same cell of
 # a grid (cell size GRID_PIXELS), and set hide_at_zoom = Z for all but one
-# plot in each group.
+# plot in each group. A plot hidden at zoom Z is also hidden at all lower
+# zooms.
 #
 # A larger cell size gives more speedup, but if it's too large the tree dots
 # start showing the grid pattern. GRID_PIXELS = 2 is the sweet spot for our
 # current tree dot size of 5 pixels.
 
 
-def recompute_hide_at_zoom(instance, verbose=False):
-    # TODO: skip if geo_rev hasn't changed
+def recompute_hide_at_zoom(instance, verbose=False, force=False):
+    """
+    Returns True if hide_at_zoom was recomputed, or False if the instance's
+    geo_rev hasn't changed since the last recompute.
+
+    Saving a map feature doesn't bump geo_rev by itself; every code path
+    that adds, moves or deletes features must call
+    instance.update_revs('geo_rev', ...) afterwards (as the map feature
+    views, importer and management commands do), or pass force=True here.
+    """
     if verbose:
         print('\nUpdating instance %s' % instance.url_name)
 
-    MapFeature.objects.all() \
-        .filter(instance=instance) \
-        .update(hide_at_zoom=None)
+    if not force and instance.hide_at_zoom_geo_rev == instance.geo_rev:
+        if verbose:
+            print('Skipping, geo_rev unchanged')
+        return False
 
-    _print_summary(instance, MAX_ZOOM + 1, verbose)
-    for zoom in range(MAX_ZOOM, MIN_ZOOM - 1, -1):
-        grid_size_wm = _get_grid_size_wm(GRID_PIXELS, zoom)
-        with connection.cursor() as cursor:
-            cursor.execute(_SQL_RECOMPUTE, {
-                'instance_id': instance.id,
-                'grid_size': grid_size_wm,
-                'zoom': zoom
-            })
+    geo_rev = instance.geo_rev
+
+    with connection.cursor() as cursor:
+        cursor.execute(_SQL_RECOMPUTE, {
+            'instance_id': instance.id,
+            'grid_size': get_grid_size_wm(GRID_PIXELS, MAX_ZOOM),
+            'max_zoom': MAX_ZOOM,
+            'min_zoom': MIN_ZOOM,
+        })
+        n_changed = cursor.rowcount
+
+    if verbose:
+        print('%s features changed' % n_changed)
+    for zoom in range(MAX_ZOOM + 1, MIN_ZOOM - 1, -1):
         _print_summary(instance, zoom, verbose)
 
-    instance.update_geo_rev()
+    if n_changed:
+        instance.update_geo_rev()
+        geo_rev += 1
+
+    # If something else changed the geo_rev meanwhile, we can't be sure we
+    # saw its changes, so leave the instance to be recomputed next time
+    Instance.objects.filter(pk=instance.pk) \
+        .update(hide_at_zoom_geo_rev=geo_rev)
+    instance.hide_at_zoom_geo_rev = geo_rev
+
+    return True
+
+
+def timed_recompute_hide_at_zoom(instance, force=False, verbose=False):
+    """
+    Recomputes hide_at_zoom and returns a report of how long it took
+    """
+    start = time.time()
+    recomputed = recompute_hide_at_zoom(instance, verbose, force)
+    report = {'instance': instance.url_name,
+              'recomputed': recomputed,
+              'seconds': round(time.time() - start, 3)}
+    logger.info('hide_at_zoom for %(instance)s: recomputed=%(recomputed)s '
+                'in %(seconds)ss' % report)
+    return report
+
+
+def recompute_hide_at_zoom_or_report_error(instance_id, force=False):
+    """
+    Like timed_recompute_hide_at_zoom, but takes an instance id and
+    reports an error instead of raising it, so that one failing instance
+    doesn't stop the rest of a Celery recompute chain
+    """
+    start = time.time()
+    instance_name = instance_id
+    try:
+        instance = Instance.objects.get(pk=instance_id)
+        instance_name = instance.url_name
+        return timed_recompute_hide_at_zoom(instance, force)
+    except Exception as e:
+        logger.exception('hide_at_zoom recompute failed for %s'
+                         % instance_name)
+        return {'instance': instance_name,
+                'recomputed': False,
+                'seconds': round(time.time() - start, 3),
+                'error': repr(e)}
+
+
+def instances_to_recompute():
+    """
+    Returns the ids of instances with enough features to be worth
+    recomputing, largest first
+    """
+    return MapFeature.objects \
+        .values('instance_id') \
+        .annotate(n=Count('instance_id')) \
+        .filter(n__gt=MIN_FEATURE_COUNT) \
+        .order_by('-n') \
+        .values_list('instance_id', flat=True)
+
+
+def schedule_hide_at_zoom_recompute(instance_ids, force=False,
+                                    concurrency=None):
+    """
+    Recompute hide_at_zoom for the given instances in Celery tasks, with at
+    most `concurrency` running at once. Instances are dealt round-robin to
+    that many chains of tasks, so passing them largest first balances the
+    chains. When all chains finish, a report of each recompute is logged.
+    """
+    from celery import chain, chord
+    from treemap.tasks import (recompute_hide_at_zoom as recompute_task,
+                               report_hide_at_zoom_recompute)
+
+    concurrency = concurrency or settings.HIDE_AT_ZOOM_RECOMPUTE_CONCURRENCY
+    lanes = [instance_ids[i::concurrency] for i in range(concurrency)]
+
+    # Each task appends its report to those of the tasks before it. Tasks
+    # report errors rather than raising them, since a failed task would
+    # stop the rest of its chain and the chord's report.
+    chains = [chain(recompute_task.s([], lane[0], force),
+                    *[recompute_task.s(instance_id, force)
+                      for instance_id in lane[1:]])
+              for lane in lanes if lane]
+
+    if chains:
+        return chord(chains, report_hide_at_zoom_recompute.s()).delay()
+
+
+def log_recompute_reports(reports):
+    reports = sorted(reports, key=lambda report: -report['seconds'])
+    n_recomputed = sum(1 for report in reports if report['recomputed'])
+    n_failed = sum(1 for report in reports if 'error' in report)
+    logger.info('Recomputed hide_at_zoom for %d of %d instances in %ss, '
+                '%d failed' % (
+                    n_recomputed, len(reports),
+                    sum(report['seconds'] for report in reports), n_failed))
+    for report in reports:
+        if 'error' in report:
+            logger.error('  %(instance)s: failed in %(seconds)ss: '
+                         '%(error)s' % report)
+        else:
+            logger.info('  %(instance)s: recomputed=%(recomputed)s in '
+                        '%(seconds)ss' % report)
 
 
 def _print_summary(instance, zoom, verbose):
     if verbose:
-        features = MapFeature.objects.filter(instance=instance,
-                                             hide_at_zoom=None)
+        features = MapFeature.objects \
+            .filter(instance=instance) \
+            .filter(Q(hide_at_zoom__isnull=True) | Q(hide_at_zoom__lt=zoom))
         print("{1:>2}  {0:>7}".format(features.count(), zoom))
 
 
-def _get_grid_size_wm(grid_pixels, zoom):
+def get_grid_size_wm(grid_pixels, zoom):
     wm_world_width = 40075016.6856
     tile_size = 256
     wm_units_per_pixel = wm_world_width / (tile_size * pow(2, zoom))
@@ -68,37 +198,150 @@ def _get_grid_size_wm(grid_pixels, zoom):
 # Notes:
 # 1) Ignore non-plots. They aren't numerous, and it simplifies
 #    both the tiler and opt-out of green infrastructure types.
-# 2) Not using ST_SnapToGrid because results were not consistent across runs.
+# 2) Grid cells nest: each cell at zoom Z is made of four cells at zoom
+#    Z + 1, and a plot's cell at zoom Z is its stored MAX_ZOOM grid cell
+#    (see treemap/lib/grid_counts.py) shifted right by MAX_ZOOM - Z.
+# 3) The plot kept in each cell is the one with the lowest id. The plot with
+#    the lowest id in a cell also has the lowest id in its smaller cell at
+#    every higher zoom, so a plot shown at one zoom is shown at all higher
+#    zooms. A plot's hide_at_zoom is therefore one less than the lowest zoom
+#    at which it is kept, and all zooms are computed in a single pass.
+# 4) Only rows whose hide_at_zoom changes are written.
 
 _SQL_RECOMPUTE = """
-    WITH featuresToHide AS (
-        WITH mapfeature AS (
-            /* Get all plots in instance with hide_at_zoom not set */
-             SELECT f.id, f.the_geom_webmercator
-             FROM treemap_mapfeature f
-             INNER JOIN treemap_instance i ON f.instance_id=i.id
-             WHERE i.id=%(instance_id)s
-               AND f.feature_type='Plot'
-               AND f.hide_at_zoom IS NULL
+    WITH cells AS (
+        SELECT f.id, f.feature_type,
+               COALESCE(f.grid_x, floor(ST_X(f.the_geom_webmercator)
+                                        / %(grid_size)s)::integer) AS x,
+               COALESCE(f.grid_y, floor(ST_Y(f.the_geom_webmercator)
+                                        / %(grid_size)s)::integer) AS y
+        FROM treemap_mapfeature f
+        WHERE f.instance_id = %(instance_id)s
+    ),
+    /* The plot kept in each cell at each zoom */
+    kept AS (
+        SELECT MIN(c.id) AS id, z.zoom
+        FROM cells c
+        CROSS JOIN generate_series(%(min_zoom)s, %(max_zoom)s) AS z (zoom)
+        WHERE c.feature_type = 'Plot'
+        GROUP BY z.zoom,
+                 c.x >> (%(max_zoom)s - z.zoom),
+                 c.y >> (%(max_zoom)s - z.zoom)
+    ),
+    first_kept AS (
+        SELECT id, MIN(zoom) AS zoom
+        FROM kept
+        GROUP BY id
+    ),
+    computed AS (
+        SELECT c.id,
+               CASE WHEN c.feature_type <> 'Plot' THEN NULL
+                    WHEN k.zoom IS NULL THEN %(max_zoom)s
+                    WHEN k.zoom = %(min_zoom)s THEN NULL
+                    ELSE k.zoom - 1
+               END AS hide_at_zoom
+        FROM cells c
+        LEFT JOIN first_kept k ON k.id = c.id
+    )
+    UPDATE treemap_mapfeature f
+    SET hide_at_zoom = computed.hide_at_zoom
+    FROM computed
+    WHERE f.id = computed.id
+      AND f.hide_at_zoom IS DISTINCT FROM computed.hide_at_zoom;
+    """
+
+
+# New plots are hidden at every zoom at which their grid cell already has a
+# visible plot (or, among plots added together, a plot with a lower id),
+# so that maps stay fast between recomputes. Plots created inside a
+# batch_new_plots() block are assigned together when the block exits.
+
+_batch = threading.local()
+
+
+@contextmanager
+def batch_new_plots():
+    if getattr(_batch, 'plot_ids', None) is not None:
+        # Already batching
+        yield
+        return
+
+    _batch.plot_ids = []
+    try:
+        yield
+        plot_ids = _batch.plot_ids
+    finally:
+        _batch.plot_ids = None
+
+    if plot_ids:
+        _hide_new_plots(plot_ids)
+
+
+def update_hide_at_zoom_after_add(feature):
+    if feature.feature_type == 'Plot':
+        if getattr(_batch, 'plot_ids', None) is not None:
+            _batch.plot_ids.append(feature.pk)
+        else:
+            hide_at_zoom = _hide_new_plots([feature.pk])
+            feature.hide_at_zoom = hide_at_zoom.get(feature.pk)
+
+
+def _hide_new_plots(plot_ids):
+    """
+    Returns a dict mapping the ids of the plots whose hide_at_zoom was set
+    to their new hide_at_zoom
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(_SQL_HIDE_NEW_PLOTS, {
+            'ids': plot_ids,
+            'grid_size': get_grid_size_wm(GRID_PIXELS, MAX_ZOOM),
+            'max_zoom': MAX_ZOOM,
+            'min_zoom': MIN_ZOOM,
+        })
+        return dict(cursor.fetchall())
+
+
+# The bounding box test lets the spatial index find the plots in each cell
+_SQL_HIDE_NEW_PLOTS = """
+    WITH new_plots AS (
+        SELECT id, instance_id, grid_x AS x, grid_y AS y
+        FROM treemap_mapfeature
+        WHERE id = ANY(%(ids)s)
+          AND feature_type = 'Plot'
+    ),
+    hidden AS (
+        SELECT n.id, MAX(z.zoom) AS zoom
+        FROM new_plots n
+        CROSS JOIN generate_series(%(min_zoom)s, %(max_zoom)s) AS z (zoom)
+        CROSS JOIN LATERAL (SELECT %(max_zoom)s - z.zoom AS shift) s
+        WHERE EXISTS (
+            SELECT 1
+            FROM treemap_mapfeature f
+            WHERE f.instance_id = n.instance_id
+              AND f.feature_type = 'Plot'
+              AND f.id <> n.id
+              AND f.the_geom_webmercator && ST_MakeEnvelope(
+                  ((n.x >> s.shift) << s.shift) * %(grid_size)s,
+                  ((n.y >> s.shift) << s.shift) * %(grid_size)s,
+                  (((n.x >> s.shift) + 1) << s.shift) * %(grid_size)s,
+                  (((n.y >> s.shift) + 1) << s.shift) * %(grid_size)s,
+                  3857)
+              AND f.grid_x >> s.shift = n.x >> s.shift
+              AND f.grid_y >> s.shift = n.y >> s.shift
+              AND CASE WHEN f.id = ANY(%(ids)s) THEN f.id < n.id
+                       ELSE f.hide_at_zoom IS NULL
+                            OR f.hide_at_zoom < z.zoom
+                  END
         )
-        SELECT mapfeature.id FROM mapfeature
-        LEFT OUTER JOIN
-            /* Choose one feature from each grid cell */
-            (SELECT DISTINCT ON (geom)
-                id,
-                ST_MakePoint(floor(ST_X(the_geom_webmercator) / %(grid_size)s),
-                             floor(ST_Y(the_geom_webmercator) / %(grid_size)s))
-                    AS geom
-              FROM mapfeature
-            ) AS distinctRows
-            ON mapfeature.id = distinctRows.id
-        /* Now get the features NOT chosen */
-        WHERE distinctRows.id IS NULL
+        GROUP BY n.id
     )
     UPDATE treemap_mapfeature f
-    SET hide_at_zoom = %(zoom)s
-    FROM featuresToHide
-    WHERE f.id = featuresToHide.id;
+    SET hide_at_zoom = hidden.zoom
+    FROM new_plots n
+    LEFT JOIN hidden ON hidden.id = n.id
+    WHERE f.id = n.id
+      AND f.hide_at_zoom IS DISTINCT FROM hidden.zoom
+    RETURNING f.id, f.hide_at_zoom;
     """
 
 
@@ -127,7 +370,7 @@ def _reveal_a_hidden_plot(instance, point, hide_at_zoom):
     min_zoom = MIN_ZOOM - 1 if hide_at_zoom is None else hide_at_zoom
 
     for zoom in range(MAX_ZOOM, min_zoom, -1):
-        grid_size_wm = _get_grid_size_wm(GRID_PIXELS, zoom)
+        grid_size_wm = get_grid_size_wm(GRID_PIXELS, zoom)
         # Plot that disappeared was visible at this zoom level.
         # Reveal a hidden plot if there's one in this cell.
         with connection.cursor() as cursor:
@@ -80,12 +80,15 @@ def _map_feature_audits(user, instance, feature, filters=None,
     return audits
 
 
-def _add_eco_benefits_to_context_dict(instance, feature, context):
+def _add_eco_benefits_to_context_dict(instance, feature, context,
+                                      eco_benefits=None):
     FeatureClass = feature.__class__
 
-    benefits, basis, failure_code = FeatureClass.benefits\
-                                                .benefits_for_object(
-                                                    instance, feature)
+    if eco_benefits is None:
+        eco_benefits = FeatureClass.benefits.benefits_for_object(
+            instance, feature)
+
+    benefits, basis, failure_code = eco_benefits
 
     if failure_code in ECOBENEFIT_FAILURE_CODES_AND_PATTERNS:
         context[failure_code] = True
@@ -369,7 +372,13 @@ def context_dict_for_resource(request, resource, **kwargs):
     return context
 
 
-def context_dict_for_map_feature(request, feature, edit=False):
+def context_dict_for_map_feature(request, feature, edit=False,
+                                 eco_benefits=None):
+    """
+    eco_benefits may be passed as the result of the feature's
+    benefits_for_object call when it has already been computed as part
+    of a batch (see BenefitCalculator.benefits_for_objects)
+    """
     context = {}
 
     if edit:
@@ -413,7 +422,8 @@ def context_dict_for_map_feature(request, feature, edit=False):
         'photo_upload_share_text': _photo_upload_share_text(feature),
     })
 
-    _add_eco_benefits_to_context_dict(instance, feature, context)
+    _add_eco_benefits_to_context_dict(instance, feature, context,
+                                      eco_benefits)
 
     return context
 
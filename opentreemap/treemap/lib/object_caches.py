@@ -48,6 +48,17 @@ def udf_defs(instance, model_name=None):
         return _udf_defs_from_db(instance, model_name)
 
 
+def reputation_metrics(instance):
+    """
+    Returns a dict of the instance's ReputationMetrics, keyed by
+    (model_name, action)
+    """
+    if settings.USE_OBJECT_CACHES:
+        return _get_adjuncts(instance).reputation_metrics()
+    else:
+        return _reputation_metrics_from_db(instance)
+
+
 def clear_caches():
     global _adjuncts
     _adjuncts = {}
@@ -100,6 +111,12 @@ def _udf_defs_from_db(instance, model_name):
         defs = defs.filter(model_type=model_name)
     return list(defs)
 
+
+def _reputation_metrics_from_db(instance):
+    from treemap.audit import ReputationMetric
+    return {(rm.model_name, rm.action): rm
+            for rm in ReputationMetric.objects.filter(instance=instance)}
+
 # ------------------------------------------------------------------------
 # Fetch info from cache
 
@@ -118,6 +135,7 @@ class _InstanceAdjuncts:
         self._user_role_ids = {}
         self._permissions = {}
         self._udf_defs = {}
+        self._reputation_metrics = None
         self.timestamp = instance.adjuncts_timestamp
 
     def permissions(self, user, model_name):
@@ -139,6 +157,14 @@ class _InstanceAdjuncts:
             self._load_udf_defs()
         return self._udf_defs.get(model_name, [])
 
+    def reputation_metrics(self):
+        # An instance may have no metrics at all, so use None (rather than
+        # an empty dict) to mean "not loaded"
+        if self._reputation_metrics is None:
+            self._reputation_metrics = \
+                _reputation_metrics_from_db(self._instance)
+        return self._reputation_metrics
+
     def _load_roles(self):
         from treemap.models import InstanceUser
 
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from treemap.models import SearchResultSet
+
+# Store the ids of the objects matching a search filter in a
+# SearchResultSet row, computed by a single INSERT ... SELECT, and have
+# later querysets for the same filter and universal_rev select from that
+# row rather than evaluating the filter's spatial and UDF predicates
+# again.
+#
+# Storing a set costs an INSERT ... SELECT, so a set is only stored the
+# second time its filter is searched for at the same rev.
+#
+# New querysets are never built on sets for older revs, but querysets
+# built before the rev changed (in concurrent requests, export tasks and
+# eco summary threads) may still be evaluated. So a periodic task marks
+# sets for older revs as superseded, and only deletes them once they have
+# been superseded for SEARCH_RESULT_SET_GRACE_PERIOD seconds.
+
+_INSERT_SQL = """
+    INSERT INTO treemap_searchresultset
+        (instance_id, model_name, universal_rev, filter_hash, ids,
+         created_at)
+    SELECT %s, %s, %s, %s,
+           COALESCE(array_agg(DISTINCT t.id ORDER BY t.id), '{{}}'), now()
+    FROM ({query}) AS t (id)
+    ON CONFLICT (instance_id, model_name, universal_rev, filter_hash)
+        DO NOTHING
+    RETURNING id
+"""
+
+_IDS_SQL = 'SELECT unnest(ids) FROM treemap_searchresultset WHERE id = %s'
+
+_SEEN_KEY = 'search_result_set_seen/%s/%s/%s/%s'
+_SEEN_TIMEOUT = 60 * 60
+
+_MARK_SUPERSEDED_SQL = """
+    UPDATE treemap_searchresultset s
+    SET superseded_at = now()
+    FROM treemap_instance i
+    WHERE s.instance_id = i.id
+      AND s.universal_rev < i.universal_rev
+      AND s.superseded_at IS NULL
+"""
+
+
+def stored_queryset(filter, ModelClass, queryset):
+    """
+    Returns a queryset of the objects in `queryset`, which must be the
+    objects of ModelClass matching `filter`, that reads their ids from
+    a stored SearchResultSet
+    """
+    result_set_id = _get_or_create_result_set(filter, ModelClass, queryset)
+    if result_set_id is None:
+        return queryset
+    return ModelClass.objects.filter(
+        pk__in=RawSQL(_IDS_SQL, [result_set_id]))
+
+
+def _get_or_create_result_set(filter, ModelClass, queryset):
+    instance = filter.instance
+    key = {'instance_id': instance.pk,
+           'model_name': ModelClass.__name__,
+           'universal_rev': instance.universal_rev,
+           'filter_hash': _filter_hash(filter)}
+
+    ids = SearchResultSet.objects.filter(**key).values_list('id', flat=True)
+    if ids:
+        return ids[0]
+
+    # Filters which are only searched for once aren't worth storing
+    seen_key = _SEEN_KEY % (key['instance_id'], key['model_name'],
+                            key['universal_rev'], key['filter_hash'])
+    if cache.add(seen_key, True, _SEEN_TIMEOUT):
+        return None
+
+    query, params = queryset.order_by().values_list('pk').query \
+        .sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(_INSERT_SQL.format(query=query),
+                       [key['instance_id'], key['model_name'],
+                        key['universal_rev'], key['filter_hash']] +
+                       list(params))
+        row = cursor.fetchone()
+
+    if row is None:
+        # Another request stored the same set first
+        return SearchResultSet.objects.filter(**key) \
+            .values_list('id', flat=True)[0]
+
+    return row[0]
+
+
+def prune_search_result_sets():
+    """
+    Marks the sets for older revs as superseded, and deletes those which
+    were superseded more than SEARCH_RESULT_SET_GRACE_PERIOD seconds ago.
+    Returns the number of sets deleted.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(_MARK_SUPERSEDED_SQL)
+
+    cutoff = timezone.now() - timedelta(
+        seconds=settings.SEARCH_RESULT_SET_GRACE_PERIOD)
+    n_deleted, __ = SearchResultSet.objects \
+        .filter(superseded_at__lt=cutoff) \
+        .delete()
+    return n_deleted
+
+
+def _filter_hash(filter):
+    filter_key = '%s/%s' % (filter.filterstr, filter.displaystr)
+    return hashlib.md5(filter_key.encode('utf-8')).hexdigest()
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import threading
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import (Case, Count, F, IntegerField, Sum, Value,
+                              When)
+
+from treemap.ecobackend import BENEFIT_FACTORS, UNKNOWN_ECO_FAILURE
+from treemap.models import Tree, TreeBenefits
+
+# Maintain a TreeBenefits row for every tree with a species and diameter,
+# so that the benefits of any set of trees can be found with a single SUM
+# instead of sending every tree to the ecoservice.
+#
+# A row is current while its species and diameter (and, for instances
+# with a default i-Tree region, its region) match the tree. Rows which
+# can't be matched that way -- those for moved trees and for species
+# whose otm_code or i-Tree code overrides changed -- are deleted when the
+# change happens. Missing and stale rows are (re)computed by a Celery
+# task, which is sent once per transaction with all of the trees saved
+# in it.
+
+_UPDATE_BATCH_SIZE = 1000
+
+# Don't schedule more than one full update for an instance at a time
+_SCHEDULED_KEY = 'tree_benefits_update_scheduled/%s'
+_SCHEDULED_TIMEOUT = 60 * 5
+
+# The ids of saved trees, by instance id, waiting for their transaction
+# to commit
+_pending = threading.local()
+
+
+def current_tree_benefits(instance):
+    rows = TreeBenefits.objects.filter(instance=instance,
+                                       species=F('tree__species'),
+                                       diameter=F('tree__diameter'))
+    if instance.itree_region_default:
+        rows = rows.filter(region_code=instance.itree_region_default)
+    return rows
+
+
+def summed_tree_benefits(instance, trees):
+    """
+    Returns a tuple of (raw benefits, number of trees with benefits) for
+    the given tree queryset, or None if some of the trees don't have
+    current benefits yet. In that case an update is scheduled.
+    """
+    n_eligible = trees.filter(species__isnull=False,
+                              diameter__isnull=False).count()
+
+    aggregates = {factor: Sum(factor) for factor in BENEFIT_FACTORS}
+    aggregates['n_rows'] = Count('tree')
+    aggregates['n_computed'] = Sum(Case(
+        When(error__isnull=True, then=Value(1)),
+        default=Value(0), output_field=IntegerField()))
+
+    totals = current_tree_benefits(instance) \
+        .filter(tree__in=trees) \
+        .aggregate(**aggregates)
+
+    if totals['n_rows'] < n_eligible:
+        schedule_tree_benefits_update(instance)
+        return None
+
+    benefits = {factor: totals[factor] or 0.0 for factor in BENEFIT_FACTORS}
+    return benefits, totals['n_computed'] or 0
+
+
+def stale_trees(instance):
+    return Tree.objects \
+        .filter(instance=instance,
+                species__isnull=False,
+                diameter__isnull=False) \
+        .exclude(pk__in=current_tree_benefits(instance).values('tree'))
+
+
+def invalidate_tree_benefits(instance, rows):
+    rows.delete()
+    schedule_tree_benefits_update(instance)
+
+
+def schedule_tree_benefits_update(instance, tree_ids=None):
+    """
+    Update benefits for the given trees, or for all of the instance's
+    stale trees, once the current transaction commits
+    """
+    from treemap.tasks import update_tree_benefits
+
+    if not settings.USE_TREE_BENEFITS_TABLE:
+        return
+
+    if tree_ids is None:
+        def schedule():
+            if cache.add(_SCHEDULED_KEY % instance.pk, True,
+                         _SCHEDULED_TIMEOUT):
+                update_tree_benefits.delay(instance.pk)
+
+        transaction.on_commit(schedule)
+    else:
+        # Every save registers a callback, since the callbacks of a
+        # rolled back transaction are dropped. The first callback to run
+        # sends all of the ids; ids left by a rolled back transaction are
+        # sent with the next one, and are harmless.
+        _pending_tree_ids()[instance.pk].update(tree_ids)
+        transaction.on_commit(
+            lambda: _send_pending_tree_ids(instance.pk))
+
+
+def _pending_tree_ids():
+    if not hasattr(_pending, 'tree_ids'):
+        _pending.tree_ids = defaultdict(set)
+    return _pending.tree_ids
+
+
+def _send_pending_tree_ids(instance_id):
+    from treemap.tasks import update_tree_benefits
+
+    tree_ids = _pending_tree_ids().pop(instance_id, None)
+    if tree_ids:
+        update_tree_benefits.delay(instance_id, sorted(tree_ids))
+
+
+def update_tree_benefits(instance, tree_ids=None):
+    from treemap.ecobenefits import raw_benefits_for_tree, region_code_lookup
+
+    cache.delete(_SCHEDULED_KEY % instance.pk)
+
+    trees = stale_trees(instance)
+    if tree_ids is not None:
+        trees = trees.filter(pk__in=tree_ids)
+    trees = trees.select_related('species', 'plot').order_by('pk')
+
+    region_code_for_plot = region_code_lookup(instance)
+
+    last_pk = 0
+    while True:
+        batch = list(trees.filter(pk__gt=last_pk)[:_UPDATE_BATCH_SIZE])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+
+        rows = []
+        for tree in batch:
+            region_code = region_code_for_plot(tree.plot)
+            benefits, err = raw_benefits_for_tree(
+                instance, region_code, tree.species_id,
+                tree.species.otm_code, tree.diameter)
+
+            if err == UNKNOWN_ECO_FAILURE:
+                # Leave the tree stale so we try again next time
+                continue
+
+            values = {factor: (benefits or {}).get(factor, 0.0)
+                      for factor in BENEFIT_FACTORS}
+            rows.append(TreeBenefits(tree=tree, instance=instance,
+                                     species_id=tree.species_id,
+                                     diameter=tree.diameter,
+                                     region_code=region_code,
+                                     error=err, **values))
+
+        with transaction.atomic():
+            TreeBenefits.objects \
+                .filter(tree__in=[row.tree_id for row in rows]) \
+                .delete()
+            TreeBenefits.objects.bulk_create(rows)
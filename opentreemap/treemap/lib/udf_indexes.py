@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction, DatabaseError
+
+from treemap.models import MapFeature
+from treemap.udf import (UserDefinedFieldDefinition,
+                         UserDefinedCollectionValue, safe_get_udf_model_class)
+
+logger = logging.getLogger(__name__)
+
+# Searches on user defined fields compile to expressions on hstore columns
+# -- (udfs -> 'name')::float for numeric scalar UDFs, (udfs -> 'name')
+# for other scalar UDFs and (data -> 'field') for the fields of
+# collection UDFs -- which no ordinary index covers.
+#
+# For each instance, keep a partial expression index matching each such
+# expression for the UDFs that can be searched: collection UDFs, and
+# scalar UDFs listed in the instance's search configuration. Indexes are
+# named udf_idx_<instance id>_<udfd id>_<n> so that the ones which are no
+# longer needed can be found and dropped.
+#
+# The planner only uses a partial index when the query's WHERE clause
+# implies the index's predicate. Map searches always constrain
+# treemap_mapfeature.instance_id, but not treemap_tree.instance_id, so
+# indexes on other tables (i.e. Tree UDFs) are instead partial on the
+# indexed expression being non-null, which any comparison with it
+# implies. Those indexes also hold the rows of other instances with a UDF
+# of the same name.
+
+_INDEX_PREFIX = 'udf_idx_%s_'
+
+_SCHEDULED_KEY = 'udf_index_sync_scheduled/%s'
+_SCHEDULED_TIMEOUT = 60
+
+_NUMERIC_TYPES = {'float', 'int'}
+
+_INDEXES_SQL = """
+    SELECT indexname FROM pg_indexes WHERE indexname LIKE %s
+"""
+
+_USAGE_SQL = """
+    SELECT s.indexrelname, s.idx_scan, s.idx_tup_read,
+           pg_relation_size(s.indexrelid)
+    FROM pg_stat_user_indexes s
+    WHERE s.indexrelname LIKE %s
+    ORDER BY s.indexrelname
+"""
+
+
+def schedule_udf_index_sync(instance):
+    from treemap.tasks import sync_udf_indexes
+
+    if not settings.USE_UDF_INDEXES:
+        return
+
+    if cache.add(_SCHEDULED_KEY % instance.pk, True, _SCHEDULED_TIMEOUT):
+        transaction.on_commit(lambda: sync_udf_indexes.delay(instance.pk))
+
+
+def searchable_udfds(instance):
+    identifiers = set()
+    for config in (instance.search_config, instance.mobile_search_fields):
+        for fields in config.values():
+            identifiers |= {field.get('identifier') for field in fields}
+
+    return [udfd for udfd in UserDefinedFieldDefinition.objects
+            .filter(instance=instance).order_by('pk')
+            if udfd.iscollection or udfd.full_name in identifiers]
+
+
+def index_definitions(udfd):
+    """
+    Returns a dict mapping index names to the CREATE INDEX statement
+    (without the "CREATE INDEX <name>") for each index `udfd` needs
+    """
+    name_prefix = '%s%s_' % (_INDEX_PREFIX % udfd.instance_id, udfd.pk)
+
+    if udfd.iscollection:
+        table = UserDefinedCollectionValue._meta.db_table
+        expressions = ["(data -> '%s')" % _quote(datatype['name'])
+                       for datatype in udfd.datatype_dict]
+        where = 'field_definition_id = %d' % udfd.pk
+    else:
+        Model = safe_get_udf_model_class(udfd.model_type)
+        table = Model._meta.get_field('udfs').model._meta.db_table
+        expression = "(udfs -> '%s')" % _quote(udfd.name)
+        if udfd.datatype_dict['type'] in _NUMERIC_TYPES:
+            expression = '(%s::float)' % expression
+        expressions = [expression]
+        if issubclass(Model, MapFeature):
+            where = 'instance_id = %d' % udfd.instance_id
+        else:
+            where = '%s IS NOT NULL' % expression
+
+    return {'%s%d' % (name_prefix, i):
+            'ON %s (%s) WHERE %s' % (table, expression, where)
+            for i, expression in enumerate(expressions)}
+
+
+def sync_udf_indexes(instance):
+    """
+    Create missing indexes and drop unneeded ones for an instance's UDFs.
+    Returns a tuple of the (created, dropped, failed) index names.
+    """
+    cache.delete(_SCHEDULED_KEY % instance.pk)
+
+    wanted = {}
+    for udfd in searchable_udfds(instance):
+        wanted.update(index_definitions(udfd))
+
+    with connection.cursor() as cursor:
+        cursor.execute(_INDEXES_SQL, [_like_prefix(instance)])
+        existing = {row[0] for row in cursor.fetchall()}
+
+    # Building an index on a large table takes a while, so don't block
+    # writes unless we have to (CONCURRENTLY can't be used in a
+    # transaction)
+    concurrently = '' if connection.in_atomic_block else 'CONCURRENTLY '
+
+    created, failed = [], []
+    for name in sorted(set(wanted) - existing):
+        try:
+            _execute('CREATE INDEX %s%s %s'
+                     % (concurrently, name, wanted[name]))
+            created.append(name)
+        except DatabaseError:
+            # e.g. a numeric UDF with a non-numeric value saved before
+            # validation was added
+            logger.exception('Failed to create UDF index %s' % name)
+            failed.append(name)
+            if concurrently:
+                # A failed concurrent build leaves an invalid index behind
+                _execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % name)
+
+    dropped = sorted(existing - set(wanted))
+    for name in dropped:
+        _execute('DROP INDEX %sIF EXISTS %s' % (concurrently, name))
+
+    return created, dropped, failed
+
+
+def udf_index_usage(instance):
+    """
+    Returns a list of dicts describing how often each of an instance's
+    UDF indexes has been used, and how large it is
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(_USAGE_SQL, [_like_prefix(instance)])
+        return [{'name': name, 'scans': scans, 'tuples_read': tuples_read,
+                 'size_bytes': size_bytes}
+                for name, scans, tuples_read, size_bytes in cursor.fetchall()]
+
+
+def _execute(sql):
+    with connection.cursor() as cursor:
+        cursor.execute(sql)
+
+
+def _like_prefix(instance):
+    # Escape the underscores, which LIKE treats as wildcards
+    return (_INDEX_PREFIX % instance.pk).replace('_', '\\_') + '%'
+
+
+def _quote(key):
+    return key.replace("'", "''")
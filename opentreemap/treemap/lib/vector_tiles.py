@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import hashlib
+import operator
+import re
+
+from django.conf import settings
+from django.contrib.gis.geos import Polygon
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Q
+
+from treemap.lib.hide_at_zoom import MAX_ZOOM
+from treemap.models import MapFeature, Plot
+from treemap.search import Filter
+
+# Mapbox vector tiles of an instance's map features, optionally limited to
+# those matching a search, built by PostGIS's ST_AsMVT.
+#
+# Searches go through treemap.search.Filter, so tiles match the search
+# results exactly. Unfiltered tiles skip the plots hidden at their zoom
+# level (see treemap/lib/hide_at_zoom.py). Filtered tiles show every
+# matching feature, because the plot chosen to represent a grid cell may
+# not match the search.
+#
+# Tile key is tile/<url_name>/<geo_rev>/<z>/<x>/<y> for unfiltered tiles,
+# and tile/<url_name>/<universal_rev>/<filter_hash>/<z>/<x>/<y> for
+# filtered ones.
+#
+# ST_AsMVT needs PostGIS 2.4 or later, built with protobuf support. On
+# older databases vector_tiles_supported() is False and the tile
+# endpoint returns 404s.
+
+MAX_TILE_ZOOM = 22
+
+LAYER_NAME = 'map_features'
+
+# Tile coordinates range from 0 to EXTENT, and features up to BUFFER
+# outside that range are included so that dots on tile edges are not cut
+WEB_MERCATOR_MAX = 20037508.342789244
+EXTENT = 4096
+BUFFER = 64
+
+_TILE_SQL = """
+    SELECT ST_AsMVT(tile, %s, %s, 'geom')
+    FROM (
+        SELECT f.id, f.feature_type,
+               ST_AsMVTGeom(f.the_geom_webmercator,
+                            ST_MakeEnvelope(%s, %s, %s, %s, 3857),
+                            %s, %s, true) AS geom
+        FROM treemap_mapfeature f
+        WHERE f.id IN ({feature_ids})
+    ) AS tile
+"""
+
+
+MIN_POSTGIS_VERSION = (2, 4)
+
+_PROBE_SQL = """
+    SELECT ST_AsMVT(t, 'probe', %s, 'geom')
+    FROM (SELECT ST_AsMVTGeom(ST_MakePoint(0, 0),
+                              ST_MakeEnvelope(-1, -1, 1, 1)) AS geom) AS t
+"""
+
+_supported = None
+
+
+def vector_tiles_supported():
+    """
+    Returns whether the database's PostGIS can build vector tiles. The
+    answer is computed once per process.
+    """
+    global _supported
+    if _supported is None:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT postgis_lib_version()')
+            lib_version = cursor.fetchone()[0]
+            version = tuple(int(part) for part
+                            in re.findall(r'\d+', lib_version)[:2])
+            _supported = version >= MIN_POSTGIS_VERSION
+            if _supported:
+                # PostGIS built without protobuf has ST_AsMVT, but it
+                # raises an error when called
+                try:
+                    with transaction.atomic():
+                        cursor.execute(_PROBE_SQL, [EXTENT])
+                except DatabaseError:
+                    _supported = False
+    return _supported
+
+
+def is_valid_tile(z, x, y):
+    return 0 <= z <= MAX_TILE_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_bounds(z, x, y):
+    """
+    Returns the (xmin, ymin, xmax, ymax) web mercator bounds of an XYZ tile
+    """
+    tile_size = 2 * WEB_MERCATOR_MAX / 2 ** z
+    xmin = -WEB_MERCATOR_MAX + x * tile_size
+    ymax = WEB_MERCATOR_MAX - y * tile_size
+    return xmin, ymax - tile_size, xmin + tile_size, ymax
+
+
+def get_vector_tile(instance, filterstr, displaystr, z, x, y):
+    """
+    Returns a vector tile, as bytes, of the instance's map features
+    matching the search
+    """
+    if filterstr or displaystr:
+        filter_hash = hashlib.md5(
+            ('%s/%s' % (filterstr, displaystr)).encode('utf-8')).hexdigest()
+        key = 'tile/%s/%s/%s/%s/%s/%s' % (
+            instance.url_name, instance.universal_rev, filter_hash, z, x, y)
+    else:
+        key = 'tile/%s/%s/%s/%s/%s' % (
+            instance.url_name, instance.geo_rev, z, x, y)
+
+    tile = cache.get(key)
+    if tile is None:
+        tile = _make_tile(instance, filterstr, displaystr, z, x, y)
+        cache.set(key, tile, settings.VECTOR_TILE_CACHE_TIMEOUT)
+    return tile
+
+
+def _make_tile(instance, filterstr, displaystr, z, x, y):
+    bounds = tile_bounds(z, x, y)
+    buffer_wm = (bounds[2] - bounds[0]) * BUFFER / EXTENT
+    buffered = Polygon.from_bbox((bounds[0] - buffer_wm,
+                                  bounds[1] - buffer_wm,
+                                  bounds[2] + buffer_wm,
+                                  bounds[3] + buffer_wm))
+    buffered.srid = 3857
+
+    features = MapFeature.objects.filter(instance=instance,
+                                         geom__bboverlaps=buffered)
+
+    if filterstr or displaystr:
+        filter = Filter(filterstr, displaystr, instance)
+        Models = [Plot] + list(instance.resource_classes)
+        matching = [Q(pk__in=objects.values('pk'))
+                    for objects in (filter.get_objects(Model)
+                                    for Model in Models)
+                    if not objects.query.is_empty()]
+        if not matching:
+            return b''
+        features = features.filter(reduce(operator.or_, matching))
+    elif z <= MAX_ZOOM:
+        features = features.filter(Q(hide_at_zoom__isnull=True) |
+                                   Q(hide_at_zoom__lt=z))
+
+    try:
+        ids_sql, ids_params = features.values('pk').query.sql_with_params()
+    except EmptyResultSet:
+        return b''
+
+    params = [LAYER_NAME, EXTENT] + list(bounds) + [EXTENT, BUFFER]
+    params += list(ids_params)
+
+    with connection.cursor() as cursor:
+        cursor.execute(_TILE_SQL.format(feature_ids=ids_sql), params)
+        tile = cursor.fetchone()[0]
+
+    return bytes(tile) if tile is not None else b''
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from treemap.lib.audit_outbox import flush_audit_outbox
+
+
+class Command(BaseCommand):
+    help = 'Moves any audits left in the audit outbox into the audit table'
+
+    def handle(self, *args, **options):
+        n_moved = flush_audit_outbox()
+        self.stdout.write('Moved %s audits' % n_moved)
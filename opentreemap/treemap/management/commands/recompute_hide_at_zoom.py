@@ -1,12 +1,12 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import Count
 
 from treemap.instance import Instance
-from treemap.lib.hide_at_zoom import recompute_hide_at_zoom
-from treemap.models import MapFeature
-
-MIN_FEATURE_COUNT = 100
+from treemap.lib.hide_at_zoom import (instances_to_recompute,
+                                      log_recompute_reports,
+                                      recompute_hide_at_zoom,
+                                      schedule_hide_at_zoom_recompute,
+                                      timed_recompute_hide_at_zoom)
 
 
 class Command(BaseCommand):
@@ -14,10 +14,24 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('instance_url_name', nargs='?', default=None)
+        parser.add_argument('--force', action='store_true', dest='force',
+                            default=False,
+                            help='Recompute even if no features have moved')
+        parser.add_argument('--celery', action='store_true', dest='celery',
+                            default=False,
+                            help='Recompute all instances in Celery tasks')
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help='How many Celery tasks to run at once')
 
     def handle(self, *args, **options):
         if options['instance_url_name'] is None:
-            _update_all_instances()
+            instance_ids = list(instances_to_recompute())
+            if options['celery']:
+                schedule_hide_at_zoom_recompute(
+                    instance_ids, options['force'], options['concurrency'])
+                self.stdout.write('Scheduled %d instances' % len(instance_ids))
+            else:
+                _update_all_instances(instance_ids, options['force'])
 
         else:
             url_name = options['instance_url_name']
@@ -26,16 +40,12 @@ class Command(BaseCommand):
             except ObjectDoesNotExist:
                 raise CommandError('Instance "%s" not found' % url_name)
 
-            recompute_hide_at_zoom(instance, verbose=True)
-
+            recompute_hide_at_zoom(instance, verbose=True,
+                                   force=options['force'])
 
-def _update_all_instances():
-    instance_ids = MapFeature.objects \
-        .values('instance_id') \
-        .annotate(n=Count('instance_id')) \
-        .filter(n__gt=MIN_FEATURE_COUNT) \
-        .values_list('instance_id', flat=True)
 
-    for id in instance_ids:
-        instance = Instance.objects.get(id=id)
-        recompute_hide_at_zoom(instance, verbose=True)
+def _update_all_instances(instance_ids, force):
+    reports = [timed_recompute_hide_at_zoom(Instance.objects.get(id=id),
+                                            force=force, verbose=True)
+               for id in instance_ids]
+    log_recompute_reports(reports)
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.core.exceptions import ObjectDoesNotExist
+
+from treemap.instance import Instance
+from treemap.lib.udf_indexes import sync_udf_indexes, udf_index_usage
+
+
+class Command(BaseCommand):
+    help = ('Creates and drops indexes for searchable user defined fields '
+            'for all instances or specified instance, and reports how often '
+            'each index has been used')
+
+    def add_arguments(self, parser):
+        parser.add_argument('instance_url_name', nargs='?', default=None)
+        parser.add_argument('--report-only', action='store_true',
+                            dest='report_only', default=False,
+                            help='Report index usage without syncing')
+
+    def handle(self, *args, **options):
+        if options['instance_url_name'] is None:
+            instances = Instance.objects.all()
+        else:
+            url_name = options['instance_url_name']
+            try:
+                instances = [Instance.objects.get(url_name=url_name)]
+            except ObjectDoesNotExist:
+                raise CommandError('Instance "%s" not found' % url_name)
+
+        for instance in instances:
+            self.stdout.write('Instance %s' % instance.url_name)
+            if not options['report_only']:
+                created, dropped, failed = sync_udf_indexes(instance)
+                for name in created:
+                    self.stdout.write('  created %s' % name)
+                for name in dropped:
+                    self.stdout.write('  dropped %s' % name)
+                for name in failed:
+                    self.stderr.write('  failed to create %s' % name)
+            for usage in udf_index_usage(instance):
+                self.stdout.write(
+                    '  %(name)s: %(scans)s scans, %(tuples_read)s tuples '
+                    'read, %(size_bytes)s bytes' % usage)
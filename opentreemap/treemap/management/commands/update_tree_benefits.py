@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.core.exceptions import ObjectDoesNotExist
+
+from treemap.instance import Instance
+from treemap.lib.tree_benefits import update_tree_benefits
+
+
+class Command(BaseCommand):
+    help = ('Computes missing or stale per-tree benefits for all instances '
+            'or specified instance')
+
+    def add_arguments(self, parser):
+        parser.add_argument('instance_url_name', nargs='?', default=None)
+
+    def handle(self, *args, **options):
+        if options['instance_url_name'] is None:
+            instances = Instance.objects.all()
+        else:
+            url_name = options['instance_url_name']
+            try:
+                instances = [Instance.objects.get(url_name=url_name)]
+            except ObjectDoesNotExist:
+                raise CommandError('Instance "%s" not found' % url_name)
+
+        for instance in instances:
+            if instance.has_itree_region():
+                self.stdout.write('Updating instance %s' % instance.url_name)
+                update_tree_benefits(instance)
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('treemap', '0046_auto_20170907_0937'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TreeBenefits',
+            fields=[
+                ('tree', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='treemap.Tree')),
+                ('diameter', models.FloatField()),
+                ('region_code', models.CharField(blank=True, max_length=40, null=True)),
+                ('error', models.CharField(blank=True, max_length=255, null=True)),
+                ('aq_nox_avoided', models.FloatField(default=0)),
+                ('aq_nox_dep', models.FloatField(default=0)),
+                ('aq_ozone_dep', models.FloatField(default=0)),
+                ('aq_pm10_avoided', models.FloatField(default=0)),
+                ('aq_pm10_dep', models.FloatField(default=0)),
+                ('aq_sox_avoided', models.FloatField(default=0)),
+                ('aq_sox_dep', models.FloatField(default=0)),
+                ('aq_voc_avoided', models.FloatField(default=0)),
+                ('bvoc', models.FloatField(default=0)),
+                ('co2_avoided', models.FloatField(default=0)),
+                ('co2_sequestered', models.FloatField(default=0)),
+                ('co2_storage', models.FloatField(default=0)),
+                ('electricity', models.FloatField(default=0)),
+                ('hydro_interception', models.FloatField(default=0)),
+                ('natural_gas', models.FloatField(default=0)),
+                ('instance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='treemap.Instance')),
+                ('species', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='treemap.Species')),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('treemap', '0047_treebenefits'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EcoCacheWarming',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('geo_rev', models.IntegerField(blank=True, null=True)),
+                ('eco_rev', models.IntegerField(blank=True, null=True)),
+                ('universal_rev', models.IntegerField(blank=True, null=True)),
+                ('n_filters', models.IntegerField(default=0)),
+                ('n_errors', models.IntegerField(default=0)),
+                ('instance', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='treemap.Instance')),
+            ],
+        ),
+    ]
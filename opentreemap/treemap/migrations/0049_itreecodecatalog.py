@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import treemap.json_field
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('treemap', '0048_ecocachewarming'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ITreeCodeCatalog',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('codes', treemap.json_field.JSONField()),
+                ('version', models.CharField(max_length=32, unique=True)),
+                ('fetched_at', models.DateTimeField()),
+            ],
+            options={
+                'get_latest_by': 'fetched_at',
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('treemap', '0049_itreecodecatalog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchResultSet',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_name', models.CharField(max_length=255)),
+                ('universal_rev', models.IntegerField()),
+                ('filter_hash', models.CharField(max_length=32)),
+                ('ids', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), size=None)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('instance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='treemap.Instance')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='searchresultset',
+            unique_together=set([('instance', 'model_name', 'universal_rev', 'filter_hash')]),
+        ),
+    ]
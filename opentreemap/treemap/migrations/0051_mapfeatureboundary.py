@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('treemap', '0050_searchresultset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='boundary',
+            name='members_indexed_at',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='MapFeatureBoundary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('boundary', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='treemap.Boundary')),
+                ('map_feature', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='treemap.MapFeature')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='mapfeatureboundary',
+            unique_together=set([('boundary', 'map_feature')]),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# The hide_at_zoom grid size at zoom 14 (see treemap/lib/hide_at_zoom.py)
+GRID_SIZE_WM = 40075016.6856 / (256 * 2 ** 14) * 2
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('treemap', '0051_mapfeatureboundary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mapfeature',
+            name='grid_x',
+            field=models.IntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='mapfeature',
+            name='grid_y',
+            field=models.IntegerField(editable=False, null=True),
+        ),
+        migrations.RunSQL(
+            'UPDATE treemap_mapfeature '
+            'SET grid_x = floor(ST_X(the_geom_webmercator) / %(size)r), '
+            '    grid_y = floor(ST_Y(the_geom_webmercator) / %(size)r)'
+            % {'size': GRID_SIZE_WM},
+            migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('treemap', '0052_mapfeature_grid_cell'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='instance',
+            name='hide_at_zoom_geo_rev',
+            field=models.IntegerField(editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('treemap', '0053_instance_hide_at_zoom_geo_rev'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditOutbox',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=255)),
+                ('model_id', models.IntegerField()),
+                ('field', models.CharField(max_length=255, null=True)),
+                ('previous_value', models.TextField(null=True)),
+                ('current_value', models.TextField(null=True)),
+                ('action', models.IntegerField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('instance', models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, to='treemap.Instance')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('treemap', '0054_auditoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchresultset',
+            name='superseded_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -16,9 +16,10 @@ from django.core.exceptions import (ValidationError, MultipleObjectsReturned,
 from django.core import validators
 from django.http import Http404
 from django.contrib.gis.db import models
+from django.contrib.postgres.fields import ArrayField
 from django.contrib.gis.measure import D
 from django.db import IntegrityError, transaction
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.models import (UserManager, AbstractBaseUser,
@@ -35,6 +36,7 @@ from treemap.images import save_uploaded_image
 from treemap.units import Convertible
 from treemap.udf import UDFModel
 from treemap.instance import Instance
+from treemap.json_field import JSONField
 from treemap.lib.object_caches import invalidate_adjuncts
 
 
@@ -645,6 +647,11 @@ class MapFeature(Convertible, UDFModel, PendingAuditable):
     hide_at_zoom = models.IntegerField(
         null=True, blank=True, default=None, db_index=True)
 
+    # The feature's cell on the finest hide_at_zoom grid, for counting
+    # features per cell at lower zooms (see treemap/lib/grid_counts.py)
+    grid_x = models.IntegerField(null=True, editable=False)
+    grid_y = models.IntegerField(null=True, editable=False)
+
     users_can_delete_own_creations = True
 
     @classproperty
@@ -666,7 +673,8 @@ class MapFeature(Convertible, UDFModel, PendingAuditable):
     @classproperty
     def do_not_track(cls):
         return PendingAuditable.do_not_track | UDFModel.do_not_track | {
-            'feature_type', 'mapfeature_ptr', 'hide_at_zoom'}
+            'feature_type', 'mapfeature_ptr', 'hide_at_zoom', 'grid_x',
+            'grid_y'}
 
     @property
     def _is_generic(self):
@@ -699,16 +707,35 @@ class MapFeature(Convertible, UDFModel, PendingAuditable):
             updated_at=self.updated_at, updated_by=user)
 
     def save_with_user(self, user, *args, **kwargs):
+        from treemap.lib.boundary_membership import update_feature_boundaries
+        from treemap.lib.grid_counts import grid_cell
+        from treemap.lib.hide_at_zoom import update_hide_at_zoom_after_add
+        from treemap.lib.tree_benefits import invalidate_tree_benefits
+
         self.full_clean_with_user(user)
 
         if self._is_generic:
             raise Exception(
                 'Never save a MapFeature -- only save a MapFeature subclass')
 
+        created = self.pk is None
+        moved = created or 'geom' in self._updated_fields()
+        if moved:
+            self.grid_x, self.grid_y = grid_cell(self.geom)
+
         self.updated_at = timezone.now()
         self.updated_by = user
         super(MapFeature, self).save_with_user(user, *args, **kwargs)
 
+        if moved:
+            update_feature_boundaries(self)
+        if created:
+            update_hide_at_zoom_after_add(self)
+        elif moved and self.is_plot:
+            # A move may change the tree's i-Tree region
+            invalidate_tree_benefits(
+                self.instance, TreeBenefits.objects.filter(tree__plot=self))
+
     def clean(self):
         super(MapFeature, self).clean()
 
@@ -1444,6 +1471,10 @@ class Boundary(models.Model):
     canopy_percent = models.FloatField(null=True)
     searchable = models.BooleanField(default=True)
 
+    # The `updated_at` as of which the MapFeatureBoundary rows for this
+    # boundary were computed (see treemap.lib.boundary_membership)
+    members_indexed_at = models.DateTimeField(null=True, editable=False)
+
     objects = BoundaryManager()
     # Allows access to anonymous boundaries
     all_objects = models.GeoManager()
@@ -1451,6 +1482,10 @@ class Boundary(models.Model):
     def __unicode__(self):
         return self.name
 
+    @property
+    def is_anonymous(self):
+        return self.name == '' and self.category == '' and not self.searchable
+
     @classmethod
     def anonymous(cls, polygon=None):
         """
@@ -1506,3 +1541,170 @@ class ITreeCodeOverride(models.Model, Auditable):
     def __init__(self, *args, **kwargs):
         super(ITreeCodeOverride, self).__init__(*args, **kwargs)
         self.populate_previous_state()
+
+
+class TreeBenefits(models.Model):
+    """
+    The raw ecoservice benefits of a single tree, stored along with the
+    species, diameter and region they were computed for. A row is only
+    current while its species and diameter match the tree's (rows are
+    deleted when the species' otm_code changes), which lets
+    benefits for any set of trees be summed in a single query (see
+    treemap.lib.tree_benefits).
+
+    Trees whose benefits cannot be computed (e.g. a species without an
+    i-Tree code) have a row with an error code and zero benefits.
+    """
+    tree = models.OneToOneField(Tree, primary_key=True)
+    instance = models.ForeignKey(Instance)
+    species = models.ForeignKey(Species)
+    diameter = models.FloatField()
+    region_code = models.CharField(max_length=40, null=True, blank=True)
+    error = models.CharField(max_length=255, null=True, blank=True)
+
+    aq_nox_avoided = models.FloatField(default=0)
+    aq_nox_dep = models.FloatField(default=0)
+    aq_ozone_dep = models.FloatField(default=0)
+    aq_pm10_avoided = models.FloatField(default=0)
+    aq_pm10_dep = models.FloatField(default=0)
+    aq_sox_avoided = models.FloatField(default=0)
+    aq_sox_dep = models.FloatField(default=0)
+    aq_voc_avoided = models.FloatField(default=0)
+    bvoc = models.FloatField(default=0)
+    co2_avoided = models.FloatField(default=0)
+    co2_sequestered = models.FloatField(default=0)
+    co2_storage = models.FloatField(default=0)
+    electricity = models.FloatField(default=0)
+    hydro_interception = models.FloatField(default=0)
+    natural_gas = models.FloatField(default=0)
+
+
+def _tree_saved(sender, instance, created, **kwargs):
+    from treemap.lib.tree_benefits import schedule_tree_benefits_update
+    tree = instance  # 'instance' is a Django term here
+    # Post-save handlers run before the previous state is updated
+    eco_fields_changed = created or \
+        {'species', 'diameter'} & set(tree._updated_fields())
+    if tree.species_id and tree.diameter and eco_fields_changed:
+        schedule_tree_benefits_update(tree.instance, [tree.pk])
+
+
+def _species_saved(sender, instance, created, **kwargs):
+    from treemap.lib.tree_benefits import invalidate_tree_benefits
+    species = instance  # 'instance' is a Django term here
+    # The benefits of trees with this species were computed for its old
+    # otm_code (e.g. before the species importer filled it in)
+    if not created and 'otm_code' in species._updated_fields():
+        invalidate_tree_benefits(
+            species.instance, TreeBenefits.objects.filter(species=species))
+
+
+def _itree_code_override_changed(sender, instance, **kwargs):
+    from treemap.lib.tree_benefits import invalidate_tree_benefits
+    override = instance  # 'instance' is a Django term here
+    species = override.instance_species
+    invalidate_tree_benefits(species.instance,
+                             TreeBenefits.objects.filter(species=species))
+
+
+post_save.connect(_tree_saved, sender=Tree)
+post_save.connect(_species_saved, sender=Species)
+post_save.connect(_itree_code_override_changed, sender=ITreeCodeOverride)
+post_delete.connect(_itree_code_override_changed, sender=ITreeCodeOverride)
+
+
+class EcoCacheWarming(models.Model):
+    """
+    The most recent run of the eco cache warming task for an instance
+    (see treemap.lib.ecocache_warming), shown in the Django admin
+    """
+    instance = models.OneToOneField(Instance)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    geo_rev = models.IntegerField(null=True, blank=True)
+    eco_rev = models.IntegerField(null=True, blank=True)
+    universal_rev = models.IntegerField(null=True, blank=True)
+    n_filters = models.IntegerField(default=0)
+    n_errors = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return 'Eco cache warming for %s' % self.instance.url_name
+
+
+class ITreeCodeCatalog(models.Model):
+    """
+    A copy of the i-Tree codes the ecoservice knows for each region, so
+    that worker processes don't need to ask the ecoservice for them (see
+    treemap.ecobenefits.all_itree_codes). `version` is a hash of `codes`.
+    """
+    codes = JSONField()
+    version = models.CharField(max_length=32, unique=True)
+    fetched_at = models.DateTimeField()
+
+    class Meta:
+        get_latest_by = 'fetched_at'
+
+
+class SearchResultSet(models.Model):
+    """
+    The sorted ids of the objects of one model matching a search filter
+    as of an instance's universal_rev, so that counts, eco summaries and
+    exports for the same search can reuse them instead of reevaluating
+    the filter (see treemap.lib.search_result_sets)
+    """
+    instance = models.ForeignKey(Instance)
+    model_name = models.CharField(max_length=255)
+    universal_rev = models.IntegerField()
+    filter_hash = models.CharField(max_length=32)
+    ids = ArrayField(models.IntegerField())
+    created_at = models.DateTimeField(auto_now_add=True)
+    # When a newer rev was first noticed, after which the set is deleted
+    # once no querysets built on it can still be in use
+    superseded_at = models.DateTimeField(null=True)
+
+    class Meta:
+        unique_together = ('instance', 'model_name', 'universal_rev',
+                           'filter_hash')
+
+
+class MapFeatureBoundary(models.Model):
+    """
+    Records that a map feature lies within a (non-anonymous) boundary, so
+    that boundary searches can use an indexed join instead of testing
+    each feature against the boundary's geometry
+    """
+    map_feature = models.ForeignKey(MapFeature)
+    boundary = models.ForeignKey(Boundary)
+
+    class Meta:
+        unique_together = ('boundary', 'map_feature')
+
+
+def _boundary_saved(sender, instance, **kwargs):
+    from treemap.lib.boundary_membership import \
+        schedule_boundary_members_update
+    boundary = instance  # 'instance' is a Django term here
+    if not boundary.is_anonymous:
+        schedule_boundary_members_update(boundary)
+
+
+post_save.connect(_boundary_saved, sender=Boundary)
+
+
+def _instance_boundaries_changed(sender, instance, action, reverse, pk_set,
+                                 **kwargs):
+    from treemap.lib.boundary_membership import invalidate_boundary_members
+    # 'instance' is the Instance, or the Boundary if reverse is True
+    if reverse:
+        boundary_ids = [instance.pk]
+    elif action == 'pre_clear':
+        boundary_ids = instance.boundaries.values_list('pk', flat=True)
+    else:
+        boundary_ids = pk_set
+
+    if action in ('post_add', 'post_remove', 'pre_clear'):
+        invalidate_boundary_members(boundary_ids)
+
+
+m2m_changed.connect(_instance_boundaries_changed,
+                    sender=Instance.boundaries.through)
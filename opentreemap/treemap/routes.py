@@ -159,6 +159,16 @@ canopy_popup = do(
     instance_request,
     feature_views.canopy_popup)
 
+vector_tile = do(
+    instance_request,
+    require_http_method('GET'),
+    feature_views.vector_tile)
+
+plot_grid_counts = do(
+    json_api_call,
+    instance_request,
+    route(GET=feature_views.plot_grid_counts))
+
 add_map_feature_photo = add_map_feature_photo_do(
     feature_views.add_map_feature_photo)
 
@@ -226,6 +236,11 @@ search_tree_benefits = do(
     render_template('treemap/partials/eco_benefits.html'),
     tree_views.search_tree_benefits)
 
+search_facets = do(
+    json_api_call,
+    instance_request,
+    route(GET=tree_views.search_facets))
+
 add_tree_photo = add_map_feature_photo_do(tree_views.add_tree_photo)
 
 #####################################
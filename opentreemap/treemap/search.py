@@ -3,11 +3,15 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 
+import threading
+
+from collections import OrderedDict
 from json import loads
 from datetime import datetime
 from functools import partial
 from itertools import groupby, chain
 
+from django.conf import settings
 from django.db.models import Q
 
 from opentreemap.util import dotted_split
@@ -44,6 +48,19 @@ PLOT_RELATED_MODELS = {Plot, Tree, Species, TreePhoto}
 MAP_FEATURE_RELATED_NAMES = {'mapFeature', 'mapFeaturePhoto'}
 
 
+# Parsing a filter means unit conversion, Boundary lookups and, for
+# collection UDFs, instantiating models, so the Q object each filter
+# compiles to for a model is kept in a per-process LRU of
+# settings.FILTER_CACHE_SIZE entries. The instance's universal_rev is part
+# of the key, so edits to data the filter depends on (e.g. a boundary
+# added by an import, or new collection UDFs) start new entries.
+_compiled_filters = OrderedDict()
+_compiled_filters_lock = threading.Lock()
+
+# Stored in the LRU for filters which match no objects of a model
+_MATCHES_NOTHING = 'matches-nothing'
+
+
 class Filter(object):
     def __repr__(self):
         return "(%s, %s)" % (self.filterstr, self.displaystr)
@@ -55,11 +72,54 @@ class Filter(object):
         self.instance = instance
 
     def get_objects(self, ModelClass):
+        from treemap.lib.search_result_sets import stored_queryset
+
+        q = self._get_compiled_q(ModelClass)
+
+        if q is _MATCHES_NOTHING:
+            return ModelClass.objects.none()
+
+        queryset = ModelClass.objects.filter(q)
+
+        # Unfiltered searches only need the instance's index, so there's
+        # nothing to gain by storing them
+        if settings.USE_SEARCH_RESULT_SETS and \
+                (self.filterstr or self.displaystr):
+            queryset = stored_queryset(self, ModelClass, queryset)
+
+        return queryset
+
+    def get_object_count(self, ModelClass):
+        return self.get_objects(ModelClass).count()
+
+    def _get_compiled_q(self, ModelClass):
+        if not settings.FILTER_CACHE_SIZE:
+            return self._compile(ModelClass)
+
+        key = (self.instance.pk, self.instance.universal_rev,
+               self.filterstr, self.displaystr, ModelClass.__name__)
+
+        with _compiled_filters_lock:
+            q = _compiled_filters.pop(key, None)
+            if q is not None:
+                _compiled_filters[key] = q
+                return q
+
+        q = self._compile(ModelClass)
+
+        with _compiled_filters_lock:
+            _compiled_filters[key] = q
+            while len(_compiled_filters) > settings.FILTER_CACHE_SIZE:
+                _compiled_filters.popitem(last=False)
+
+        return q
+
+    def _compile(self, ModelClass):
         # Filter out invalid models
         model_name = ModelClass.__name__
 
         if not _model_in_display_filters(model_name, self.display_filter):
-            return ModelClass.objects.none()
+            return _MATCHES_NOTHING
 
         q = create_filter(self.instance, self.filterstr, DEFAULT_MAPPING)
         if model_name == 'Plot':
@@ -70,14 +130,14 @@ class Filter(object):
 
         if _is_valid_models_list_for_model(models, model_name, ModelClass,
                                            self.instance):
-            queryset = ModelClass.objects.filter(q)
+            return q
         else:
-            queryset = ModelClass.objects.none()
+            return _MATCHES_NOTHING
 
-        return queryset
 
-    def get_object_count(self, ModelClass):
-        return self.get_objects(ModelClass).count()
+def clear_compiled_filters():
+    with _compiled_filters_lock:
+        _compiled_filters.clear()
 
 
 def _is_valid_models_list_for_model(models, model_name, ModelClass, instance):
@@ -251,9 +311,12 @@ def _parse_scalar_predicate(query, mapping):
 
                 cast = rhs if props['udf_cast'] else None
 
-                lookup_key = _lookup_key(
-                    prefix, search_key,
-                    lookup_name=lookup_tail, cast=cast)
+                if lookup_tail == _MAP_FEATURE_ID_IN:
+                    lookup_key = prefix + 'id__in'
+                else:
+                    lookup_key = _lookup_key(
+                        prefix, search_key,
+                        lookup_name=lookup_tail, cast=cast)
 
                 query[lookup_key] = rhs
 
@@ -496,8 +559,23 @@ def _parse_min_max_value_fn(operator, is_hstore=True):
     return fn
 
 
+# Predicate builders normally return a lookup on the searched field. This
+# lookup is applied to the id of the searched map feature instead.
+_MAP_FEATURE_ID_IN = '__map_feature_id_in'
+
+
 def _parse_in_boundary(boundary_id):
-    boundary = Boundary.all_objects.get(pk=boundary_id)
+    from treemap.lib.boundary_membership import (
+        members_are_indexed, member_ids, schedule_boundary_members_update)
+
+    # Avoid loading the (possibly very large) geometry unless we need it
+    boundary = Boundary.all_objects.defer('geom').get(pk=boundary_id)
+
+    if members_are_indexed(boundary):
+        return {_MAP_FEATURE_ID_IN: member_ids(boundary_id)}
+
+    if not boundary.is_anonymous:
+        schedule_boundary_members_update(boundary, debounce=True)
     return {'__within': boundary.geom}
 
 
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from celery import shared_task
+
+from treemap import ecobenefits, ecocache
+from treemap.models import Boundary, Instance, Plot
+from treemap.lib import (audit_outbox, boundary_membership,
+                         ecocache_warming, hide_at_zoom, search_result_sets,
+                         tree_benefits, udf_indexes)
+from treemap.search import Filter
+
+
+@shared_task
+def update_tree_benefits(instance_id, tree_ids=None):
+    instance = Instance.objects.get(pk=instance_id)
+    tree_benefits.update_tree_benefits(instance, tree_ids)
+
+
+@shared_task
+def refresh_eco_cache(prefix, instance_id, filterstr, displaystr, lock_key):
+    instance = Instance.objects.get(pk=instance_id)
+    filter = Filter(filterstr, displaystr, instance)
+    ecocache.refresh_cached_value(prefix, filter, lock_key)
+
+
+@shared_task
+def warm_eco_cache(instance_id):
+    instance = Instance.objects.get(pk=instance_id)
+    ecocache_warming.warm_eco_cache(instance)
+
+
+@shared_task
+def compute_exact_benefits(instance_id, filterstr, displaystr):
+    instance = Instance.objects.get(pk=instance_id)
+    filter = Filter(filterstr, displaystr, instance)
+    benefits = Plot.benefits.benefits_for_filter(instance, filter,
+                                                 allow_sampling=False)
+    ecocache.set_cached_benefits('Plot', filter, benefits)
+
+
+@shared_task
+def refresh_itree_code_catalog():
+    ecobenefits.refresh_itree_code_catalog()
+
+
+@shared_task
+def update_boundary_members(boundary_id):
+    boundary = Boundary.all_objects.get(pk=boundary_id)
+    boundary_membership.update_boundary_members(boundary)
+
+
+@shared_task
+def sync_udf_indexes(instance_id):
+    instance = Instance.objects.get(pk=instance_id)
+    udf_indexes.sync_udf_indexes(instance)
+
+
+@shared_task
+def prune_search_result_sets():
+    search_result_sets.prune_search_result_sets()
+
+
+@shared_task
+def flush_audit_outbox():
+    audit_outbox.flush_audit_outbox()
+
+
+@shared_task
+def recompute_hide_at_zoom(reports, instance_id, force=False):
+    report = hide_at_zoom.recompute_hide_at_zoom_or_report_error(
+        instance_id, force)
+    return reports + [report]
+
+
+@shared_task
+def report_hide_at_zoom_recompute(reports_by_chain):
+    hide_at_zoom.log_recompute_reports(
+        [report for reports in reports_by_chain for report in reports])
@@ -10,6 +10,11 @@ test_settings = {
     # Without this we'd need to invalidate the cache before every test.
     'USE_OBJECT_CACHES': False,
     'USE_ECO_CACHE': False,
+    'USE_TREE_BENEFITS_TABLE': False,
+    'ECO_CACHE_WARMING_DELAY': None,
+    'FILTER_CACHE_SIZE': 0,
+    'USE_SEARCH_RESULT_SETS': False,
+    'USE_UDF_INDEXES': False,
 
     'CELERY_TASK_ALWAYS_EAGER': True,
     'CELERY_TASK_EAGER_PROPAGATES': True
@@ -13,19 +13,23 @@ from django.core.exceptions import (FieldError, ValidationError,
 from django.core.urlresolvers import reverse
 
 from django.db import IntegrityError, connection
+from django.contrib.auth.models import Permission
 from django.contrib.gis.geos import Point
+from django.test.utils import override_settings
 
 from stormwater.models import RainBarrel
 from treemap.templatetags.util import audit_detail_link
 
 from treemap.models import (Tree, Plot, FieldPermission, User, InstanceUser,
                             Instance)
-from treemap.audit import (Audit, Role, UserTrackingException,
+from treemap.audit import (Audit, AuditOutbox, Role, UserTrackingException,
                            AuthorizeException, ReputationMetric,
                            approve_or_reject_audits_and_apply,
                            approve_or_reject_audit_and_apply,
                            approve_or_reject_existing_edit,
                            get_id_sequence_name)
+from treemap.lib.audit_outbox import flush_audit_outbox
+from treemap.lib.object_caches import clear_caches
 from treemap.udf import UserDefinedFieldDefinition
 from treemap.tests import (make_instance, make_user_with_default_role,
                            make_user_and_role, make_commander_user,
@@ -811,6 +815,36 @@ class ReputationTest(OTMTestCase):
         self.assertEqual(2,
                          self.unprivileged_user.get_reputation(self.instance))
 
+    def _make_insert_audit(self, model='Tree'):
+        return Audit(model=model, model_id=1,
+                     action=Audit.Type.Insert,
+                     instance=self.instance, field='readonly',
+                     previous_value=None,
+                     current_value=True,
+                     user=self.unprivileged_user)
+
+    def test_reputation_adjustments_are_summed_per_user(self):
+        ReputationMetric.apply_adjustment(self._make_insert_audit(),
+                                          self._make_insert_audit('Plot'),
+                                          self._make_insert_audit())
+
+        self.assertEqual(4,
+                         self.unprivileged_user.get_reputation(self.instance))
+
+    @override_settings(USE_OBJECT_CACHES=True)
+    def test_reputation_metric_changes_are_applied(self):
+        clear_caches()
+        ReputationMetric.apply_adjustment(self._make_insert_audit())
+
+        rm = ReputationMetric.objects.get(instance=self.instance,
+                                          model_name='Tree')
+        rm.direct_write_score = 7
+        rm.save()
+        ReputationMetric.apply_adjustment(self._make_insert_audit())
+
+        self.assertEqual(9,
+                         self.unprivileged_user.get_reputation(self.instance))
+
     def _test_negative_adjustment(self, initial, adjusted):
         iuser = self.unprivileged_user.get_instance_user(self.instance)
         iuser.reputation = initial
@@ -847,6 +881,93 @@ class ReputationTest(OTMTestCase):
         self._test_negative_adjustment(3, 0)
 
 
+@override_settings(USE_AUDIT_OUTBOX=True)
+class AuditOutboxTest(OTMTestCase):
+    def setUp(self):
+        self.p1 = Point(-7615441.0, 5953519.0)
+        self.instance = make_instance(point=self.p1)
+        self.commander_user = make_commander_user(self.instance)
+        self.pending_user = make_apprentice_user(self.instance)
+
+        self.plot = Plot(geom=self.p1, instance=self.instance, length=5.0)
+        self.plot.save_with_user(self.commander_user)
+
+    def test_direct_audits_are_moved_from_outbox(self):
+        self.plot.length = 6.0
+        self.plot.save_with_user(self.commander_user)
+
+        n_recorded = AuditOutbox.objects.count()
+        self.assertGreater(n_recorded, 0)
+        updates = self.plot.audits().filter(action=Audit.Type.Update)
+        self.assertFalse(updates.exists())
+        created = AuditOutbox.objects.get(field='length').created
+
+        self.assertEqual(n_recorded, flush_audit_outbox(batch_size=2))
+
+        self.assertEqual(0, AuditOutbox.objects.count())
+        self.assertEqual(n_recorded, updates.count())
+        self.assertTrue(updates.filter(field='length',
+                                       user=self.commander_user,
+                                       created=created).exists())
+
+    def test_insert_audits_are_not_deferred(self):
+        self.assertFalse(AuditOutbox.objects
+                         .filter(action=Audit.Type.Insert).exists())
+        self.assertTrue(self.plot.audits()
+                        .filter(action=Audit.Type.Insert, field='length')
+                        .exists())
+
+    def test_creator_can_delete_before_flush(self):
+        role = self.commander_user.get_role(self.instance)
+        role.instance_permissions.remove(Permission.objects.get(
+            codename=Role.permission_codename(Plot, 'delete')))
+        self.assertFalse(role.can_delete(Plot))
+
+        plot = Plot(geom=self.p1, instance=self.instance)
+        plot.save_with_user(self.commander_user)
+        plot.delete_with_user(self.commander_user)
+
+        self.assertFalse(Plot.objects.filter(pk=plot.pk).exists())
+
+    def test_pending_audits_are_not_deferred(self):
+        flush_audit_outbox()
+
+        self.plot.length = 6.0
+        self.plot.save_with_user(self.pending_user)
+
+        self.assertFalse(AuditOutbox.objects.filter(field='length')
+                         .exists())
+        self.assertEqual(1, self.plot.audits()
+                         .filter(requires_auth=True, field='length')
+                         .count())
+
+    def test_hash_changes_before_flush(self):
+        flush_audit_outbox()
+        old_hash = self.plot.hash
+
+        self.plot.length = 6.0
+        self.plot.save_with_user(self.commander_user)
+
+        self.assertNotEqual(old_hash, self.plot.hash)
+
+    def test_reject_does_not_revert_newer_edit_in_outbox(self):
+        flush_audit_outbox()
+
+        self.plot.length = 6.0
+        self.plot.save_with_user(self.pending_user)
+        pending_audit = self.plot.audits().get(requires_auth=True,
+                                               field='length')
+
+        plot = Plot.objects.get(pk=self.plot.pk)
+        plot.length = 7.0
+        plot.save_with_user(self.commander_user)
+
+        approve_or_reject_audit_and_apply(pending_audit, self.commander_user,
+                                          approved=False)
+
+        self.assertEqual(7.0, Plot.objects.get(pk=self.plot.pk).length)
+
+
 class UserRoleFieldPermissionTest(MultiUserTestCase):
     def setUp(self):
         super(UserRoleFieldPermissionTest, self).setUp()
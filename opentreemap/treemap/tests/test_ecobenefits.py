@@ -4,27 +4,69 @@ from __future__ import unicode_literals
 from __future__ import division
 
 import json
+import os
+import shutil
+import tempfile
 
 from unittest.case import skip
 
+from django.conf import settings
 from django.core.cache import cache
-from django.test import override_settings
+from django.contrib.gis.geos import Point
+from django.test import TransactionTestCase, override_settings
 
+from stormwater.models import RainBarrel
 from treemap.models import (Plot, Tree, Species, ITreeRegion,
-                            ITreeCodeOverride, BenefitCurrencyConversion)
+                            ITreeCodeOverride, BenefitCurrencyConversion,
+                            EcoCacheWarming, ITreeCodeCatalog, TreeBenefits)
 from treemap.tests import (make_instance, make_commander_user, make_request,
-                           OTMTestCase)
+                           make_simple_boundary, OTMTestCase)
+from treemap.tests.base import test_settings
 from treemap.tests.test_urls import UrlTestCase
 
-from treemap import ecobackend
+from treemap import ecobackend, ecobenefits, ecoengine
 from treemap.ecobenefits import (TreeBenefitsCalculator,
+                                 get_benefits_for_filter,
+                                 compute_currency_and_transform_units,
                                  _combine_benefit_basis,
                                  _annotate_basis_with_extra_stats,
-                                 _combine_grouped_benefits, BenefitCategory)
+                                 _combine_grouped_benefits, BenefitCategory,
+                                 has_itree_code, all_itree_codes)
+from treemap.lib import ecocache_warming, tree_benefits
+from treemap.lib.ecocache_warming import (filters_to_warm,
+                                          schedule_eco_cache_warming,
+                                          warm_eco_cache)
+from treemap.lib.tree_benefits import update_tree_benefits
 from treemap.views.tree import search_tree_benefits
 from treemap.search import Filter
 from treemap.ecocache import (get_cached_benefits, get_cached_plot_count,
-                              invalidate_ecoservice_cache_if_stale)
+                              get_cached_tree_benefits, set_cached_benefits,
+                              tree_benefits_cache_stats,
+                              clear_tree_benefits_cache,
+                              eco_cache_stats, _get_key,
+                              invalidate_ecoservice_cache_if_stale,
+                              override_rev_stats)
+
+
+# The ecoservice's response for
+# eco.json?otmcode=CEAT&diameter=1630&region=NoEastXXX
+ECOSERVICE_CEAT_BENEFITS = {
+    "aq_nox_avoided": 0.6792,
+    "aq_nox_dep": 0.371,
+    "aq_ozone_dep": 0.775,
+    "aq_pm10_avoided": 0.0436,
+    "aq_pm10_dep": 0.491,
+    "aq_sox_avoided": 0.372,
+    "aq_sox_dep": 0.21,
+    "aq_voc_avoided": 0.0254,
+    "bvoc": -0.077,
+    "co2_avoided": 255.5,
+    "co2_sequestered": 0,
+    "co2_storage": 6575,
+    "electricity": 187,
+    "hydro_interception": 12.06,
+    "natural_gas": 5834.1
+}
 
 
 class EcoTestCase(UrlTestCase):
@@ -34,23 +76,7 @@ class EcoTestCase(UrlTestCase):
         # eco.json?otmcode=CEAT&diameter=1630&region=NoEastXXX
         def mockbenefits(*args, **kwargs):
             benefits = {
-                "Benefits": {
-                    "aq_nox_avoided": 0.6792,
-                    "aq_nox_dep": 0.371,
-                    "aq_ozone_dep": 0.775,
-                    "aq_pm10_avoided": 0.0436,
-                    "aq_pm10_dep": 0.491,
-                    "aq_sox_avoided": 0.372,
-                    "aq_sox_dep": 0.21,
-                    "aq_voc_avoided": 0.0254,
-                    "bvoc": -0.077,
-                    "co2_avoided": 255.5,
-                    "co2_sequestered": 0,
-                    "co2_storage": 6575,
-                    "electricity": 187,
-                    "hydro_interception": 12.06,
-                    "natural_gas": 5834.1
-                }
+                "Benefits": dict(ECOSERVICE_CEAT_BENEFITS)
             }
             return (benefits, None)
 
@@ -126,6 +152,122 @@ class EcoTest(EcoTestCase):
         self.assert_benefit_value(bens, BenefitCategory.CO2STORAGE,
                                   'lbs', 6575)
 
+    def test_benefits_for_objects_matches_benefits_for_object(self):
+        calculator = TreeBenefitsCalculator()
+        single = calculator.benefits_for_object(self.instance, self.plot)
+        batch = calculator.benefits_for_objects(self.instance, [self.plot])
+
+        self.assertEqual(batch, {self.plot.pk: single})
+
+    def test_benefits_for_objects_shares_lookups(self):
+        calls = self._count_eco_calls()
+
+        plot2 = Plot(geom=self.instance.center, instance=self.instance)
+        plot2.save_with_user(self.user)
+        Tree(plot=plot2, instance=self.instance, species=self.species,
+             diameter=1630).save_with_user(self.user)
+        empty_plot = Plot(geom=self.instance.center, instance=self.instance)
+        empty_plot.save_with_user(self.user)
+
+        results = TreeBenefitsCalculator().benefits_for_objects(
+            self.instance, [self.plot, plot2, empty_plot])
+
+        self.assertEqual(calls, ['eco.json'])
+        self.assertEqual(results[self.plot.pk], results[plot2.pk])
+        self.assertEqual(results[empty_plot.pk][2], 'NO_TREE')
+
+    def _count_eco_calls(self):
+        calls = []
+        mockbenefits = ecobackend.json_benefits_call
+
+        def counting_mock(*args, **kwargs):
+            calls.append(args[0])
+            return mockbenefits(*args, **kwargs)
+
+        ecobackend.json_benefits_call = counting_mock
+        return calls
+
+    @override_settings(USE_TREE_BENEFITS_TABLE=True)
+    def test_benefits_for_filter_uses_tree_benefits_table(self):
+        all_plots = Filter('', '', self.instance)
+        from_service = TreeBenefitsCalculator().benefits_for_filter(
+            self.instance, all_plots)
+
+        update_tree_benefits(self.instance)
+        calls = self._count_eco_calls()
+        from_table = TreeBenefitsCalculator().benefits_for_filter(
+            self.instance, all_plots)
+
+        self.assertEqual(calls, [])
+        self.assertEqual(from_table, from_service)
+
+    @override_settings(ECO_SAMPLING_THRESHOLD=0)
+    def test_sampled_summary_matches_exact_for_full_sample(self):
+        all_plots = Filter('', '', self.instance)
+        calculator = TreeBenefitsCalculator()
+        exact, __ = calculator.benefits_for_filter(
+            self.instance, all_plots, allow_sampling=False)
+        sampled, basis = calculator.benefits_for_filter(
+            self.instance, all_plots)
+
+        self.assertEqual(sampled, exact)
+        self.assertEqual(basis['plot']['n_objects_sampled'], 1)
+        self.assertEqual(basis['plot']['ci95_energy'], 0.0)
+
+    @override_settings(USE_TREE_BENEFITS_TABLE=True)
+    def test_stale_tree_benefits_are_not_used(self):
+        update_tree_benefits(self.instance)
+        self.tree.diameter = 10
+        self.tree.save_with_user(self.user)
+
+        calls = self._count_eco_calls()
+        TreeBenefitsCalculator().benefits_for_filter(
+            self.instance, Filter('', '', self.instance))
+
+        self.assertEqual(calls, ['eco_summary.json'])
+
+    @override_settings(USE_TREE_BENEFITS_TABLE=True)
+    def test_tree_benefits_scheduled_only_for_eco_changes(self):
+        scheduled = []
+        orig_schedule = tree_benefits.schedule_tree_benefits_update
+
+        def recording_schedule(instance, tree_ids=None):
+            scheduled.append(tree_ids)
+
+        tree_benefits.schedule_tree_benefits_update = recording_schedule
+        try:
+            self.tree.height = 12
+            self.tree.save_with_user(self.user)
+            self.assertEqual(scheduled, [])
+
+            self.tree.diameter = 10
+            self.tree.save_with_user(self.user)
+            self.assertEqual(scheduled, [[self.tree.pk]])
+        finally:
+            tree_benefits.schedule_tree_benefits_update = orig_schedule
+
+    @override_settings(USE_TREE_BENEFITS_TABLE=True)
+    def test_otm_code_change_invalidates_tree_benefits(self):
+        update_tree_benefits(self.instance)
+        self.assertTrue(TreeBenefits.objects.filter(tree=self.tree).exists())
+
+        self.species.otm_code = 'CEDE'
+        self.species.save_with_user(self.user)
+
+        self.assertFalse(
+            TreeBenefits.objects.filter(tree=self.tree).exists())
+
+    @override_settings(USE_TREE_BENEFITS_TABLE=True)
+    def test_moving_plot_invalidates_tree_benefits(self):
+        update_tree_benefits(self.instance)
+        self.assertTrue(TreeBenefits.objects.filter(tree=self.tree).exists())
+
+        self.plot.geom = Point(self.plot.geom.x + 10, self.plot.geom.y)
+        self.plot.save_with_user(self.user)
+
+        self.assertFalse(
+            TreeBenefits.objects.filter(tree=self.tree).exists())
+
     def testSearchBenefits(self):
         request = make_request(
             {'q': json.dumps({'tree.readonly': {'IS': False}})})  # all trees
@@ -366,6 +508,7 @@ class EcoCacheTest(UrlTestCase):
 
     def tearDown(self):
         cache.clear()
+        clear_tree_benefits_cache()
 
     def get_cached_tree_benefits(self, filter, fn):
         return get_cached_benefits('Plot', filter, fn)
@@ -381,6 +524,26 @@ class EcoCacheTest(UrlTestCase):
         benefits = self.get_cached_tree_benefits(self.filter, lambda: 'others')
         self.assertEqual(benefits, 'others')
 
+    def test_exact_benefits_are_not_replaced_by_estimate(self):
+        def compute_estimate():
+            # The exact value is written while the estimate is computed
+            set_cached_benefits('Plot', self.filter, 'exact')
+            return 'estimate'
+
+        benefits = self.get_cached_tree_benefits(self.filter,
+                                                 compute_estimate)
+        self.assertEqual(benefits, 'exact')
+
+        benefits = self.get_cached_tree_benefits(self.filter, lambda: 'others')
+        self.assertEqual(benefits, 'exact')
+
+    def test_exact_benefits_replace_estimate(self):
+        self.get_cached_tree_benefits(self.filter, lambda: 'estimate')
+        set_cached_benefits('Plot', self.filter, 'exact')
+
+        benefits = self.get_cached_tree_benefits(self.filter, lambda: 'others')
+        self.assertEqual(benefits, 'exact')
+
     def test_count_is_cached(self):
         count = get_cached_plot_count(self.filter)
         self.assertEqual(0, count)
@@ -403,6 +566,119 @@ class EcoCacheTest(UrlTestCase):
         count = get_cached_plot_count(self.filter)
         self.assertEqual(1, count)
 
+    @override_settings(ECO_CACHE_SERVE_STALE=True)
+    def test_stale_count_is_served_while_recomputing(self):
+        get_cached_plot_count(self.filter)
+
+        plot = Plot(geom=self.instance.center, instance=self.instance)
+        plot.save_with_user(self.user)
+        self.filter.instance.update_geo_rev()
+
+        stale_before = eco_cache_stats()['stale']
+        # Celery tasks run eagerly in tests, so the refresh happens here
+        self.assertEqual(0, get_cached_plot_count(self.filter))
+        self.assertEqual(eco_cache_stats()['stale'], stale_before + 1)
+
+        self.assertEqual(1, get_cached_plot_count(self.filter))
+
+    @override_settings(ECO_CACHE_LOCK_WAIT=0)
+    def test_computes_after_waiting_for_another_process(self):
+        key = _get_key('eco/Plot', self.filter)
+        cache.add(key + '/lock', True)
+
+        waits_before = eco_cache_stats()['waits']
+        benefits = self.get_cached_tree_benefits(self.filter,
+                                                 lambda: self.benefits)
+
+        self.assertEqual(benefits, self.benefits)
+        self.assertEqual(eco_cache_stats()['waits'], waits_before + 1)
+
+    def test_single_tree_benefits_are_cached(self):
+        get_cached_tree_benefits('NoEastXXX', 1, 'CEAT', 10.0,
+                                 lambda: ({'electricity': 1.0}, None))
+        benefits, err = get_cached_tree_benefits(
+            'NoEastXXX', 1, 'CEAT', 10.0,
+            lambda: ({'electricity': 2.0}, None))
+
+        self.assertIsNone(err)
+        self.assertEqual(benefits, {'electricity': 1.0})
+
+        stats = tree_benefits_cache_stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['local_hits'], 1)
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_single_tree_benefits_are_shared_between_processes(self):
+        get_cached_tree_benefits('NoEastXXX', 1, 'CEAT', 10.0,
+                                 lambda: ({'electricity': 1.0}, None))
+        # Simulate another process, which only sees the shared cache
+        clear_tree_benefits_cache()
+        benefits, __ = get_cached_tree_benefits(
+            'NoEastXXX', 1, 'CEAT', 10.0,
+            lambda: ({'electricity': 2.0}, None))
+
+        self.assertEqual(benefits, {'electricity': 1.0})
+        self.assertEqual(tree_benefits_cache_stats()['shared_hits'], 1)
+
+    def test_single_tree_errors_are_not_cached(self):
+        get_cached_tree_benefits('NoEastXXX', 1, 'CEAT', 10.0,
+                                 lambda: (None, 'some error'))
+        benefits, err = get_cached_tree_benefits(
+            'NoEastXXX', 1, 'CEAT', 10.0,
+            lambda: ({'electricity': 2.0}, None))
+
+        self.assertIsNone(err)
+        self.assertEqual(benefits, {'electricity': 2.0})
+
+    @override_settings(ECO_OVERRIDE_REV_TTL=60)
+    def test_override_rev_is_not_read_for_every_lookup(self):
+        def compute():
+            return {'electricity': 1.0}, None
+
+        get_cached_tree_benefits('NoEastXXX', 1, 'CEAT', 10.0, compute)
+        reads = override_rev_stats()['shared_reads']
+
+        get_cached_tree_benefits('NoEastXXX', 1, 'CEAT', 20.0, compute)
+        self.assertEqual(override_rev_stats()['shared_reads'], reads)
+
+    def test_warmed_boundary_filter_matches_map_page_filter(self):
+        boundary = make_simple_boundary('b1')
+        self.instance.boundaries.add(boundary)
+
+        # As sent by the map page's search (treemap/js/src/lib/search.js)
+        map_page_filter = Filter(
+            '{"mapFeature.geom":{"IN_BOUNDARY":"%s"}}' % boundary.pk, '',
+            self.instance)
+
+        warmed_keys = {_get_key('count/Plot', filter)
+                       for filter in filters_to_warm(self.instance)}
+        self.assertIn(_get_key('count/Plot', map_page_filter), warmed_keys)
+
+    def test_warming_populates_count_cache(self):
+        warm_eco_cache(self.instance)
+
+        # The count was cached by warming, before the plot was added
+        plot = Plot(geom=self.instance.center, instance=self.instance)
+        plot.save_with_user(self.user)
+
+        count = get_cached_plot_count(self.filter)
+        self.assertEqual(0, count)
+
+        status = EcoCacheWarming.objects.get(instance=self.instance)
+        self.assertEqual(status.n_filters, 1)
+        self.assertEqual(status.n_errors, 0)
+        self.assertEqual(status.geo_rev, self.instance.geo_rev)
+        self.assertIsNotNone(status.finished_at)
+
+    @override_settings(ECO_CACHE_WARMING_DELAY=60)
+    def test_warming_is_not_debounced_before_commit(self):
+        # Test transactions are never committed, so a key claimed before
+        # the commit would stay set after a rollback
+        schedule_eco_cache_warming(self.instance)
+
+        self.assertIsNone(cache.get(
+            ecocache_warming._SCHEDULED_KEY % self.instance.pk))
+
 
 class EcoserviceCacheBusterTest(OTMTestCase):
     def setUp(self):
@@ -434,3 +710,272 @@ class EcoserviceCacheBusterTest(OTMTestCase):
         invalidate_ecoservice_cache_if_stale()
 
         self.assertTrue(self.cache_invalidated)
+
+
+class ITreeCodeCatalogTest(OTMTestCase):
+    def setUp(self):
+        def mock_json_benefits_call(*args, **kwargs):
+            self.calls.append(args[0])
+            return {'Codes': {'NoEastXXX': ['CEL OTHER']}}, None
+
+        self.calls = []
+        self.orig_benefit_fn = ecobackend.json_benefits_call
+        ecobackend.json_benefits_call = mock_json_benefits_call
+        self._forget_itree_codes()
+
+    def tearDown(self):
+        ecobackend.json_benefits_call = self.orig_benefit_fn
+        self._forget_itree_codes()
+
+    def _forget_itree_codes(self):
+        # As if this were a newly started process
+        ecobenefits._itree_codes_by_region = None
+        ecobenefits._itree_codes_version = None
+
+    def test_codes_are_fetched_once_and_stored(self):
+        self.assertTrue(has_itree_code('NoEastXXX', 'CEL OTHER'))
+        self.assertFalse(has_itree_code('NoEastXXX', 'BDL OTHER'))
+
+        self._forget_itree_codes()
+        self.assertEqual(all_itree_codes(), {'CEL OTHER'})
+
+        self.assertEqual(self.calls, ['itree_codes.json'])
+        self.assertEqual(ITreeCodeCatalog.objects.count(), 1)
+
+
+@override_settings(ECO_SERVICE_URL='http://localhost:1',
+                   ECO_SERVICE_MAX_RETRIES=0)
+class EcoserviceClientTest(OTMTestCase):
+    def setUp(self):
+        ecobackend.reset_ecoservice_stats()
+
+    def tearDown(self):
+        ecobackend.reset_ecoservice_stats()
+
+    def test_connection_failure_is_counted(self):
+        result, err = ecobackend.json_benefits_call('itree_codes.json', {})
+
+        self.assertIsNone(result)
+        self.assertEqual(err, ecobackend.UNKNOWN_ECO_FAILURE)
+
+        stats = ecobackend.ecoservice_stats()['itree_codes.json']
+        self.assertEqual(stats['calls'], 1)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['error_rate'], 1.0)
+
+    def test_session_is_shared(self):
+        self.assertIs(ecobackend._get_session(), ecobackend._get_session())
+
+    def test_slow_posts_are_not_retried_after_reading(self):
+        retry = ecobackend._get_session() \
+            .get_adapter(settings.ECO_SERVICE_URL).max_retries
+
+        self.assertTrue(retry.is_retry('GET', 503))
+        self.assertFalse(retry.is_retry('POST', 503))
+
+
+class LocalEcoEngineTest(OTMTestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        region_data = {
+            'dbh_breaks_cm': [3.81, 11.43, 22.86],
+            'codes': {
+                'CEM OTHER': {
+                    'electricity': [10.0, 20.0, 40.0],
+                    'co2_storage': [100.0, 200.0, 400.0]
+                }
+            }
+        }
+        with open(os.path.join(self.data_dir, 'NoEastXXX.json'), 'w') as f:
+            json.dump(region_data, f)
+
+        self.settings_override = override_settings(
+            ECO_BACKEND='local', ITREE_DATA_DIR=self.data_dir)
+        self.settings_override.enable()
+        ecoengine._regions = None
+
+        region = ITreeRegion.objects.get(code='NoEastXXX')
+        self.instance = make_instance(point=region.geometry.point_on_surface)
+        self.user = make_commander_user(self.instance)
+        self.species = Species(otm_code='CEAT', genus='cedrus',
+                               species='atlantica', instance=self.instance)
+        self.species.save_with_user(self.user)
+
+    def tearDown(self):
+        ecoengine._regions = None
+        self.settings_override.disable()
+        shutil.rmtree(self.data_dir)
+
+    def _eco(self, otm_code, diameter):
+        params = {'otmcode': otm_code,
+                  'diameter': diameter,
+                  'region': 'NoEastXXX',
+                  'instanceid': self.instance.pk,
+                  'speciesid': self.species.pk}
+        return ecobackend.json_benefits_call('eco.json', params.iteritems())
+
+    def _add_tree(self, diameter):
+        plot = Plot(geom=self.instance.center, instance=self.instance)
+        plot.save_with_user(self.user)
+        Tree(plot=plot, instance=self.instance, species=self.species,
+             diameter=diameter).save_with_user(self.user)
+
+    def test_interpolates_between_dbh_breaks(self):
+        # 3 inches is 7.62cm, halfway between the first two breaks
+        result, err = self._eco('CEAT', 3.0)
+
+        self.assertIsNone(err)
+        self.assertAlmostEqual(result['Benefits']['electricity'], 15.0)
+        self.assertAlmostEqual(result['Benefits']['co2_storage'], 150.0)
+        self.assertEqual(result['Benefits']['natural_gas'], 0.0)
+
+    def test_clamps_to_dbh_breaks(self):
+        result, __ = self._eco('CEAT', 100.0)
+
+        self.assertAlmostEqual(result['Benefits']['electricity'], 40.0)
+
+    def test_unknown_species_is_invalid_pair(self):
+        result, err = self._eco('NOTACODE', 3.0)
+
+        self.assertIsNone(result)
+        self.assertEqual(err, ecobackend.INVALID_ECO_PAIR)
+
+    def test_override_without_data_is_incomplete(self):
+        ITreeCodeOverride(
+            instance_species=self.species,
+            region=ITreeRegion.objects.get(code='NoEastXXX'),
+            itree_code='BDL OTHER'
+        ).save_with_user(self.user)
+        ecoengine._invalidate_cache({})
+
+        result, err = self._eco('CEAT', 3.0)
+
+        self.assertEqual(err, ecobackend.INCOMPLETE_ECO_DATA)
+
+    def test_summary_sums_trees(self):
+        self._add_tree(3.0)
+        self._add_tree(100.0)
+        Plot(geom=self.instance.center, instance=self.instance)\
+            .save_with_user(self.user)
+
+        rslt, basis = TreeBenefitsCalculator().benefits_for_filter(
+            self.instance, Filter('', '', self.instance))
+
+        self.assertEqual(basis['plot']['n_objects_used'], 2)
+        expected = compute_currency_and_transform_units(
+            self.instance, {'electricity': 55.0, 'co2_storage': 550.0})
+        self.assertAlmostEqual(rslt['plot']['energy']['value'],
+                               expected['plot']['energy']['value'])
+        self.assertAlmostEqual(rslt['plot']['co2storage']['value'],
+                               expected['plot']['co2storage']['value'])
+
+    def _write_ecoservice_tables(self):
+        # Tables in the ecoservice's layout. The values at the 4140.2cm
+        # (1630 inch) break are those the ecoservice returned for a CEAT
+        # (CEM OTHER) of that size, and the neighbouring breaks have half
+        # and double those values, so that diameters between the breaks
+        # are interpolated.
+        os.remove(os.path.join(self.data_dir, 'NoEastXXX.json'))
+        region_dir = os.path.join(self.data_dir, 'NoEastXXX')
+        os.mkdir(region_dir)
+        for factor, value in ECOSERVICE_CEAT_BENEFITS.iteritems():
+            filename = 'output__NoEastXXX__%s.csv' % factor
+            with open(os.path.join(region_dir, filename), 'w') as f:
+                f.write('itree_code,3.81,2070.1,4140.2,8280.4\n')
+                f.write('CEM OTHER,0,%s,%s,%s\n'
+                        % (value / 2, value, value * 2))
+                f.write('BDL OTHER,1,2,3,4\n')
+        ecoengine._regions = None
+
+    def _assert_ceat_benefits(self, benefits, scale):
+        self.assertEqual(set(benefits), set(ECOSERVICE_CEAT_BENEFITS))
+        for factor, value in ECOSERVICE_CEAT_BENEFITS.iteritems():
+            self.assertAlmostEqual(benefits[factor], value * scale)
+
+    def test_reads_ecoservice_tables(self):
+        self._write_ecoservice_tables()
+
+        result, err = self._eco('CEAT', 1630)
+        self.assertIsNone(err)
+        self._assert_ceat_benefits(result['Benefits'], 1.0)
+
+        # 1426.25 inches is 3622.675cm, 3/4 of the way between the
+        # 2070.1cm and 4140.2cm breaks
+        result, __ = self._eco('CEAT', 1426.25)
+        self._assert_ceat_benefits(result['Benefits'], 0.875)
+
+        # 2445 inches is 6210.3cm, halfway between the 4140.2cm and
+        # 8280.4cm breaks
+        result, __ = self._eco('CEAT', 2445)
+        self._assert_ceat_benefits(result['Benefits'], 1.5)
+
+    def test_scenario_diameters_are_in_cm(self):
+        self._write_ecoservice_tables()
+        params = {
+            'region': 'NoEastXXX',
+            'instance_id': str(self.instance.pk),
+            'years': 3,
+            'scenario_trees': [{
+                'otmcode': 'CEAT',
+                'species_id': self.species.pk,
+                'region': 'NoEastXXX',
+                # Not yet planted, then 1630 and 1426.25 inches
+                'diameters': [0, 4140.2, 3622.675]
+            }]
+        }
+
+        result, err = ecobackend.json_benefits_call(
+            'eco_scenario.json', params, post=True, convert_params=False)
+
+        self.assertIsNone(err)
+        self._assert_ceat_benefits(result['Years'][0], 0.0)
+        self._assert_ceat_benefits(result['Years'][1], 1.0)
+        self._assert_ceat_benefits(result['Years'][2], 0.875)
+        self._assert_ceat_benefits(result['Total'], 1.875)
+
+    def test_itree_codes(self):
+        result, err = ecobackend.json_benefits_call('itree_codes.json', {})
+
+        self.assertEqual(result, {'Codes': {'NoEastXXX': ['CEM OTHER']}})
+
+
+@override_settings(FEATURE_BACKEND_FUNCTION=None, **test_settings)
+class ThreadedBenefitsTest(TransactionTestCase):
+    # Each map feature class's benefits are only computed on a separate
+    # thread outside of a transaction, so this can't be a TestCase.
+    # TransactionTestCase empties the tables after each test, so restore
+    # the data loaded by migrations (e.g. i-Tree regions) afterwards.
+    serialized_rollback = True
+
+    def setUp(self):
+        self.instance = make_instance()
+        self.instance.add_map_feature_types(['RainBarrel'])
+        user = make_commander_user(self.instance)
+
+        Plot(geom=Point(0, 0), instance=self.instance).save_with_user(user)
+        RainBarrel(geom=Point(0, 0), instance=self.instance,
+                   capacity=50.0).save_with_user(user)
+
+    def test_threaded_benefits_match_serial_benefits(self):
+        filter = Filter('', '', self.instance)
+
+        with override_settings(ECO_BENEFIT_THREADS=1):
+            serial = get_benefits_for_filter(filter)
+
+        threaded_classes = []
+        orig_in_thread = ecobenefits._benefits_for_class_in_thread
+
+        def recording_in_thread(args):
+            threaded_classes.append(args[0])
+            return orig_in_thread(args)
+
+        ecobenefits._benefits_for_class_in_thread = recording_in_thread
+        try:
+            with override_settings(ECO_BENEFIT_THREADS=4):
+                threaded = get_benefits_for_filter(filter)
+        finally:
+            ecobenefits._benefits_for_class_in_thread = orig_in_thread
+
+        self.assertEqual(set(threaded_classes),
+                         self.instance.map_feature_classes)
+        self.assertEqual(threaded, serial)
@@ -7,9 +7,12 @@ from django.contrib.gis.geos import Point
 from django.db.models import Count
 
 from treemap.models import Plot
-from treemap.lib.hide_at_zoom import (recompute_hide_at_zoom,
+from treemap.lib import hide_at_zoom
+from treemap.lib.hide_at_zoom import (batch_new_plots,
+                                      recompute_hide_at_zoom,
                                       update_hide_at_zoom_after_delete,
                                       update_hide_at_zoom_after_move)
+from treemap.lib.grid_counts import grid_cell, grid_counts, is_valid_grid
 from treemap.tests import make_instance, make_commander_user
 from treemap.tests.base import OTMTestCase
 
@@ -56,6 +59,84 @@ class HideAtZoomTests(OTMTestCase):
         update_hide_at_zoom_after_move(plot, self.user, old_point)
         self.assert_counts(expected_count_dict)
 
+    def test_recompute_skips_unchanged_instance(self):
+        self.assertFalse(recompute_hide_at_zoom(self.instance))
+        self.assertTrue(recompute_hide_at_zoom(self.instance, force=True))
+        self.assert_counts({14: 2, 10: 1})
+
+        # Saving a plot doesn't change geo_rev, so this is skipped too
+        self.make_plots([(0, 300)])
+        self.instance.refresh_from_db()
+        self.assertFalse(recompute_hide_at_zoom(self.instance))
+
+        # The views bump geo_rev after saving a plot
+        self.instance.update_geo_rev()
+        self.assertTrue(recompute_hide_at_zoom(self.instance))
+
+    def test_recompute_writes_only_changed_rows(self):
+        geo_rev = self.instance.geo_rev
+        recompute_hide_at_zoom(self.instance, force=True)
+        self.assertEqual(geo_rev, self.instance.geo_rev)
+
+    def test_celery_recompute_reports_each_instance(self):
+        other_instance = make_instance()
+        reports = []
+        orig_log_recompute_reports = hide_at_zoom.log_recompute_reports
+        hide_at_zoom.log_recompute_reports = reports.extend
+        try:
+            hide_at_zoom.schedule_hide_at_zoom_recompute(
+                [self.instance.pk, other_instance.pk], force=True,
+                concurrency=1)
+        finally:
+            hide_at_zoom.log_recompute_reports = orig_log_recompute_reports
+
+        self.assertEqual([self.instance.url_name, other_instance.url_name],
+                         [report['instance'] for report in reports])
+        self.assertTrue(all(report['recomputed'] for report in reports))
+
+    def test_celery_recompute_continues_after_failure(self):
+        failing_instance = make_instance()
+        other_instance = make_instance()
+        reports = []
+        orig_log_recompute_reports = hide_at_zoom.log_recompute_reports
+        orig_recompute_hide_at_zoom = hide_at_zoom.recompute_hide_at_zoom
+
+        def failing_recompute(instance, *args, **kwargs):
+            if instance.pk == failing_instance.pk:
+                raise Exception('Failed')
+            return orig_recompute_hide_at_zoom(instance, *args, **kwargs)
+
+        hide_at_zoom.log_recompute_reports = reports.extend
+        hide_at_zoom.recompute_hide_at_zoom = failing_recompute
+        try:
+            hide_at_zoom.schedule_hide_at_zoom_recompute(
+                [failing_instance.pk, self.instance.pk, other_instance.pk],
+                force=True, concurrency=1)
+        finally:
+            hide_at_zoom.log_recompute_reports = orig_log_recompute_reports
+            hide_at_zoom.recompute_hide_at_zoom = orig_recompute_hide_at_zoom
+
+        self.assertEqual([failing_instance.url_name, self.instance.url_name,
+                          other_instance.url_name],
+                         [report['instance'] for report in reports])
+        self.assertIn('error', reports[0])
+        self.assertFalse(reports[0]['recomputed'])
+        self.assertTrue(all(report['recomputed'] for report in reports[1:]))
+
+    def test_new_plot_is_hidden_where_cell_has_visible_plot(self):
+        plot = Plot(instance=self.instance, geom=Point(0, 102))
+        plot.save_with_user(self.user)
+
+        self.assertEqual(14, plot.hide_at_zoom)
+        self.assertEqual(14, Plot.objects.get(pk=plot.pk).hide_at_zoom)
+
+    def test_new_plots_are_hidden_in_batches(self):
+        with batch_new_plots():
+            self.make_plots([(0, 450), (0, 451)])
+
+        new_plots = Plot.objects.order_by('-pk')[:2]
+        self.assertEqual([14, 9], [p.hide_at_zoom for p in new_plots])
+
     def test_delete_1(self):
         plot = Plot.objects.get(hide_at_zoom=None)
         self.delete_and_assert_counts(plot, {14: 1, 10: 1})
@@ -73,3 +154,30 @@ class HideAtZoomTests(OTMTestCase):
         plot = Plot.objects.get(hide_at_zoom=10)
         point = (1, plot.geom.y)
         self.move_and_assert_counts(plot, point, {14: 1, 10: 1})
+
+
+class GridCountsTests(OTMTestCase):
+    def setUp(self):
+        self.instance = make_instance(edge_length=1000)
+        self.user = make_commander_user(self.instance)
+        for p in [(0, 100), (0, 101), (0, 200), (0, 201)]:
+            plot = Plot(instance=self.instance, geom=Point(*p))
+            plot.save_with_user(self.user)
+
+    def counts(self, zoom, cell_pixels):
+        cells = grid_counts(self.instance, '', '', (-1, -1, 1, 1), zoom,
+                            cell_pixels)
+        return [cell['n_plots'] for cell in cells]
+
+    def test_grid_cell_is_stored_on_save(self):
+        plot = Plot.objects.get(instance=self.instance, geom=Point(0, 200))
+        self.assertEqual((plot.grid_x, plot.grid_y), grid_cell(plot.geom))
+
+    def test_counts_per_cell(self):
+        self.assertEqual([2, 2], self.counts(14, 2))
+        self.assertEqual([4], self.counts(10, 64))
+
+    def test_valid_grids(self):
+        self.assertTrue(is_valid_grid(10, 64))
+        self.assertFalse(is_valid_grid(10, 48))
+        self.assertFalse(is_valid_grid(15, 64))
@@ -13,6 +13,8 @@ from treemap.models import Tree, Plot, MapFeature, Species, TreePhoto
 from treemap.instance import Instance
 from treemap.search import Filter
 from treemap.lib import format_benefits
+from treemap.lib.vector_tiles import (WEB_MERCATOR_MAX, get_vector_tile,
+                                      tile_bounds, vector_tiles_supported)
 from treemap.ecobenefits import get_benefits_for_filter, BenefitCategory
 from treemap.tests import (make_instance, make_commander_user,
                            LocalMediaTestCase)
@@ -357,3 +359,40 @@ class UpdatedFieldsTest(LocalMediaTestCase):
         self.plot.refresh_from_db()
         self.assertGreater(self.plot.updated_at, self.initial_updated)
         self.assertEqual(self.plot.updated_by, self.fellow)
+
+
+class VectorTileTest(OTMTestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.user = make_commander_user(self.instance)
+        # In tile 16/16 at zoom 5, and 2^(z-1) at any zoom z
+        self.plot = Plot(geom=Point(1000, -1000), instance=self.instance)
+        self.plot.save_with_user(self.user)
+
+    def _tile(self, z, filterstr=''):
+        if not vector_tiles_supported():
+            self.skipTest('Vector tiles need PostGIS 2.4 with protobuf')
+        n = 2 ** (z - 1)
+        return get_vector_tile(self.instance, filterstr, '', z, n, n)
+
+    def test_tile_bounds(self):
+        self.assertEqual((-WEB_MERCATOR_MAX, -WEB_MERCATOR_MAX,
+                          WEB_MERCATOR_MAX, WEB_MERCATOR_MAX),
+                         tile_bounds(0, 0, 0))
+        self.assertEqual((0, -WEB_MERCATOR_MAX / 2,
+                          WEB_MERCATOR_MAX / 2, 0),
+                         tile_bounds(2, 2, 2))
+
+    def test_tile_honors_hide_at_zoom(self):
+        MapFeature.objects.filter(pk=self.plot.pk).update(hide_at_zoom=5)
+        self.instance.update_geo_rev()
+
+        self.assertEqual(b'', self._tile(5))
+        self.assertNotEqual(b'', self._tile(6))
+
+    def test_tile_applies_filter(self):
+        matching = '{"plot.id": {"IS": %s}}' % self.plot.pk
+        not_matching = '{"plot.id": {"IS": %s}}' % (self.plot.pk + 1)
+
+        self.assertNotEqual(b'', self._tile(5, matching))
+        self.assertEqual(b'', self._tile(5, not_matching))
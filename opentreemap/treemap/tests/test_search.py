@@ -9,9 +9,12 @@ import psycopg2
 from datetime import datetime
 from functools import partial
 
+from django.core.cache import cache
 from django.db.models import Q
 from django.db import connection
 from django.db.models.query import QuerySet
+from django.test.utils import override_settings
+from django.utils.timezone import utc
 from django.utils.tree import Node
 
 from django.contrib.gis.geos import Point, MultiPolygon
@@ -21,7 +24,12 @@ from treemap.tests import (make_instance, make_commander_user,
                            make_simple_polygon, set_write_permissions)
 from treemap.tests.base import OTMTestCase
 from treemap.tests.test_udfs import make_collection_udf
-from treemap.models import (Tree, Plot, Boundary, Species)
+from treemap.models import (Tree, Plot, Boundary, Species, SearchResultSet,
+                            MapFeatureBoundary)
+from treemap.lib.boundary_membership import (members_are_indexed,
+                                             update_boundary_members)
+from treemap.lib.facets import FacetError, facet_counts
+from treemap.lib.search_result_sets import prune_search_result_sets
 from treemap.udf import UserDefinedFieldDefinition
 from treemap import search
 
@@ -752,6 +760,75 @@ class SearchTests(OTMTestCase):
         self.assertEqual(
             0, len(plots))
 
+    def test_indexed_boundary_search(self):
+        b = Boundary.objects.create(
+            geom=MultiPolygon(make_simple_polygon(0)),
+            name='whatever',
+            category='whatever',
+            sort_order=1)
+        self.instance.boundaries.add(b)
+
+        plot1 = Plot(geom=Point(0.9, 0.9), instance=self.instance)
+        plot1.save_with_user(self.commander)
+
+        update_boundary_members(b)
+        b.refresh_from_db()
+        self.assertTrue(members_are_indexed(b))
+
+        # Features saved after the boundary was indexed are added to it
+        plot2 = Plot(geom=Point(0.5, 0.5), instance=self.instance)
+        plot2.save_with_user(self.commander)
+        plot1.geom = Point(1.1, 1.1)
+        plot1.save_with_user(self.commander)
+
+        self.assertEqual(search._parse_in_boundary(b.pk).keys(),
+                         [search._MAP_FEATURE_ID_IN])
+
+        boundary_filter = json.dumps({'plot.geom': {'IN_BOUNDARY': b.pk}})
+        plots = search.Filter(boundary_filter, '', self.instance)\
+                      .get_objects(Plot)
+
+        self.assertEqual({plot2.pk}, {p.pk for p in plots})
+
+    def test_boundary_members_are_limited_to_linked_instances(self):
+        b = Boundary.objects.create(
+            geom=MultiPolygon(make_simple_polygon(0)),
+            name='whatever',
+            category='whatever',
+            sort_order=1)
+        self.instance.boundaries.add(b)
+
+        other_instance = make_instance(point=self.p1)
+        other_commander = make_commander_user(other_instance, 'other')
+
+        plot = Plot(geom=Point(0.5, 0.5), instance=self.instance)
+        plot.save_with_user(self.commander)
+        Plot(geom=Point(0.5, 0.5), instance=other_instance) \
+            .save_with_user(other_commander)
+
+        update_boundary_members(b)
+        Plot(geom=Point(0.6, 0.6), instance=other_instance) \
+            .save_with_user(other_commander)
+
+        self.assertEqual({plot.pk}, {m.map_feature_id for m in
+                                     MapFeatureBoundary.objects.all()})
+
+    def test_linking_boundary_invalidates_members(self):
+        b = Boundary.objects.create(
+            geom=MultiPolygon(make_simple_polygon(0)),
+            name='whatever',
+            category='whatever',
+            sort_order=1)
+        self.instance.boundaries.add(b)
+        update_boundary_members(b)
+        b.refresh_from_db()
+        self.assertTrue(members_are_indexed(b))
+
+        make_instance(point=self.p1).boundaries.add(b)
+
+        b.refresh_from_db()
+        self.assertFalse(members_are_indexed(b))
+
     def setup_diameter_test(self):
         p1, t1 = self.create_tree_and_plot()
         t1.diameter = 2.0
@@ -1018,3 +1095,175 @@ class SearchTests(OTMTestCase):
                     # Range encompasses p1's prune but not p1's water action
                     {'MIN': '2013-09-01 00:00:00',
                      'MAX': '2013-10-31 00:00:00'}}))
+
+
+@override_settings(FILTER_CACHE_SIZE=10)
+class CompiledFilterCacheTest(OTMTestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.commander = make_commander_user(self.instance)
+        self.filterstr = json.dumps({'plot.id': {'MIN': 0}})
+
+        self.n_compiled = 0
+        self.orig_create_filter = search.create_filter
+
+        def counting_create_filter(*args, **kwargs):
+            self.n_compiled += 1
+            return self.orig_create_filter(*args, **kwargs)
+
+        search.create_filter = counting_create_filter
+        search.clear_compiled_filters()
+
+    def tearDown(self):
+        search.create_filter = self.orig_create_filter
+        search.clear_compiled_filters()
+
+    def test_filter_is_compiled_once_per_rev(self):
+        plot = Plot(geom=self.instance.center, instance=self.instance)
+        plot.save_with_user(self.commander)
+
+        for __ in range(2):
+            plots = search.Filter(self.filterstr, '', self.instance) \
+                .get_objects(Plot)
+            self.assertEqual(list(plots), [plot])
+        self.assertEqual(self.n_compiled, 1)
+
+        self.instance.update_universal_rev()
+        search.Filter(self.filterstr, '', self.instance).get_object_count(Plot)
+        self.assertEqual(self.n_compiled, 2)
+
+
+@override_settings(USE_SEARCH_RESULT_SETS=True)
+class SearchResultSetTest(OTMTestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.commander = make_commander_user(self.instance)
+        self.filterstr = json.dumps({'plot.id': {'MIN': 0}})
+
+    def _make_plot(self):
+        plot = Plot(geom=self.instance.center, instance=self.instance)
+        plot.save_with_user(self.commander)
+        return plot
+
+    def _search(self):
+        return set(search.Filter(self.filterstr, '', self.instance)
+                   .get_objects(Plot))
+
+    def test_results_are_stored_when_filter_is_reused(self):
+        cache.clear()
+        plot1 = self._make_plot()
+        self.assertEqual(self._search(), {plot1})
+        self.assertEqual(SearchResultSet.objects.count(), 0)
+
+        self.assertEqual(self._search(), {plot1})
+        self.assertEqual(SearchResultSet.objects.count(), 1)
+
+    def test_results_are_reused_until_rev_changes(self):
+        cache.clear()
+        plot1 = self._make_plot()
+        self._search()
+        self.assertEqual(self._search(), {plot1})
+
+        # Saving a plot doesn't change the instance object's rev
+        plot2 = self._make_plot()
+        self.assertEqual(self._search(), {plot1})
+        self.assertEqual(SearchResultSet.objects.count(), 1)
+
+        self.instance.update_universal_rev()
+        self._search()
+        self.assertEqual(self._search(), {plot1, plot2})
+        self.assertEqual(SearchResultSet.objects.count(), 2)
+
+    @override_settings(SEARCH_RESULT_SET_GRACE_PERIOD=0)
+    def test_superseded_results_are_kept_until_pruned(self):
+        cache.clear()
+        plot1 = self._make_plot()
+        self._search()
+        stored = search.Filter(self.filterstr, '', self.instance) \
+            .get_objects(Plot)
+
+        self.instance.update_universal_rev()
+        self._search()
+        self._search()
+
+        # A queryset built before the rev changed still works
+        self.assertEqual(set(stored.all()), {plot1})
+
+        prune_search_result_sets()
+        self.assertEqual(SearchResultSet.objects.count(), 2)
+        self.assertIsNotNone(SearchResultSet.objects
+                             .get(universal_rev__lt=self.instance
+                                  .universal_rev)
+                             .superseded_at)
+
+        # now() is the start of the test's transaction, so backdate
+        SearchResultSet.objects \
+            .filter(superseded_at__isnull=False) \
+            .update(superseded_at=datetime(2000, 1, 1, tzinfo=utc))
+        self.assertEqual(1, prune_search_result_sets())
+        self.assertEqual(set(stored.all()), set())
+
+
+class FacetTest(OTMTestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.commander = make_commander_user(self.instance)
+        self.species = Species(common_name='Species-1', genus='Genus-1',
+                               otm_code='S1', instance=self.instance)
+        self.species.save_with_user(self.commander)
+
+        for diameter in (3, 4, 13):
+            plot = Plot(geom=self.instance.center, instance=self.instance)
+            plot.save_with_user(self.commander)
+            tree = Tree(plot=plot, instance=self.instance,
+                        species=self.species, diameter=diameter)
+            tree.save_with_user(self.commander)
+
+    def _facets(self, filterstr, *facet_names):
+        filter = search.Filter(filterstr, '', self.instance)
+        return facet_counts(filter, facet_names)
+
+    def test_species_and_diameter_facets(self):
+        facets = self._facets('', 'species', 'diameter')
+
+        self.assertEqual([{'id': self.species.pk, 'name': 'Species-1',
+                           'count': 3}],
+                         facets['species'])
+        self.assertEqual([{'min': 0, 'max': 6, 'count': 2},
+                          {'min': 12, 'max': 18, 'count': 1}],
+                         facets['diameter'])
+
+    def test_facets_apply_filter(self):
+        facets = self._facets(json.dumps({'tree.diameter': {'MIN': 10}}),
+                              'diameter')
+
+        self.assertEqual([{'min': 12, 'max': 18, 'count': 1}],
+                         facets['diameter'])
+
+    def test_unknown_facet(self):
+        with self.assertRaises(FacetError):
+            self._facets('', 'plot.udf:Nonexistent')
+
+    def test_boundary_facet_only_counts_instance_boundaries(self):
+        geom = MultiPolygon(self.instance.center.buffer(10))
+        boundary = Boundary.objects.create(
+            geom=geom, name='Ours', category='Unknown', sort_order=1)
+        self.instance.boundaries.add(boundary)
+        update_boundary_members(boundary)
+
+        # Another instance's boundary covering the same plots, with the
+        # membership rows it could get before membership was limited to
+        # linked instances
+        other_boundary = Boundary.objects.create(
+            geom=geom, name='Theirs', category='Unknown', sort_order=1)
+        make_instance(point=self.instance.center) \
+            .boundaries.add(other_boundary)
+        MapFeatureBoundary.objects.bulk_create(
+            MapFeatureBoundary(map_feature=plot, boundary=other_boundary)
+            for plot in Plot.objects.filter(instance=self.instance))
+
+        facets = self._facets('', 'boundary')
+
+        self.assertEqual([{'id': boundary.pk, 'name': 'Ours',
+                           'category': 'Unknown', 'count': 3}],
+                         facets['boundary'])
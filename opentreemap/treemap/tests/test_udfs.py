@@ -20,12 +20,14 @@ from treemap.tests import (make_instance, make_commander_user,
 
 from treemap.lib.object_caches import role_field_permissions
 from treemap.lib.udf import udf_create
+from treemap.lib.udf_indexes import sync_udf_indexes, udf_index_usage
 
 from treemap.instance import create_stewardship_udfs
 from treemap.udf import UserDefinedFieldDefinition, UDFDictionary
 from treemap.models import Instance, Plot, User
 from treemap.audit import AuthorizeException, FieldPermission, Role
 from treemap.tests.base import OTMTestCase
+from treemap import search
 
 
 def make_collection_udf(instance, name='Stewardship', model='Plot',
@@ -357,6 +359,58 @@ class ScalarUDFFilterTest(ScalarUDFTestCase):
             {plot.pk for plot in plots})
 
 
+class UDFIndexTest(ScalarUDFTestCase):
+    def _index_names(self):
+        return {usage['name'] for usage in udf_index_usage(self.instance)}
+
+    def test_indexes_follow_search_config(self):
+        udfd = UserDefinedFieldDefinition.objects.get(
+            instance=self.instance, name='Test int')
+        index_name = 'udf_idx_%s_%s_0' % (self.instance.pk, udfd.pk)
+
+        self.instance.search_config['Plot'].append(
+            {'identifier': 'plot.udf:Test int'})
+        self.instance.save()
+
+        created, dropped, failed = sync_udf_indexes(self.instance)
+        self.assertEqual([index_name], created)
+        self.assertEqual([], failed)
+        self.assertIn(index_name, self._index_names())
+
+        self.instance.search_config['Plot'] = []
+        self.instance.save()
+
+        created, dropped, failed = sync_udf_indexes(self.instance)
+        self.assertEqual([index_name], dropped)
+        self.assertNotIn(index_name, self._index_names())
+
+    def test_tree_udf_search_uses_index(self):
+        udfd = UserDefinedFieldDefinition.objects.create(
+            instance=self.instance,
+            model_type='Tree',
+            datatype=json.dumps({'type': 'int'}),
+            iscollection=False,
+            name='Tree int')
+        index_name = 'udf_idx_%s_%s_0' % (self.instance.pk, udfd.pk)
+
+        self.instance.search_config.setdefault('Tree', []).append(
+            {'identifier': 'tree.udf:Tree int'})
+        self.instance.save()
+        sync_udf_indexes(self.instance)
+
+        filterstr = json.dumps({'tree.udf:Tree int': {'MIN': 5}})
+        plots = search.Filter(filterstr, '', self.instance).get_objects(Plot)
+        sql, params = plots.query.sql_with_params()
+
+        with connection.cursor() as cursor:
+            # The test tables are tiny, so make the planner avoid them
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql, params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+
+        self.assertIn(index_name, plan)
+
+
 class UDFAuditTest(OTMTestCase):
     def setUp(self):
         self.p = Point(-8515941.0, 4953519.0)
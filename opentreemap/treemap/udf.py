@@ -1033,6 +1033,21 @@ post_save.connect(invalidate_adjuncts, sender=UserDefinedFieldDefinition)
 post_delete.connect(invalidate_adjuncts, sender=UserDefinedFieldDefinition)
 
 
+def _udf_indexes_changed(sender, instance, **kwargs):
+    from treemap.lib.udf_indexes import schedule_udf_index_sync
+    if isinstance(instance, Instance):
+        schedule_udf_index_sync(instance)
+    else:
+        schedule_udf_index_sync(instance.instance)
+
+
+# Changing a UDF or an instance's search configuration can change which
+# UDF indexes are needed (see treemap/lib/udf_indexes.py)
+post_save.connect(_udf_indexes_changed, sender=UserDefinedFieldDefinition)
+post_delete.connect(_udf_indexes_changed, sender=UserDefinedFieldDefinition)
+post_save.connect(_udf_indexes_changed, sender=Instance)
+
+
 # To understand hooks used by this field, see
 # https://docs.djangoproject.com/en/1.8/howto/custom-model-fields/
 # and
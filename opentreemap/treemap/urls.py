@@ -36,6 +36,10 @@ urlpatterns = [
     url(r'^features/(?P<feature_id>\d+)/popup$',
         routes.map_feature_popup, name='map_feature_popup'),
     url(r'^canopy-popup$', routes.canopy_popup, name='canopy_popup'),
+    url(r'^tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.mvt$',
+        routes.vector_tile, name='vector_tile'),
+    url(r'^plots/grid-counts$', routes.plot_grid_counts,
+        name='plot_grid_counts'),
     url(r'^features/(?P<feature_id>\d+)/trees/(?P<tree_id>\d+)/$',
         routes.delete_tree, name='delete_tree'),
     url(r'^features/(?P<feature_id>\d+)/sidebar$',
@@ -73,6 +77,7 @@ urlpatterns = [
         routes.instance_settings_js, name='settings'),
     url(r'^benefit/search$', routes.search_tree_benefits,
         name='benefit_search'),
+    url(r'^search/facets$', routes.search_facets, name='search_facets'),
     url(r'^users/%s/$' % USERNAME_PATTERN, routes.instance_user_page,
         name="user_profile"),
     url(r'^users/%s/edits/$' % USERNAME_PATTERN, routes.instance_user_audits),
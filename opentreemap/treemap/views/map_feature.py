@@ -7,7 +7,7 @@ import json
 import hashlib
 from functools import wraps
 
-from django.http import HttpResponse
+from django.http import HttpResponse, Http404
 from django.shortcuts import get_object_or_404, render
 from django.core.exceptions import ValidationError
 from django.conf import settings
@@ -16,9 +16,15 @@ from django.contrib.gis.geos import Point, MultiPolygon, Polygon
 from django.contrib.gis.db.models import GeometryField
 from django.utils.translation import ugettext as _
 
+from django_tinsel.exceptions import HttpBadRequestException
+
 from opentreemap.util import dotted_split
 from treemap.lib.hide_at_zoom import (update_hide_at_zoom_after_move,
                                       update_hide_at_zoom_after_delete)
+from treemap.lib.vector_tiles import (MIN_POSTGIS_VERSION, get_vector_tile,
+                                      is_valid_tile, vector_tiles_supported)
+from treemap.lib.grid_counts import (DEFAULT_CELL_PIXELS, grid_counts,
+                                     is_valid_grid)
 
 from treemap.units import Convertible
 from treemap.models import (Tree, Species, MapFeature,
@@ -428,6 +434,42 @@ def canopy_popup(request, instance):
     return HttpResponse('')
 
 
+def vector_tile(request, instance, z, x, y):
+    if not vector_tiles_supported():
+        raise Http404('Vector tiles need PostGIS %s.%s or later' %
+                      MIN_POSTGIS_VERSION)
+
+    z, x, y = int(z), int(x), int(y)
+    if not is_valid_tile(z, x, y):
+        raise Http404('No such tile')
+
+    tile = get_vector_tile(instance, request.GET.get('q', ''),
+                           request.GET.get('show', ''), z, x, y)
+    return HttpResponse(tile,
+                        content_type='application/vnd.mapbox-vector-tile')
+
+
+def plot_grid_counts(request, instance):
+    try:
+        bbox = [float(request.GET[b])
+                for b in ('xmin', 'ymin', 'xmax', 'ymax')]
+        zoom = int(request.GET['zoom'])
+        cell_pixels = int(request.GET.get('cell_pixels',
+                                          DEFAULT_CELL_PIXELS))
+    except (KeyError, ValueError):
+        raise HttpBadRequestException(
+            'xmin, ymin, xmax, ymax and zoom must be numbers')
+
+    if not is_valid_grid(zoom, cell_pixels):
+        raise HttpBadRequestException('Unsupported zoom or cell size')
+
+    include_trees = request.GET.get('trees', 'false').lower() == 'true'
+
+    return grid_counts(instance, request.GET.get('q', ''),
+                       request.GET.get('show', ''), bbox, zoom,
+                       cell_pixels, include_trees)
+
+
 def _get_boundaries_with_canopy(instance, point):
     boundaries = instance.boundaries \
         .filter(geom__contains=point) \
@@ -12,11 +12,14 @@ from django.shortcuts import get_object_or_404
 from django.db import transaction
 from django.http import HttpResponseRedirect
 
+from django_tinsel.exceptions import HttpBadRequestException
+
 from treemap.search import Filter
 from treemap.models import Tree, Plot
 from treemap.ecobenefits import get_benefits_for_filter
 from treemap.ecocache import get_cached_plot_count
 from treemap.lib import format_benefits
+from treemap.lib.facets import FacetError, STANDARD_FACETS, facet_counts
 from treemap.lib.tree import add_tree_photo_helper
 from treemap.lib.photo import context_dict_for_photo
 
@@ -99,6 +102,17 @@ def search_tree_benefits(request, instance):
     return context
 
 
+def search_facets(request, instance):
+    filter = Filter(request.GET.get('q', ''), request.GET.get('show', ''),
+                    instance)
+    facet_names = request.GET.getlist('facet') or STANDARD_FACETS
+
+    try:
+        return facet_counts(filter, facet_names)
+    except FacetError as e:
+        raise HttpBadRequestException(e.message)
+
+
 def _single_result_context(instance, n_plots, n_resources, filter):
     # If search found just one feature, return its id and location
     if n_plots + n_resources != 1: